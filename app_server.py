@@ -29,8 +29,10 @@ from sqlalchemy.orm.exc import (
 from model import (
     get_one,
     Complaint,
+    Edition,
     Identifier,
     Patron,
+    Work,
 )
 from util.cdn import cdnify
 from classifier import Classifier
@@ -248,6 +250,11 @@ class URNLookupController(object):
         self.works = []
         self.precomposed_entries = []
         self.unresolved_identifiers = []
+        self.identifiers_by_urn = {}
+
+        # Objects loaded ahead of time by preload(). Holding on to
+        # them keeps them in the session's identity map.
+        self.preloaded = []
 
     def work_lookup(self, annotator, route_name='lookup',
                     urns=[], **process_urn_kwargs):
@@ -255,8 +262,7 @@ class URNLookupController(object):
         urns = flask.request.args.getlist('urn')
 
         this_url = cdn_url_for(route_name, _external=True, urn=urns)
-        for urn in urns:
-            self.process_urn(urn, **process_urn_kwargs)
+        self.process_urns(urns, **process_urn_kwargs)
         self.post_lookup_hook()
 
         opds_feed = LookupAcquisitionFeed(
@@ -282,13 +288,70 @@ class URNLookupController(object):
 
         return feed_response(opds_feed)
     
+    def resolve_urns(self, urns):
+        """Look up the Identifiers for a number of URNs at once, so
+        process_urn doesn't have to look them up one at a time.
+        """
+        identifiers, unparseable = Identifier.parse_urns(self._db, urns)
+        self.identifiers_by_urn.update(identifiers)
+        for urn in unparseable:
+            self.identifiers_by_urn[urn] = None
+
+    def process_urns(self, urns, **process_urn_kwargs):
+        """Turn a number of URNs into Works suitable for use in an OPDS
+        feed.
+
+        Everything process_urn and the feed need is loaded with a
+        handful of queries up front, so the number of queries doesn't
+        grow with the number of URNs.
+        """
+        self.resolve_urns(urns)
+        self.preload(self.identifiers_by_urn.values())
+        for urn in urns:
+            self.process_urn(urn, **process_urn_kwargs)
+
+    def preload(self, identifiers):
+        """Load the Works for these Identifiers' LicensePools, along with
+        the presentation Editions of the Works and LicensePools.
+
+        Once they're in the session, following `LicensePool.work`,
+        `LicensePool.presentation_edition` and
+        `Work.presentation_edition` doesn't touch the database. The
+        Works' cached OPDS entries come along with the Works.
+        """
+        pools = [x.licensed_through for x in identifiers
+                 if x and x.licensed_through]
+        work_ids = set(pool.work_id for pool in pools if pool.work_id)
+        works = []
+        if work_ids:
+            works = self._db.query(Work).filter(Work.id.in_(work_ids)).all()
+
+        # A Work's other LicensePools come along with it, and we may
+        # need their Editions to decide which LicensePool is active.
+        for work in works:
+            pools.extend(work.license_pools)
+        edition_ids = set(
+            [pool.presentation_edition_id for pool in pools] +
+            [work.presentation_edition_id for work in works]
+        )
+        edition_ids.discard(None)
+        editions = []
+        if edition_ids:
+            editions = self._db.query(Edition).filter(
+                Edition.id.in_(edition_ids)
+            ).all()
+        self.preloaded.extend(works + editions)
+
     def process_urn(self, urn, **kwargs):
         """Turn a URN into a Work suitable for use in an OPDS feed.
         """
-        try:
-            identifier, is_new = Identifier.parse_urn(self._db, urn)
-        except ValueError, e:
-            identifier = None
+        if urn in self.identifiers_by_urn:
+            identifier = self.identifiers_by_urn[urn]
+        else:
+            try:
+                identifier, is_new = Identifier.parse_urn(self._db, urn)
+            except ValueError, e:
+                identifier = None
 
         if not identifier:
             # Not a well-formed URN.
@@ -26,6 +26,7 @@ from model import (
     LicensePool,
     Edition,
     Identifier,
+    RateLimit,
     Representation,
     Subject,
 )
@@ -57,6 +58,9 @@ class Axis360API(object):
     def __init__(self, _db, username=None, library_id=None, password=None,
                  base_url=None):
         self._db = _db
+        self.rate_limiter = RateLimit.limiter_for(
+            _db, Configuration.AXIS_INTEGRATION
+        )
         (env_library_id, env_username, 
          env_password, env_base_url) = self.environment_values()
             
@@ -132,10 +136,12 @@ class Axis360API(object):
             disallowed_response_codes = ["401"]
         else:
             disallowed_response_codes = None
-        response = self._make_request(
-            url=url, method=method, headers=headers,
-            data=data, params=params, 
-            disallowed_response_codes=disallowed_response_codes
+        response = self.rate_limiter.request(
+            lambda: self._make_request(
+                url=url, method=method, headers=headers,
+                data=data, params=params,
+                disallowed_response_codes=disallowed_response_codes
+            )
         )
         if response.status_code == 401:
             # This must be our first 401, since our second 401 will
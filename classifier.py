@@ -12,11 +12,14 @@
 # SQL to find commonly used classifications not assigned to a genre 
 # select count(identifiers.id) as c, subjects.type, substr(subjects.identifier, 0, 20) as i, substr(subjects.name, 0, 20) as n from workidentifiers join classifications on workidentifiers.id=classifications.work_identifier_id join subjects on classifications.subject_id=subjects.id where subjects.genre_id is null and subjects.fiction is null group by subjects.type, i, n order by c desc;
 
+import hashlib
+import inspect
 import logging
 import json
 import os
 import pkgutil
 import re
+import sys
 import urllib
 from collections import (
     Counter,
@@ -27,12 +30,24 @@ from sqlalchemy.orm.session import Session
 from sqlalchemy.sql.expression import and_
 from psycopg2.extras import NumericRange
 
+from util import LRUCache
+
 base_dir = os.path.split(__file__)[0]
 resource_dir = os.path.join(base_dir, "resources")
 
 NO_VALUE = "NONE"
 NO_NUMBER = -1
 
+# Classifier.rules_hash() normally covers the source of this module.
+# If the source isn't available (say, a deploy with only .pyc files),
+# it falls back to this number, so bump it whenever the rules change.
+RULES_VERSION = 1
+
+# The most recent results of Classifier.classify(). A given classifier
+# always classifies a given (identifier, name) pair the same way, so
+# there's no need to run the rules twice.
+classification_cache = LRUCache(50000)
+
 class Classifier(object):
 
     """Turn an external classification into an internal genre, an
@@ -90,6 +105,10 @@ class Classifier(object):
     # TODO: This is currently set in model.py in the Subject class.
     classifiers = dict()
 
+    # Files in the resources directory that a classifier loads its
+    # rules from. Their contents are part of its rules_hash().
+    RESOURCE_FILES = []
+
     @classmethod
     def nr(cls, lower, upper):
         """Turn a 2-tuple into an inclusive NumericRange."""
@@ -109,14 +128,50 @@ class Classifier(object):
         """Look up a human-readable name for the given identifier."""
         return None
 
+    @classmethod
+    def rules_hash(cls):
+        """A hash of the rules this classifier uses to classify subjects.
+
+        Classifiers lean on each other and on module-level rules (the
+        keyword tables, the genre lists), so the hash covers the
+        source of this entire module and every resource file that a
+        classifier in it loads, along with the name of this
+        classifier. A Subject whose stored hash doesn't match needs
+        to be classified again.
+        """
+        if cls not in _rules_hashes:
+            sha = hashlib.sha1(_module_rules())
+            sha.update(cls.__name__)
+            for klass in cls.__mro__:
+                for filename in klass.__dict__.get('RESOURCE_FILES', []):
+                    with open(os.path.join(resource_dir, filename)) as f:
+                        sha.update(f.read())
+            _rules_hashes[cls] = unicode(sha.hexdigest())
+        return _rules_hashes[cls]
+
     @classmethod
     def classify(cls, subject):
         """Try to determine genre, audience, target age, and fiction status
         for the given Subject.
+
+        Results are cached in memory, since the same subject
+        identifier and name will always be classified the same way.
+        """
+        key = (cls, subject.identifier, subject.name)
+        result = classification_cache.get(key)
+        if result is None:
+            result = cls._classify(subject.identifier, subject.name)
+            classification_cache.set(key, result)
+        return result
+
+    @classmethod
+    def _classify(cls, identifier, name):
+        """Run the classification rules against a subject's identifier
+        and name.
         """
-        identifier = cls.scrub_identifier(subject.identifier)
-        if subject.name:
-            name = cls.scrub_name(subject.name)
+        identifier = cls.scrub_identifier(identifier)
+        if name:
+            name = cls.scrub_name(name)
         else:
             name = identifier
         fiction = cls.is_fiction(identifier, name)
@@ -280,6 +335,31 @@ class Classifier(object):
             old = young + 2
         return old
 
+# Classifier.rules_hash() results, keyed by classifier class.
+_rules_hashes = dict()
+
+def _module_rules():
+    """The source of this module plus the contents of every resource
+    file its classifiers load.
+    """
+    module = sys.modules[__name__]
+    try:
+        rules = inspect.getsource(module)
+    except (IOError, TypeError), e:
+        logging.warn(
+            "Can't read the source of %s (%s), so classifier rules hashes will only change along with RULES_VERSION.",
+            __name__, e
+        )
+        rules = "RULES_VERSION = %d" % RULES_VERSION
+    filenames = set()
+    for name, klass in inspect.getmembers(module, inspect.isclass):
+        if klass.__module__ == __name__:
+            filenames.update(klass.__dict__.get('RESOURCE_FILES', []))
+    for filename in sorted(filenames):
+        with open(os.path.join(resource_dir, filename)) as f:
+            rules += f.read()
+    return rules
+
 class GradeLevelClassifier(Classifier):
     # How old a kid is when they start grade N in the US.
     american_grade_to_age = {
@@ -1421,8 +1501,10 @@ class OverdriveClassifier(Classifier):
 
 class DeweyDecimalClassifier(Classifier):
 
+    RESOURCE_FILES = ["dewey_1000.json"]
+
     NAMES = json.load(
-        open(os.path.join(resource_dir, "dewey_1000.json")))
+        open(os.path.join(resource_dir, RESOURCE_FILES[0])))
 
     # Add some other values commonly found in MARC records.
     NAMES["B"] = "Biography"
@@ -1655,7 +1737,9 @@ class LCCClassifier(Classifier):
         BP=Religion_Spirituality,
     )
 
-    NAMES = json.load(open(os.path.join(resource_dir, "lcc_one_level.json")))
+    RESOURCE_FILES = ["lcc_one_level.json"]
+
+    NAMES = json.load(open(os.path.join(resource_dir, RESOURCE_FILES[0])))
 
     @classmethod
     def scrub_identifier(cls, identifier):
@@ -1721,10 +1805,16 @@ def match_kw(*l):
     to match any of those strings, so long as there's a word boundary on both ends.
     The function will match all the strings by default, or can exclude the strings
     that are examples of the classification.
+
+    Each regular expression is compiled the first time it's needed and
+    reused from then on, since KeywordBasedClassifier.genre runs every
+    one of these functions against every subject it sees.
     """
-    def match_term(term, exclude_examples=False):
-        if not l:
-            return None
+    # Compiled regular expressions, keyed by the value of
+    # `exclude_examples`. None means there are no keywords to match.
+    compiled = {}
+
+    def compile_keywords(exclude_examples):
         if exclude_examples:
             keywords = [keyword for keyword in l if not isinstance(keyword, Eg)]
         else:
@@ -1734,8 +1824,16 @@ def match_kw(*l):
             return None
         any_keyword = "|".join(keywords)
         with_boundaries = r'\b(%s)\b' % any_keyword
-        return re.compile(with_boundaries, re.I).search(term)
+        return re.compile(with_boundaries, re.I)
 
+    def match_term(term, exclude_examples=False):
+        exclude_examples = bool(exclude_examples)
+        if exclude_examples not in compiled:
+            compiled[exclude_examples] = compile_keywords(exclude_examples)
+        regex = compiled[exclude_examples]
+        if regex is None:
+            return None
+        return regex.search(term)
 
     # This is a dictionary so it can be used as a class variable
     return {"search": match_term}
@@ -3414,7 +3512,7 @@ class WorkClassifier(object):
             self.classifications.append(classification)
 
         # Make sure the Subject is ready to be used in calculations.
-        if not classification.subject.checked: # or self.debug
+        if classification.subject.needs_genre_assignment: # or self.debug
             classification.subject.assign_to_genre()
 
         if classification.comes_from_license_source:
@@ -7,6 +7,7 @@ import logging
 import copy
 from facets import FacetConstants as Facets
 from util import LanguageCodes
+from util.http import HTTP
 
 class CannotLoadConfiguration(Exception):
     pass
@@ -60,6 +61,16 @@ class Configuration(object):
 
     DATA_DIRECTORY = "data_directory"
 
+    # If this is set, Representation content is kept in a
+    # content-addressed store under this directory rather than in
+    # the database.
+    CONTENT_STORE_DIRECTORY = "content_store_directory"
+
+    # If this is set, OPDSImportMonitor keeps the feed pages it's
+    # working on, and its progress through them, under this directory,
+    # so an interrupted import can pick up where it left off.
+    OPDS_IMPORT_DIRECTORY = "opds_import_directory"
+
     # Policies, mostly circulation specific
     POLICIES = "policies"
 
@@ -106,8 +117,16 @@ class Configuration(object):
 
     ANALYTICS_POLICY = "analytics"
 
+    # Which noun phrase extractor SummaryEvaluator should use:
+    # "textblob" or "regex".
+    SUMMARY_NOUN_PHRASE_EXTRACTOR_POLICY = "summary_noun_phrase_extractor"
+
     LOCALIZATION_LANGUAGES = "localization_languages"
 
+    # How connections to third-party services are pooled and
+    # retried: a dictionary of keyword arguments to HTTP.configure().
+    HTTP_POLICY = "http"
+
     # Integrations
     URL = "url"
     NAME = "name"
@@ -136,6 +155,17 @@ class Configuration(object):
     OVERDRIVE_INTEGRATION = "Overdrive"
     THREEM_INTEGRATION = "3M"
     AXIS_INTEGRATION = "Axis 360"
+    THETA_INTEGRATION = "Theta"
+
+    # Any integration may have a rate limit: a dictionary with the
+    # number of requests allowed per second, an optional number of
+    # requests allowed in a burst, and whether the limit is shared
+    # through the database by every process that uses the
+    # integration, rather than applying to each process separately.
+    RATE_LIMIT = "rate_limit"
+    RATE_LIMIT_REQUESTS_PER_SECOND = "requests_per_second"
+    RATE_LIMIT_BURST = "burst"
+    RATE_LIMIT_SHARED = "shared"
 
     MINIMUM_FEATURED_QUALITY = "minimum_featured_quality"
     FEATURED_LANE_SIZE = "featured_lane_size"
@@ -145,6 +175,12 @@ class Configuration(object):
     S3_SECRET_KEY = "secret_key"
     S3_OPEN_ACCESS_CONTENT_BUCKET = "open_access_content_bucket"
     S3_BOOK_COVERS_BUCKET = "book_covers_bucket"
+    S3_MAX_UPLOADS_IN_FLIGHT = "max_uploads_in_flight"
+    S3_UPLOAD_MEMORY_BUDGET = "upload_memory_budget"
+    S3_MULTIPART_THRESHOLD = "multipart_threshold"
+    S3_MULTIPART_PART_SIZE = "multipart_part_size"
+    S3_MAX_RETRIES = "max_retries"
+    S3_BACKOFF_FACTOR = "backoff_factor"
 
     CDN_INTEGRATION = "CDN"
 
@@ -207,6 +243,11 @@ class Configuration(object):
         integration = cls.integration(cls.S3_INTEGRATION)
         return integration[bucket_name]
 
+    @classmethod
+    def rate_limit(cls, integration_name):
+        """Find the rate limit for an integration, if it has one."""
+        return cls.integration(integration_name).get(cls.RATE_LIMIT, {})
+
     @classmethod
     def policy(cls, name, default=None, required=False):
         """Find a policy configuration by name."""
@@ -231,6 +272,14 @@ class Configuration(object):
     def data_directory(cls):
         return cls.get(cls.DATA_DIRECTORY)
 
+    @classmethod
+    def content_store_directory(cls):
+        return cls.get(cls.CONTENT_STORE_DIRECTORY)
+
+    @classmethod
+    def opds_import_directory(cls):
+        return cls.get(cls.OPDS_IMPORT_DIRECTORY)
+
     @classmethod
     def terms_of_service_url(cls):
         return cls.link(cls.TERMS_OF_SERVICE)
@@ -294,6 +343,22 @@ class Configuration(object):
         default_logging = {}
         return cls.get(cls.LOGGING, default_logging)
 
+    @classmethod
+    def http_policy(cls):
+        return cls.policy(cls.HTTP_POLICY, default={})
+
+    @classmethod
+    def summary_noun_phrase_extractor(cls):
+        """The name of the noun phrase extractor SummaryEvaluator
+        should use, or None to use its default.
+
+        Summaries get evaluated by code that never loads a
+        configuration file, so that's not an error here.
+        """
+        if not cls.instance:
+            return None
+        return cls.policy(cls.SUMMARY_NOUN_PHRASE_EXTRACTOR_POLICY)
+
     @classmethod
     def minimum_featured_quality(cls):
         return float(cls.policy(cls.MINIMUM_FEATURED_QUALITY, 0.65))
@@ -328,6 +393,7 @@ class Configuration(object):
                     config_path, e)
             )
         cls.instance = configuration
+        HTTP.configure(**cls.http_policy())
         return configuration
 
     @classmethod
@@ -1,14 +1,20 @@
 from nose.tools import set_trace
 import datetime
 import logging
+import os
+import socket
+import sys
+from multiprocessing.pool import ThreadPool
 
 from sqlalchemy.orm.session import Session
 from sqlalchemy.sql.functions import func
 
 from model import (
+    estimated_row_count,
     get_one,
     get_one_or_create,
     BaseCoverageRecord,
+    CoverageClaim,
     CoverageRecord,
     DataSource,
     Edition,
@@ -21,6 +27,7 @@ from model import (
 from metadata_layer import (
     ReplacementPolicy
 )
+from util.rate_limit import TokenBucket
 
 import log # This sets the appropriate log format.
 
@@ -85,6 +92,24 @@ class BaseCoverageProvider(object):
     coverage records are WorkCoverageRecord objects.
     """
 
+    # A provider that spends most of its time waiting on a remote
+    # API can fetch data for all the items in a batch at once. To opt
+    # in, set FETCH_THREADS to the number of threads to use, and
+    # implement fetch_item() and process_fetched_item() instead of
+    # process_item().
+    FETCH_THREADS = 1
+
+    # If this is set, fetch_item() will not be called more than this
+    # many times a second, no matter how many threads there are.
+    FETCH_RATE_LIMIT = None
+
+    # If CLAIM_ITEMS is set, each batch is claimed (and committed)
+    # before it's processed, so that any number of workers can run
+    # this provider at once without covering the same item twice. A
+    # worker's claims expire after CLAIM_DURATION, in case it crashes.
+    CLAIM_ITEMS = False
+    CLAIM_DURATION = datetime.timedelta(hours=1)
+
     def __init__(self, _db, service_name, operation, batch_size=100, 
                  cutoff_time=None):
         """Constructor.
@@ -103,6 +128,13 @@ class BaseCoverageProvider(object):
         self.operation = operation
         self.batch_size = batch_size
         self.cutoff_time = cutoff_time
+        self.fetch_threads = self.FETCH_THREADS
+        if self.FETCH_RATE_LIMIT:
+            self.fetch_rate_limiter = TokenBucket(self.FETCH_RATE_LIMIT)
+        else:
+            self.fetch_rate_limiter = None
+        self.claim_items = self.CLAIM_ITEMS
+        self.worker_name = u"%s:%d" % (socket.gethostname(), os.getpid())
 
     @property
     def log(self):
@@ -117,24 +149,30 @@ class BaseCoverageProvider(object):
 
         # First cover items that have never had a coverage attempt
         # before.
-        offset = 0
-        while offset is not None:
-            offset = self.run_once(
-                offset, count_as_covered=BaseCoverageRecord.ALL_STATUSES
-            )
+        self.run_through_backlog(BaseCoverageRecord.ALL_STATUSES)
 
         # Next, cover items that failed with a transient failure
         # on a previous attempt.
-        offset = 0
-        while offset is not None:
-            offset = self.run_once(
-                offset, 
-                count_as_covered=BaseCoverageRecord.DEFAULT_COUNT_AS_COVERED
-            )
+        self.run_through_backlog(BaseCoverageRecord.DEFAULT_COUNT_AS_COVERED)
         
         Timestamp.stamp(self._db, self.service_name)
         self._db.commit()
 
+    def run_through_backlog(self, count_as_covered):
+        """Cover every item that needs coverage, one batch at a time."""
+        qu = self.items_that_need_coverage(count_as_covered=count_as_covered)
+        estimate = estimated_row_count(qu)
+        if estimate is not None:
+            self.log.info(
+                "About %d items need coverage (counting %s as covered)",
+                estimate, ', '.join(count_as_covered)
+            )
+        last_id = 0
+        while last_id is not None:
+            last_id = self.run_once(
+                last_id, count_as_covered=count_as_covered
+            )
+
     def run_on_specific_identifiers(self, identifiers):
         """Split a specific set of Identifiers into batches and process one
         batch at a time.
@@ -177,43 +215,72 @@ class BaseCoverageProvider(object):
             index += self.batch_size
         return (successes, transient_failures, persistent_failures), records
 
-    def run_once(self, offset, count_as_covered=None):
-        count_as_covered = count_as_covered or BaseCoverageRecord.DEFAULT_COUNT_AS_COVERED
-        # Make it clear which class of items we're covering on this
-        # run.
-        count_as_covered_message = '(counting %s as covered)' % (', '.join(count_as_covered))
+    def run_once(self, last_id, count_as_covered=None):
+        """Cover one batch of items.
 
-        qu = self.items_that_need_coverage(count_as_covered=count_as_covered)
-        self.log.info("%d items need coverage%s", qu.count(), 
-                      count_as_covered_message)
-        batch = qu.limit(self.batch_size).offset(offset)
+        Items are covered in order of ID, so no item comes up twice
+        in one pass through the backlog, whether or not it gets
+        covered.
+
+        :param last_id: Only items with IDs higher than this will be
+        covered.
 
-        if not batch.count():
-            # The batch is empty. We're done.
+        :return: The ID of the last item in the batch, or None if
+        there was nothing left to cover.
+        """
+        count_as_covered = count_as_covered or BaseCoverageRecord.DEFAULT_COUNT_AS_COVERED
+        id_column = self.item_id_column()
+        qu = self.items_that_need_coverage(count_as_covered=count_as_covered)
+        qu = qu.filter(id_column > last_id)
+        if self.claim_items:
+            # Don't even consider items another worker is covering.
+            qu = qu.filter(
+                CoverageClaim.unclaimed(self.service_name, id_column)
+            )
+        batch = qu.order_by(id_column).limit(self.batch_size).all()
+        if not batch:
+            # We're done.
             return None
-        (successes, transient_failures, persistent_failures), results = (
+        last_id = batch[-1].id
+
+        if not self.claim_items:
+            self.process_batch_and_handle_results(batch)
+            return last_id
+
+        batch = self.claim(batch)
+        if batch:
             self.process_batch_and_handle_results(batch)
+        self.release(batch)
+        return last_id
+
+    def claim(self, batch):
+        """Claim a batch of items for this worker.
+
+        :return: The items that were claimed. Items claimed by another
+        worker in the meantime are left out.
+        """
+        claimed = CoverageClaim.claim(
+            self._db, self.service_name, [item.id for item in batch],
+            self.worker_name, self.CLAIM_DURATION
         )
+        # Commit right away, so other workers can see the claims.
+        self._db.commit()
+        if len(claimed) < len(batch):
+            self.log.info(
+                "%d of %d items were already claimed by another worker.",
+                len(batch) - len(claimed), len(batch)
+            )
+        return [item for item in batch if item.id in claimed]
 
-        if BaseCoverageRecord.SUCCESS not in count_as_covered:
-            # If any successes happened in this batch, increase the
-            # offset to ignore them, or they will just show up again
-            # the next time we run this batch.
-            offset += successes
-
-        if BaseCoverageRecord.TRANSIENT_FAILURE not in count_as_covered:
-            # If any transient failures happened in this batch,
-            # increase the offset to ignore them, or they will
-            # just show up again the next time we run this batch.
-            offset += transient_failures
-
-        if BaseCoverageRecord.PERSISTENT_FAILURE not in count_as_covered:
-            # If any persistent failures happened in this batch,
-            # increase the offset to ignore them, or they will
-            # just show up again the next time we run this batch.
-            offset += persistent_failures
-        
-        return offset
+    def release(self, batch):
+        """Give up this worker's claims on a batch of items, and
+        commit the batch's coverage records along with that.
+        """
+        CoverageClaim.release(
+            self._db, self.service_name, [item.id for item in batch],
+            self.worker_name
+        )
+        self._db.commit()
 
     def process_batch_and_handle_results(self, batch):
         """:return: A 2-tuple (counts, records). 
@@ -221,9 +288,8 @@ class BaseCoverageProvider(object):
         `counts` is a 3-tuple (successes, transient failures,
         persistent_failures).
 
-        `records` is a mixed list of CoverageRecord objects (for
-        successes and persistent failures) and CoverageFailure objects
-        (for transient failures).
+        `records` is a list of coverage records, one for each
+        success, failure, and ignored item in the batch.
         """
 
         # Batch is a query that may not be ordered, so it may return
@@ -232,32 +298,35 @@ class BaseCoverageProvider(object):
         batch = list(batch)
 
         offset_increment = 0
-        results = self.process_batch(batch)
+        # Work coverage records created while processing the batch
+        # are written all at once.
+        with WorkCoverageRecord.batch(self._db):
+            results = self.process_batch(batch)
         successes = 0
         transient_failures = 0
         persistent_failures = 0
         num_ignored = 0
-        records = []
 
+        # Every success and failure in the batch is written with a
+        # single bulk upsert at the end, rather than one query per
+        # item.
+        handled = []
         unhandled_items = set(batch)
         for item in results:
             if isinstance(item, CoverageFailure):
                 if item.obj in unhandled_items:
                     unhandled_items.remove(item.obj)
-                record = self.record_failure_as_coverage_record(item)
                 if item.transient:
                     self.log.warn(
                         "Transient failure covering %r: %s", 
                         item.obj, item.exception
                     )
-                    record.status = BaseCoverageRecord.TRANSIENT_FAILURE
                     transient_failures += 1
                 else:
                     self.log.error(
                         "Persistent failure covering %r: %s", 
                         item.obj, item.exception
                     )
-                    record.status = BaseCoverageRecord.PERSISTENT_FAILURE
                     persistent_failures += 1
             else:
                 # Count this as a success and add a CoverageRecord for
@@ -266,9 +335,7 @@ class BaseCoverageProvider(object):
                 if item in unhandled_items:
                     unhandled_items.remove(item)
                 successes += 1
-                record, ignore = self.add_coverage_record_for(item)
-                record.status = BaseCoverageRecord.SUCCESS
-            records.append(record)
+            handled.append(item)
 
         # Perhaps some records were ignored--they neither succeeded nor
         # failed. Treat them as transient failures.
@@ -276,12 +343,11 @@ class BaseCoverageProvider(object):
             self.log.warn(
                 "%r was ignored by a coverage provider that was supposed to cover it.", item
             )
-            failure = self.failure_for_ignored_item(item)
-            record = self.record_failure_as_coverage_record(failure)
-            record.status = BaseCoverageRecord.TRANSIENT_FAILURE
-            records.append(record)
+            handled.append(self.failure_for_ignored_item(item))
             num_ignored += 1
 
+        records = self.add_coverage_records_for(handled)
+
         self.log.info(
             "Batch processed with %d successes, %d transient failures, %d persistent failures, %d ignored.",
             successes, transient_failures, persistent_failures, num_ignored
@@ -303,12 +369,56 @@ class BaseCoverageProvider(object):
         :return: A mixed list of CoverageRecords and CoverageFailures.
         """
         results = []
-        for item in batch:
-            result = self.process_item(item)
+        for item, result in self.process_items(batch):
             if result:
                 results.append(result)
         return results
 
+    def process_items(self, items):
+        """Call process_item() on each of the given items.
+
+        If `fetch_threads` is more than 1, fetch_item() is called on
+        all the items at once in a pool of threads, and then
+        process_fetched_item() is called on each item in turn, in
+        this thread. Only this thread touches the database.
+
+        :return: A generator of (item, result) 2-tuples, in the same
+        order as `items`.
+        """
+        items = list(items)
+        if self.fetch_threads <= 1 or len(items) <= 1:
+            for item in items:
+                yield item, self.process_item(item)
+            return
+
+        pool = ThreadPool(min(self.fetch_threads, len(items)))
+        try:
+            fetched = pool.imap(self._fetch_in_thread, items)
+            for item, (data, exc_info) in zip(items, fetched):
+                if exc_info:
+                    # Raise the exception here, as though the item
+                    # had been fetched in this thread.
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                yield item, self.process_fetched_item(item, data)
+        finally:
+            pool.close()
+            pool.join()
+
+    def fetch(self, item):
+        """Call fetch_item(), respecting the rate limit."""
+        if self.fetch_rate_limiter:
+            self.fetch_rate_limiter.take()
+        return self.fetch_item(item)
+
+    def _fetch_in_thread(self, item):
+        """Call fetch(), capturing any exception so it can be raised in
+        the main thread.
+        """
+        try:
+            return self.fetch(item), None
+        except Exception, e:
+            return None, sys.exc_info()
+
     def should_update(self, coverage_record):
         """Should we do the work to update the given CoverageRecord?"""
         if coverage_record is None:
@@ -350,6 +460,14 @@ class BaseCoverageProvider(object):
         """
         raise NotImplementedError()
 
+    def item_id_column(self):
+        """The column containing the ID of each item returned by
+        items_that_need_coverage().
+
+        Implemented in CoverageProvider and WorkCoverageProvider.
+        """
+        raise NotImplementedError()
+
     def add_coverage_record_for(self, item):
         """Add a coverage record for the given item.
 
@@ -364,6 +482,35 @@ class BaseCoverageProvider(object):
         """
         raise NotImplementedError()
 
+    def add_coverage_records_for(self, results):
+        """Record the outcome of a batch of items.
+
+        The default implementation adds one coverage record at a
+        time. CoverageProvider and WorkCoverageProvider write the
+        whole batch at once.
+
+        :param results: A list containing successfully covered items
+        and CoverageFailures.
+
+        :return: A list of coverage records, one for each result.
+        """
+        records = []
+        for result in results:
+            if isinstance(result, CoverageFailure):
+                record = self.record_failure_as_coverage_record(result)
+                record.status = self.failure_status(result)
+            else:
+                record, ignore = self.add_coverage_record_for(result)
+                record.status = BaseCoverageRecord.SUCCESS
+            records.append(record)
+        return records
+
+    def failure_status(self, failure):
+        """The coverage status to record for a CoverageFailure."""
+        if failure.transient:
+            return BaseCoverageRecord.TRANSIENT_FAILURE
+        return BaseCoverageRecord.PERSISTENT_FAILURE
+
     def failure_for_ignored_item(self, work):
         """Create a CoverageFailure recording the coverage provider's
         failure to even try to process an item.
@@ -377,7 +524,25 @@ class BaseCoverageProvider(object):
 
         Since this is where the actual work happens, this is not
         implemented in CoverageProvider or WorkCoverageProvider, and
-        must be handled in a subclass.
+        must be handled in a subclass -- either here, or by
+        implementing fetch_item() and process_fetched_item().
+        """
+        return self.process_fetched_item(item, self.fetch(item))
+
+    def fetch_item(self, item):
+        """Get whatever data is needed from a remote source to cover
+        one specific item.
+
+        This may be called from a worker thread, so it must not use
+        the database.
+        """
+        raise NotImplementedError()
+
+    def process_fetched_item(self, item, data):
+        """Use the data returned by fetch_item() to give coverage to
+        an item.
+
+        :return: Same as process_item().
         """
         raise NotImplementedError()
 
@@ -651,6 +816,9 @@ class CoverageProvider(BaseCoverageProvider):
             qu = qu.filter(Identifier.id.in_([x.id for x in identifiers]))
         return qu
 
+    def item_id_column(self):
+        return Identifier.id
+
     def add_coverage_record_for(self, item):
         """Record this CoverageProvider's coverage for the given
         Edition/Identifier, as a CoverageRecord.
@@ -663,6 +831,28 @@ class CoverageProvider(BaseCoverageProvider):
         """Turn a CoverageFailure into a CoverageRecord object."""
         return failure.to_coverage_record(operation=self.operation)
 
+    def add_coverage_records_for(self, results):
+        """Record the outcome of a batch of Editions/Identifiers with
+        a single bulk upsert.
+        """
+        values = []
+        for result in results:
+            if isinstance(result, CoverageFailure):
+                if not result.data_source:
+                    raise Exception(
+                        "Cannot convert coverage failure to CoverageRecord because it has no output source."
+                    )
+                values.append((
+                    result.obj, result.data_source, self.operation,
+                    self.failure_status(result), result.exception
+                ))
+            else:
+                values.append((
+                    result, self.output_source, self.operation,
+                    CoverageRecord.SUCCESS, None
+                ))
+        return CoverageRecord.bulk_add(self._db, values)
+
     def failure_for_ignored_item(self, item):
         """Create a CoverageFailure recording the CoverageProvider's
         failure to even try to process an item.
@@ -700,6 +890,9 @@ class WorkCoverageProvider(BaseCoverageProvider):
             )
         return qu
 
+    def item_id_column(self):
+        return Work.id
+
     def failure_for_ignored_item(self, work):
         """Create a CoverageFailure recording the WorkCoverageProvider's
         failure to even try to process a Work.
@@ -720,6 +913,23 @@ class WorkCoverageProvider(BaseCoverageProvider):
         """Turn a CoverageFailure into a WorkCoverageRecord object."""
         return failure.to_work_coverage_record(operation=self.operation)
 
+    def add_coverage_records_for(self, results):
+        """Record the outcome of a batch of Works with a single bulk
+        upsert.
+        """
+        values = []
+        for result in results:
+            if isinstance(result, CoverageFailure):
+                values.append((
+                    result.obj, self.operation,
+                    self.failure_status(result), result.exception
+                ))
+            else:
+                values.append((
+                    result, self.operation, WorkCoverageRecord.SUCCESS, None
+                ))
+        return WorkCoverageRecord.bulk_add(self._db, values)
+
 
 class BibliographicCoverageProvider(CoverageProvider):
     """Fill in bibliographic metadata for records.
@@ -761,8 +971,7 @@ class BibliographicCoverageProvider(CoverageProvider):
     def process_batch(self, identifiers):
         """Returns a list of successful identifiers and CoverageFailures"""
         results = []
-        for identifier in identifiers:
-            result = self.process_item(identifier)
+        for identifier, result in self.process_items(identifiers):
             if not isinstance(result, CoverageFailure):
                 self.handle_success(identifier)
             results.append(result)
@@ -25,7 +25,6 @@ as
     works.quality,
     works.rating,
     works.popularity,
-    works.random,
     works.last_update_time,
     works.simple_opds_entry,
     works.verbose_opds_entry,
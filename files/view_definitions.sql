@@ -23,7 +23,6 @@ as
     works.quality,
     works.rating,
     works.popularity,
-    works.random,
     works.last_update_time,
     works.simple_opds_entry,
     licensepools.id AS license_pool_id
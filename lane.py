@@ -187,13 +187,18 @@ class Facets(FacetConstants):
                 # We can get this data from the materialized view.
                 return work_model.availability_time
 
+        if order_facet == cls.ORDER_RANDOM:
+            if work_model is Work:
+                return Work.random_order()
+            else:
+                return Work.random_order(work_model.works_id)
+
         # In all other cases the field names are the same whether
         # we are using Work/Edition or a materialized view.
         order_facet_to_database_field = {
             cls.ORDER_TITLE : edition_model.sort_title,
             cls.ORDER_AUTHOR : edition_model.sort_author,
             cls.ORDER_LAST_UPDATE : work_model.last_update_time,
-            cls.ORDER_RANDOM : work_model.random,
         }
         return order_facet_to_database_field[order_facet]
 
@@ -223,7 +228,13 @@ class Facets(FacetConstants):
         if database_field in (Work.id, mw.works_id, mwg.works_id):
             return cls.ORDER_WORK_ID
 
-        if database_field in (Work.random, mw.random, mwg.random):
+        # A random order is an expression rather than a column, and
+        # a new one is built every time, so compare the SQL.
+        random_orders = [
+            unicode(Work.random_order(column))
+            for column in (Work.id, mw.works_id, mwg.works_id)
+        ]
+        if unicode(database_field) in random_orders:
             return cls.ORDER_RANDOM
 
         return None
@@ -286,13 +297,13 @@ class Facets(FacetConstants):
         primary_order_by = self.order_facet_to_database_field(
             self.order, work_model, edition_model
         )
-        if primary_order_by:
+        if primary_order_by is not None:
             # Promote the field designated by the sort facet to the top of
             # the order-by list.
             order_by = [primary_order_by]
 
             for i in default_sort_order:
-                if i not in order_by:
+                if i is not primary_order_by:
                     order_by.append(i)
         else:
             # Use the default sort order
@@ -7,7 +7,11 @@ model. Doing a third-party integration should be as simple as putting
 the information into this format.
 """
 
-from collections import defaultdict
+from collections import (
+    defaultdict,
+    OrderedDict,
+)
+from multiprocessing.pool import ThreadPool
 from sqlalchemy.orm.session import Session
 from nose.tools import set_trace
 from dateutil.parser import parse
@@ -19,6 +23,8 @@ from sqlalchemy.orm import aliased
 import csv
 import datetime
 import logging
+import sys
+import time
 from util import LanguageCodes
 from util.median import median
 from model import (
@@ -59,7 +65,8 @@ class ReplacementPolicy(object):
             mirror=None,
             http_get=None,
             even_if_not_apparently_updated=False,
-            presentation_calculation_policy=None
+            presentation_calculation_policy=None,
+            mirror_queue=None,
     ):
         self.identifiers = identifiers
         self.subjects = subjects
@@ -71,6 +78,9 @@ class ReplacementPolicy(object):
         self.even_if_not_apparently_updated = even_if_not_apparently_updated
         self.mirror = mirror
         self.http_get = http_get
+        # If this is a LinkMirrorQueue, links will be queued up
+        # instead of being mirrored immediately.
+        self.mirror_queue = mirror_queue
         self.presentation_calculation_policy = (
             presentation_calculation_policy or
             PresentationCalculationPolicy()
@@ -444,73 +454,263 @@ class FormatData(object):
 
 
 
-class MetaToModelUtility(object):
-    """
-    Contains functionality common to both CirculationData and Metadata.
+class LinkMirrorQueue(object):
+    """Mirror the links found in a number of Metadata and CirculationData
+    objects as a group.
+
+    Links are queued up by mirror_link() as the objects are
+    applied. When mirror_all() is called, all the links are fetched
+    at once with a pool of threads, any covers are scaled down into
+    thumbnails together, and the results are uploaded to the mirror
+    in batches. All database work happens on the calling thread.
     """
 
-    def mirror_link(self, model_object, data_source, link, link_obj, policy):
-        """Retrieve a copy of the given link and make sure it gets
-        mirrored. If it's a full-size image, create a thumbnail and
-        mirror that too.
+    log = logging.getLogger("Link mirror queue")
 
-        The model_object can be either a pool or an edition.
+    # By default, fetch up to this many links at once.
+    DEFAULT_THREADS = 10
+
+    # Upload this many representations to the mirror at once.
+    DEFAULT_BATCH_SIZE = 50
+
+    def __init__(self, threads=None, batch_size=None,
+                 thumbnail_processes=None):
+        """Constructor.
+
+        :param threads: Fetch up to this many links at once.
+        :param batch_size: Upload this many representations to the
+        mirror at once.
+        :param thumbnail_processes: Passed into Representation.bulk_scale.
         """
+        self.threads = threads or self.DEFAULT_THREADS
+        self.batch_size = batch_size or self.DEFAULT_BATCH_SIZE
+        self.thumbnail_processes = thumbnail_processes
+        self.jobs = []
+
+    def add(self, utility, model_object, data_source, link, link_obj,
+            policy):
+        self.jobs.append(
+            LinkMirrorJob(
+                utility, model_object, data_source, link, link_obj, policy
+            )
+        )
 
-        if link_obj.rel not in Hyperlink.MIRRORED:
-            # we only host locally open-source epubs and cover images
-            if link.href:
-                # The log message only makes sense if the resource is
-                # hosted elsewhere.
-                self.log.info("Not mirroring %s: rel=%s", link.href, link_obj.rel)
+    def __len__(self):
+        return len(self.jobs)
+
+    def mirror_all(self):
+        """Fetch and mirror every queued link.
+
+        :return: A list of (Identifier, exc_info) 2-tuples, one for
+        each link that couldn't be mirrored because of an unexpected
+        exception.
+        """
+        jobs, self.jobs = self.jobs, []
+        failures = []
+
+        def each(jobs, method, *args):
+            """Call a method on every job, keeping track of the ones
+            that raise exceptions.
+            """
+            survivors = []
+            for job in jobs:
+                try:
+                    if getattr(job, method)(*args):
+                        survivors.append(job)
+                except Exception, e:
+                    self.log.error(
+                        "Error mirroring %s", job.link.href, exc_info=e
+                    )
+                    failures.append((job.identifier, sys.exc_info()))
+            return survivors
+
+        jobs = each(jobs, 'prepare')
+        self.fetch(jobs)
+        jobs = each(jobs, 'process_response')
+        self.make_thumbnails(jobs)
+
+        # Upload everything, keeping each thumbnail next to its
+        # original image.
+        by_mirror = defaultdict(list)
+        for job in jobs:
+            upload = by_mirror[job.policy.mirror]
+            for representation in job.to_mirror:
+                if representation not in upload:
+                    upload.append(representation)
+        for mirror, representations in by_mirror.items():
+            for i in range(0, len(representations), self.batch_size):
+                mirror.mirror_batch(representations[i:i+self.batch_size])
+
+        each(jobs, 'finish')
+        return failures
+
+    def fetch(self, jobs):
+        """Fetch every link that needs to be fetched, using a pool of
+        threads.
+        """
+        # Only fetch each URL once, even if it shows up in more than
+        # one link.
+        by_url = OrderedDict()
+        for job in jobs:
+            if job.request_headers is not None:
+                by_url.setdefault(job.link.href, []).append(job)
+        if not by_url:
             return
 
-        mirror = policy.mirror
-        http_get = policy.http_get
+        def fetch_one(jobs):
+            job = jobs[0]
+            http_get = job.policy.http_get or Representation.simple_http_get
+            try:
+                response = http_get(job.link.href, job.request_headers)
+                exc_info = None
+            except Exception, e:
+                response = None
+                exc_info = sys.exc_info()
+            for job in jobs:
+                job.response = response
+                job.response_exc_info = exc_info
+
+        start = time.time()
+        groups = by_url.values()
+        if self.threads == 1 or len(groups) == 1:
+            map(fetch_one, groups)
+        else:
+            pool = ThreadPool(min(self.threads, len(groups)))
+            try:
+                pool.map(fetch_one, groups)
+            finally:
+                pool.close()
+                pool.join()
+        self.log.info(
+            "Fetched %d links in %.2fs", len(groups), time.time()-start
+        )
 
-        _db = Session.object_session(link_obj)
-        original_url = link.href
+    def make_thumbnails(self, jobs):
+        """Scale down all the cover images at once."""
+        jobs = [job for job in jobs if job.thumbnail_url]
+        if not jobs:
+            return
+
+        # The same image may be used by more than one link, and it
+        # only needs to be decoded once.
+        sizes = OrderedDict()
+        for job in jobs:
+            sizes.setdefault(job.representation, []).append(
+                (Edition.MAX_THUMBNAIL_HEIGHT, Edition.MAX_THUMBNAIL_WIDTH,
+                 job.thumbnail_url)
+            )
+        _db = Session.object_session(jobs[0].representation)
+        results = Representation.bulk_scale(
+            _db, sizes.items(), Representation.PNG_MEDIA_TYPE, force=True,
+            processes=self.thumbnail_processes
+        )
+        for job in jobs:
+            thumbnail, is_new = results[job.representation].pop(0)
+            if is_new:
+                # A thumbnail was created distinct from the original
+                # image. Mirror it as well.
+                job.to_mirror.append(thumbnail)
+
+
+class LinkMirrorJob(object):
+    """The work of mirroring a single link."""
+
+    def __init__(self, utility, model_object, data_source, link, link_obj,
+                 policy):
+        self.utility = utility
+        self.log = utility.log
+        self.model_object = model_object
+        self.data_source = data_source
+        self.link = link
+        self.link_obj = link_obj
+        self.policy = policy
+
+        self.pool = None
+        self.identifier = link_obj.identifier
+        self.title = None
+        self.max_age = None
+        self.request_headers = None
+        self.response = None
+        self.response_exc_info = None
+        self.representation = None
+        self.thumbnail_url = None
+        self.to_mirror = []
+
+    def prepare(self):
+        """Figure out where the link will be mirrored and whether it
+        needs to be fetched.
+
+        :return: True if the job should continue.
+        """
+        link = self.link
+        link_obj = self.link_obj
+        model_object = self.model_object
+        self.log.info("About to mirror %s" % link.href)
 
-        self.log.info("About to mirror %s" % original_url)
-        pool = None
         edition = None
-        title = None
         identifier = None
         if model_object:
             if isinstance(model_object, LicensePool):
-                pool = model_object
+                self.pool = model_object
                 identifier = model_object.identifier
 
                 if (identifier and identifier.primarily_identifies and identifier.primarily_identifies[0]): 
                     edition = identifier.primarily_identifies[0]
             elif isinstance(model_object, Edition):
-                pool = model_object.license_pool
+                self.pool = model_object.license_pool
                 identifier = model_object.primary_identifier
                 edition = model_object
         if edition and edition.title:
-            title = edition.title
+            self.title = edition.title
         else:
-            title = self.title or None
+            self.title = self.utility.title or None
 
         if ((not identifier) or (link_obj.identifier and identifier != link_obj.identifier)):
             # insanity found
             self.log.warn("Tried to mirror a link with an invalid identifier %r" % identifier)
-            return
+            return False
+        self.identifier = identifier
 
-        max_age = None
-        if policy.link_content:
+        if self.policy.link_content:
             # We want to fetch the representation again, even if we
             # already have a recent usable copy. If we fetch it and it
             # hasn't changed, we'll keep using the one we have.
-            max_age = 0
+            self.max_age = 0
+
+        _db = Session.object_session(link_obj)
+        self.request_headers = Representation.request_headers_for(
+            _db, link.href, max_age=self.max_age
+        )
+        return True
+
+    def prefetched_get(self, url, headers):
+        """Act like an HTTP client, but return the response
+        that was fetched earlier.
+        """
+        if self.response_exc_info:
+            raise self.response_exc_info[0], self.response_exc_info[1], self.response_exc_info[2]
+        return self.response
+
+    def process_response(self):
+        """Store the fetched representation and decide whether and
+        where to mirror it.
 
-        # This will fetch a representation of the original and 
-        # store it in the database.
+        :return: True if the representation should be mirrored.
+        """
+        link = self.link
+        link_obj = self.link_obj
+        pool = self.pool
+        mirror = self.policy.mirror
+        _db = Session.object_session(link_obj)
+
+        # This will store the representation we fetched (or find the
+        # one we already had) in the database.
         representation, is_new = Representation.get(
-            _db, link.href, do_get=http_get,
+            _db, link.href, do_get=self.prefetched_get,
             presumed_media_type=link.media_type,
-            max_age=max_age,
+            max_age=self.max_age,
         )
+        self.representation = representation
 
         # Make sure the (potentially newly-fetched) representation is
         # associated with the resource.
@@ -526,7 +726,7 @@ class MetaToModelUtility(object):
                 pool.suppressed = True
                 pool.license_exception = "Fetch exception: %s" % representation.fetch_exception
                 self.log.error(pool.license_exception)
-            return
+            return False
 
         # If we fetched the representation and it hasn't changed,
         # the previously mirrored version is fine. Don't mirror it
@@ -535,14 +735,14 @@ class MetaToModelUtility(object):
             self.log.info(
                 "Representation has not changed, assuming mirror at %s is up to date.", representation.mirror_url
             )
-            return
+            return False
 
         if representation.status_code / 100 not in (2,3):
             self.log.info(
                 "Representation %s gave %s status code, not mirroring.",
                 representation.url, representation.status_code
             )
-            return
+            return False
 
         # The metadata may have some idea about the media type for this
         # LinkObject, but the media type we actually just saw takes 
@@ -553,25 +753,40 @@ class MetaToModelUtility(object):
         if not representation.mirrorable_media_type:
             self.log.info("Not mirroring %s: unsupported media type %s",
                           representation.url, representation.media_type)
-            return
+            return False
 
         # Determine the best URL to use when mirroring this
         # representation.
-        if title and link.rel == Hyperlink.OPEN_ACCESS_DOWNLOAD:
+        if self.title and link.rel == Hyperlink.OPEN_ACCESS_DOWNLOAD:
             extension = representation.extension()
             mirror_url = mirror.book_url(
-                identifier, data_source=data_source, title=title,
-                extension=extension
+                self.identifier, data_source=self.data_source,
+                title=self.title, extension=extension
             )
         else:
             filename = representation.default_filename(link_obj)
             mirror_url = mirror.cover_image_url(
-                data_source, identifier, filename
+                self.data_source, self.identifier, filename
             )
-
-        # Mirror it.
         representation.mirror_url = mirror_url
-        mirror.mirror_one(representation)
+        self.to_mirror.append(representation)
+
+        if link_obj.rel == Hyperlink.IMAGE:
+            # We'll need to create and mirror a thumbnail.
+            thumbnail_filename = representation.default_filename(
+                link_obj, Representation.PNG_MEDIA_TYPE
+            )
+            self.thumbnail_url = mirror.cover_image_url(
+                self.data_source, self.identifier, thumbnail_filename,
+                Edition.MAX_THUMBNAIL_HEIGHT
+            )
+        return True
+
+    def finish(self):
+        """Clean up after the representation has been mirrored."""
+        link = self.link
+        pool = self.pool
+        representation = self.representation
 
         # If we couldn't mirror an open access link representation, suppress
         # the license pool until someone fixes it manually.
@@ -581,34 +796,50 @@ class MetaToModelUtility(object):
                 pool.license_exception = "Mirror exception: %s" % representation.mirror_exception
                 self.log.error(pool.license_exception)
 
-        if link_obj.rel == Hyperlink.IMAGE:
-            # Create and mirror a thumbnail.
-            thumbnail_filename = representation.default_filename(
-                link_obj, Representation.PNG_MEDIA_TYPE
-            )
-            thumbnail_url = mirror.cover_image_url(
-                data_source, identifier, thumbnail_filename,
-                Edition.MAX_THUMBNAIL_HEIGHT
-            )
-            thumbnail, is_new = representation.scale(
-                max_height=Edition.MAX_THUMBNAIL_HEIGHT,
-                max_width=Edition.MAX_THUMBNAIL_WIDTH,
-                destination_url=thumbnail_url,
-                destination_media_type=Representation.PNG_MEDIA_TYPE,
-                force=True
-            )
-            if is_new:
-                # A thumbnail was created distinct from the original
-                # image. Mirror it as well.
-                mirror.mirror_one(thumbnail)
-
-        if link_obj.rel == Hyperlink.OPEN_ACCESS_DOWNLOAD:
+        if self.link_obj.rel == Hyperlink.OPEN_ACCESS_DOWNLOAD:
             # If we mirrored book content successfully, don't keep it in
             # the database to save space. We do keep images in case we
             # ever need to resize them.
             if representation.mirrored_at and not representation.mirror_exception:
                 representation.content = None
+        return True
+
+
+class MetaToModelUtility(object):
+    """
+    Contains functionality common to both CirculationData and Metadata.
+    """
+
+    def mirror_link(self, model_object, data_source, link, link_obj, policy):
+        """Retrieve a copy of the given link and make sure it gets
+        mirrored. If it's a full-size image, create a thumbnail and
+        mirror that too.
+
+        The model_object can be either a pool or an edition.
+
+        If the ReplacementPolicy has a `mirror_queue`, the link is
+        added to the queue, to be mirrored later along with other
+        links. Otherwise it's mirrored immediately.
+        """
+
+        if link_obj.rel not in Hyperlink.MIRRORED:
+            # we only host locally open-source epubs and cover images
+            if link.href:
+                # The log message only makes sense if the resource is
+                # hosted elsewhere.
+                self.log.info("Not mirroring %s: rel=%s", link.href, link_obj.rel)
+            return
+
+        if policy.mirror_queue is not None:
+            policy.mirror_queue.add(
+                self, model_object, data_source, link, link_obj, policy
+            )
+            return
 
+        queue = LinkMirrorQueue(threads=1, thumbnail_processes=1)
+        queue.add(self, model_object, data_source, link, link_obj, policy)
+        for identifier, exc_info in queue.mirror_all():
+            raise exc_info[0], exc_info[1], exc_info[2]
 
 
 class CirculationData(MetaToModelUtility):
@@ -0,0 +1,2 @@
+alter table subjects add column rules_hash varchar;
+CREATE INDEX ix_subjects_rules_hash ON subjects USING btree (rules_hash);
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+"""Record the current classifier rules hash for every Subject that has
+already been checked.
+
+Those Subjects were classified with the rules that ship alongside this
+migration, so there's no need to classify them all again the first
+time the rules hash is checked.
+"""
+import os
+import sys
+from pdb import set_trace
+bin_dir = os.path.split(__file__)[0]
+package_dir = os.path.join(bin_dir, "..", "..")
+sys.path.append(os.path.abspath(package_dir))
+
+from core.classifier import Classifier
+from core.model import (
+    production_session,
+    Subject,
+)
+
+_db = production_session()
+for type, classifier in sorted(Classifier.classifiers.items()):
+    count = _db.query(Subject).filter(Subject.type==type).filter(
+        Subject.checked==True).filter(Subject.rules_hash==None).update(
+            dict(rules_hash=classifier.rules_hash()),
+            synchronize_session=False
+        )
+    _db.commit()
+    print "Recorded rules hash for %d %s subjects." % (count, type)
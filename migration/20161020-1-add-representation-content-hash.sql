@@ -0,0 +1,2 @@
+alter table representations add column content_hash varchar;
+CREATE INDEX ix_representations_content_hash ON representations USING btree (content_hash);
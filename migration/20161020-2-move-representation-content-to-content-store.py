@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""Move Representation content out of the database and into the
+content store, if one is configured.
+"""
+import os
+import sys
+import logging
+from pdb import set_trace
+bin_dir = os.path.split(__file__)[0]
+package_dir = os.path.join(bin_dir, "..", "..")
+sys.path.append(os.path.abspath(package_dir))
+
+from nose.tools import set_trace
+from core.model import (
+    production_session,
+    Representation,
+)
+
+store = Representation.content_store()
+if not store:
+    print "No content store is configured; leaving content in the database."
+    sys.exit(0)
+
+_db = production_session()
+base = _db.query(Representation).filter(
+    Representation._content != None).order_by(Representation.id)
+print "Moving content for %d representations." % base.count()
+
+# Page by ID rather than by offset, since rows drop out of the query
+# as their content is moved.
+last_id = 0
+while True:
+    batch = base.filter(Representation.id > last_id).limit(100).all()
+    if not batch:
+        break
+    for representation in batch:
+        representation.content_hash = store.put(representation._content)
+        representation._content = None
+        last_id = representation.id
+    _db.commit()
+    print "Moved content through representation %d." % last_id
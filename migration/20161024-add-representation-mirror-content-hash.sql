@@ -0,0 +1,2 @@
+alter table representations add column mirror_content_hash varchar;
+CREATE INDEX ix_representations_mirror_content_hash ON representations USING btree (mirror_content_hash);
@@ -0,0 +1,9 @@
+-- Coverage records with no operation can't be kept unique by the
+-- existing unique constraints, since NULLs never conflict. Get rid of
+-- any duplicates (keeping the newest) and add partial unique indexes
+-- so that bulk upserts have something to conflict on.
+delete from coveragerecords a using coveragerecords b where a.operation is null and b.operation is null and a.identifier_id = b.identifier_id and a.data_source_id = b.data_source_id and a.id < b.id;
+CREATE UNIQUE INDEX ix_coveragerecords_identifier_id_data_source_id_null_operation ON coveragerecords USING btree (identifier_id, data_source_id) WHERE operation IS NULL;
+
+delete from workcoveragerecords a using workcoveragerecords b where a.operation is null and b.operation is null and a.work_id = b.work_id and a.id < b.id;
+CREATE UNIQUE INDEX ix_workcoveragerecords_work_id_null_operation ON workcoveragerecords USING btree (work_id) WHERE operation IS NULL;
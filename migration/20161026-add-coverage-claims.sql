@@ -0,0 +1,9 @@
+CREATE TABLE coverageclaims (
+    id serial NOT NULL PRIMARY KEY,
+    service_name varchar NOT NULL,
+    item_id integer NOT NULL,
+    worker varchar,
+    expires timestamp without time zone,
+    CONSTRAINT coverageclaims_service_name_item_id_key UNIQUE (service_name, item_id)
+);
+CREATE INDEX ix_coverageclaims_expires ON coverageclaims USING btree (expires);
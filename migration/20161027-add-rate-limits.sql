@@ -0,0 +1,5 @@
+CREATE TABLE ratelimits (
+    name varchar NOT NULL PRIMARY KEY,
+    tokens double precision,
+    updated timestamp without time zone
+);
@@ -0,0 +1,8 @@
+CREATE TABLE summaryanalyses (
+    id serial NOT NULL PRIMARY KEY,
+    content_hash varchar NOT NULL,
+    extractor varchar NOT NULL,
+    noun_phrases varchar[],
+    sentences integer,
+    CONSTRAINT summaryanalyses_content_hash_extractor_key UNIQUE (content_hash, extractor)
+);
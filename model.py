@@ -1,12 +1,13 @@
 # encoding: utf-8
 from cStringIO import StringIO
+from contextlib import contextmanager
 from collections import (
     Counter,
     defaultdict,
+    namedtuple,
 )
 from lxml import etree
 from nose.tools import set_trace
-import cairosvg
 import bisect
 import datetime
 import isbnlib
@@ -26,10 +27,6 @@ import uuid
 import warnings
 import bcrypt
 
-from PIL import (
-    Image,
-)
-
 from psycopg2.extras import NumericRange
 from sqlalchemy.engine.url import URL
 from sqlalchemy import exc as sa_exc
@@ -71,11 +68,13 @@ from sqlalchemy.sql.expression import (
     cast,
     and_,
     or_,
+    exists,
     select,
     join,
     literal_column,
     case,
     table,
+    text,
 )
 from sqlalchemy.exc import (
     IntegrityError
@@ -120,10 +119,20 @@ from util.http import (
     RemoteIntegrationException,
 )
 from util.permanent_work_id import WorkIDCalculator
+from util.rate_limit import (
+    RateLimiter,
+    TokenBucket,
+)
 from util.summary import SummaryEvaluator
+from util.content_store import ContentStore
+from util.thumbnail import (
+    ThumbnailPipeline,
+    open_image,
+)
 
 from sqlalchemy.orm.session import Session
 
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.dialects.postgresql import (
     ARRAY,
     HSTORE,
@@ -967,6 +976,87 @@ class BaseCoverageRecord(object):
 
         return missing
 
+    @classmethod
+    def _bulk_upsert(cls, _db, key_columns, rows):
+        """Create or update a number of coverage records with one
+        INSERT ... ON CONFLICT DO UPDATE statement per kind of
+        operation.
+
+        :param key_columns: The names of the columns that, together
+        with `operation`, identify a coverage record.
+
+        :param rows: A list of dictionaries, each containing a value
+        for every one of `key_columns` as well as 'operation',
+        'status', 'exception' and 'timestamp'.
+
+        :return: A list of coverage records, one for each row, in the
+        same order as `rows`.
+        """
+        if not rows:
+            return []
+
+        # Anything waiting to be written has to be in the database
+        # before we upsert, or the two writes could collide.
+        _db.flush()
+
+        # A single statement can't touch the same row twice, so if
+        # a record shows up more than once the last row wins.
+        key_columns = list(key_columns) + ['operation']
+        by_key = dict()
+        keys = []
+        for row in rows:
+            key = tuple(row[c] for c in key_columns)
+            keys.append(key)
+            by_key[key] = row
+
+        columns = key_columns + ['status', 'exception', 'timestamp']
+        # Rows with no operation can't rely on the unique constraint,
+        # since NULLs never conflict -- they conflict on a partial
+        # unique index instead.
+        with_operation = "(%s)" % ", ".join(key_columns)
+        without_operation = "(%s) WHERE operation IS NULL" % ", ".join(
+            key_columns[:-1]
+        )
+        ids_by_key = dict()
+        for conflict_target, subset in (
+            (with_operation,
+             [row for key, row in by_key.items() if key[-1] is not None]),
+            (without_operation,
+             [row for key, row in by_key.items() if key[-1] is None]),
+        ):
+            if not subset:
+                continue
+            params = dict()
+            values = []
+            for i, row in enumerate(subset):
+                placeholders = []
+                for column in columns:
+                    name = "%s_%d" % (column, i)
+                    params[name] = row[column]
+                    placeholders.append(":" + name)
+                values.append("(%s)" % ", ".join(placeholders))
+            sql = ("INSERT INTO %(table)s (%(columns)s) VALUES %(values)s "
+                   "ON CONFLICT %(conflict_target)s DO UPDATE SET "
+                   "status=excluded.status, exception=excluded.exception, "
+                   "timestamp=excluded.timestamp "
+                   "RETURNING id, %(key_columns)s") % dict(
+                       table=cls.__tablename__,
+                       columns=", ".join(columns),
+                       values=", ".join(values),
+                       conflict_target=conflict_target,
+                       key_columns=", ".join(key_columns),
+                   )
+            for result in _db.execute(sql, params):
+                ids_by_key[tuple(result[1:])] = result[0]
+
+        # Load the records, overwriting anything stale that was
+        # already in the session.
+        records = _db.query(cls).filter(
+            cls.id.in_(ids_by_key.values())
+        ).populate_existing()
+        records_by_id = dict((record.id, record) for record in records)
+        return [records_by_id[ids_by_key[key]] for key in keys]
+
 
 class CoverageRecord(Base, BaseCoverageRecord):
     """A record of a Identifier being used as input into some process."""
@@ -1059,8 +1149,46 @@ class CoverageRecord(Base, BaseCoverageRecord):
         coverage_record.timestamp = timestamp
         return coverage_record, is_new
 
+    @classmethod
+    def bulk_add(cls, _db, records, timestamp=None):
+        """Create or update a number of coverage records at once.
+
+        :param records: A list of 5-tuples (edition_or_identifier,
+        data_source, operation, status, exception).
+
+        :return: A list of CoverageRecords, one for each tuple, in the
+        same order.
+        """
+        timestamp = timestamp or datetime.datetime.utcnow()
+        rows = []
+        for edition, data_source, operation, status, exception in records:
+            if isinstance(edition, Identifier):
+                identifier = edition
+            elif isinstance(edition, Edition):
+                identifier = edition.primary_identifier
+            else:
+                raise ValueError(
+                    "Cannot create a coverage record for %r." % edition)
+            rows.append(dict(
+                identifier_id=identifier.id,
+                data_source_id=data_source and data_source.id,
+                operation=operation, status=status, exception=exception,
+                timestamp=timestamp,
+            ))
+        return cls._bulk_upsert(
+            _db, ['identifier_id', 'data_source_id'], rows
+        )
+
 Index("ix_coveragerecords_data_source_id_operation_identifier_id", CoverageRecord.data_source_id, CoverageRecord.operation, CoverageRecord.identifier_id)
 
+# The unique constraint doesn't stop two records with no operation
+# from covering the same identifier, since NULLs never conflict.
+Index(
+    "ix_coveragerecords_identifier_id_data_source_id_null_operation",
+    CoverageRecord.identifier_id, CoverageRecord.data_source_id,
+    unique=True, postgresql_where=CoverageRecord.operation==None
+)
+
 class WorkCoverageRecord(Base, BaseCoverageRecord):
     """A record of some operation that was performed on a Work.
 
@@ -1128,7 +1256,175 @@ class WorkCoverageRecord(Base, BaseCoverageRecord):
         coverage_record.status = status
         coverage_record.timestamp = timestamp
         return coverage_record, is_new
+
+    # The key in Session.info under which records deferred by
+    # add_or_defer() are kept until the enclosing batch() ends.
+    DEFERRED_KEY = 'deferred_work_coverage_records'
+
+    @classmethod
+    @contextmanager
+    def batch(cls, _db):
+        """Collect the coverage records that add_or_defer() would
+        create for any number of Works, and write them all with one
+        bulk_add() when the block ends.
+
+        Batches may be nested; the records are written when the
+        outermost batch ends. If the block raises an exception,
+        nothing is written.
+        """
+        if cls.DEFERRED_KEY in _db.info:
+            yield
+            return
+        _db.info[cls.DEFERRED_KEY] = []
+        try:
+            yield
+        finally:
+            deferred = _db.info.pop(cls.DEFERRED_KEY)
+        # New Works don't have an ID until they're flushed, and a
+        # Work merged into another one during the batch is gone.
+        _db.flush()
+        cls.bulk_add(_db, [x for x in deferred if x[0] in _db])
+
+    @classmethod
+    def add_or_defer(cls, work, operation, status=CoverageRecord.SUCCESS):
+        """Note that `operation` was performed on `work`.
+
+        Inside a batch() the record is written along with all the
+        others when the batch ends; otherwise it's written immediately
+        with add_for().
+        """
+        _db = Session.object_session(work)
+        deferred = _db.info.get(cls.DEFERRED_KEY)
+        if deferred is None:
+            cls.add_for(work, operation, status=status)
+        else:
+            deferred.append((work, operation, status, None))
+
+    @classmethod
+    def bulk_add(cls, _db, records, timestamp=None):
+        """Create or update a number of coverage records at once.
+
+        :param records: A list of 4-tuples (work, operation, status,
+        exception).
+
+        :return: A list of WorkCoverageRecords, one for each tuple, in
+        the same order.
+        """
+        timestamp = timestamp or datetime.datetime.utcnow()
+        rows = [
+            dict(work_id=work.id, operation=operation, status=status,
+                 exception=exception, timestamp=timestamp)
+            for work, operation, status, exception in records
+        ]
+        return cls._bulk_upsert(_db, ['work_id'], rows)
+
 Index("ix_workcoveragerecords_operation_work_id", WorkCoverageRecord.operation, WorkCoverageRecord.work_id)
+Index(
+    "ix_workcoveragerecords_work_id_null_operation",
+    WorkCoverageRecord.work_id,
+    unique=True, postgresql_where=WorkCoverageRecord.operation==None
+)
+
+
+class CoverageClaim(Base):
+    """A worker's temporary claim on an item it's about to give
+    coverage to.
+
+    This lets any number of processes run the same coverage provider
+    at once without covering the same item twice. A claim expires
+    after a while, so items claimed by a worker that crashed will
+    eventually be picked up by some other worker.
+    """
+    __tablename__ = 'coverageclaims'
+
+    id = Column(Integer, primary_key=True)
+
+    # The service_name of the coverage provider.
+    service_name = Column(Unicode, nullable=False)
+
+    # The ID of the Identifier or Work being covered.
+    item_id = Column(Integer, nullable=False)
+
+    # The worker that made the claim, e.g. 'hostname:pid'.
+    worker = Column(Unicode)
+
+    expires = Column(DateTime, index=True)
+
+    __table_args__ = (
+        UniqueConstraint('service_name', 'item_id'),
+    )
+
+    def __repr__(self):
+        return '<CoverageClaim: service_name="%s" item_id=%s worker="%s" expires="%s">' % (
+            self.service_name, self.item_id, self.worker,
+            self.expires.strftime("%Y-%m-%d %H:%M:%S")
+        )
+
+    @classmethod
+    def unclaimed(cls, service_name, id_column, now=None):
+        """A clause that filters out items with a current claim.
+
+        :param id_column: The column containing the item IDs.
+        :return: A clause that can be passed in to Query.filter().
+        """
+        now = now or datetime.datetime.utcnow()
+        return ~exists().where(
+            and_(cls.service_name==service_name, cls.item_id==id_column,
+                 cls.expires >= now)
+        )
+
+    @classmethod
+    def claim(cls, _db, service_name, item_ids, worker, duration, now=None):
+        """Claim as many of the given items as possible.
+
+        An item can be claimed if nobody has claimed it, or if its
+        last claim has expired. Claims are made with a single
+        INSERT ... ON CONFLICT DO UPDATE, so if two workers go after
+        the same item at once, only one of them gets it.
+
+        :param duration: A timedelta; the claims expire after this
+        much time has passed.
+
+        :return: A set containing the IDs of the claimed items.
+        """
+        item_ids = set(item_ids)
+        if not item_ids:
+            return set()
+        now = now or datetime.datetime.utcnow()
+        params = dict(
+            service_name=service_name, worker=worker, now=now,
+            expires=now + duration
+        )
+        values = []
+        for i, item_id in enumerate(item_ids):
+            name = "item_id_%d" % i
+            params[name] = item_id
+            values.append("(:service_name, :%s, :worker, :expires)" % name)
+        sql = ("INSERT INTO coverageclaims (service_name, item_id, worker, expires) "
+               "VALUES %s ON CONFLICT (service_name, item_id) DO UPDATE "
+               "SET worker=excluded.worker, expires=excluded.expires "
+               "WHERE coverageclaims.expires < :now "
+               "RETURNING item_id") % ", ".join(values)
+        return set(row[0] for row in _db.execute(sql, params))
+
+    @classmethod
+    def release(cls, _db, service_name, item_ids, worker, now=None):
+        """Give up a worker's claims on the given items.
+
+        Expired claims left behind by other workers are cleaned up at
+        the same time.
+        """
+        now = now or datetime.datetime.utcnow()
+        releasable = cls.expires < now
+        item_ids = list(item_ids)
+        if item_ids:
+            releasable = or_(
+                releasable,
+                and_(cls.worker==worker, cls.item_id.in_(item_ids))
+            )
+        _db.query(cls).filter(cls.service_name==service_name).filter(
+            releasable
+        ).delete(synchronize_session=False)
 
 class Equivalency(Base):
     """An assertion that two Identifiers identify the same work.
@@ -1316,15 +1612,9 @@ class Identifier(Base):
         if not foreign_identifier_type or not foreign_id:
             return None
 
-        # Turn a deprecated identifier type (e.g. "3M ID" into the
-        # current type (e.g. "Bibliotheca ID").
-        foreign_identifier_type = cls.DEPRECATED_NAMES.get(
-            foreign_identifier_type, foreign_identifier_type
+        foreign_identifier_type, foreign_id = cls._normalize(
+            foreign_identifier_type, foreign_id
         )
-        
-        if foreign_identifier_type in (
-                Identifier.OVERDRIVE_ID, Identifier.THREEM_ID):
-            foreign_id = foreign_id.lower()
         if autocreate:
             m = get_one_or_create
         else:
@@ -1337,6 +1627,83 @@ class Identifier(Base):
         else:
             return result, False
 
+    @classmethod
+    def _normalize(cls, foreign_identifier_type, foreign_id):
+        # Turn a deprecated identifier type (e.g. "3M ID" into the
+        # current type (e.g. "Bibliotheca ID").
+        foreign_identifier_type = cls.DEPRECATED_NAMES.get(
+            foreign_identifier_type, foreign_identifier_type
+        )
+        
+        if foreign_identifier_type in (
+                Identifier.OVERDRIVE_ID, Identifier.THREEM_ID):
+            foreign_id = foreign_id.lower()
+        return foreign_identifier_type, foreign_id
+
+    @classmethod
+    def for_foreign_ids(cls, _db, keys, autocreate=True):
+        """Turn a number of foreign IDs into Identifiers.
+
+        Existing Identifiers are found with one query per identifier
+        type. Missing ones are created with a single INSERT ... ON
+        CONFLICT DO NOTHING, so an Identifier created by someone else
+        in the meantime is picked up rather than causing an error.
+
+        :param keys: A list of (type, identifier) 2-tuples.
+
+        :return: A dictionary mapping each of `keys` to its
+        Identifier. If `autocreate` is False, keys with no Identifier
+        are left out.
+        """
+        normalized = dict()
+        by_type = defaultdict(set)
+        for key in keys:
+            foreign_identifier_type, foreign_id = key
+            if not foreign_identifier_type or not foreign_id:
+                continue
+            normalized[key] = cls._normalize(*key)
+            type, identifier = normalized[key]
+            by_type[type].add(identifier)
+
+        def lookup(by_type):
+            found = dict()
+            for type, identifiers in by_type.items():
+                qu = _db.query(cls).filter(cls.type==type).filter(
+                    cls.identifier.in_(identifiers)
+                )
+                for obj in qu:
+                    found[(obj.type, obj.identifier)] = obj
+            return found
+
+        # Identifiers waiting to be written have to be in the database
+        # before we look for them, or we might create them twice.
+        _db.flush()
+        found = lookup(by_type)
+
+        missing = set(normalized.values()) - set(found.keys())
+        if missing and autocreate:
+            params = dict()
+            values = []
+            for i, (type, identifier) in enumerate(sorted(missing)):
+                params["type_%d" % i] = type
+                params["identifier_%d" % i] = identifier
+                values.append("(:type_%d, :identifier_%d)" % (i, i))
+            _db.execute(
+                "INSERT INTO identifiers (type, identifier) VALUES %s "
+                "ON CONFLICT (type, identifier) DO NOTHING" % ", ".join(values),
+                params
+            )
+            missing_by_type = defaultdict(set)
+            for type, identifier in missing:
+                missing_by_type[type].add(identifier)
+            found.update(lookup(missing_by_type))
+
+        return dict(
+            (key, found[normalized_key])
+            for key, normalized_key in normalized.items()
+            if normalized_key in found
+        )
+
     @property
     def urn(self):
         identifier_text = urllib.quote(self.identifier)
@@ -1400,6 +1767,37 @@ class Identifier(Base):
 
         return cls.for_foreign_id(_db, type, identifier_string)
 
+    @classmethod
+    def parse_urns(cls, _db, identifier_strings, autocreate=True):
+        """Turn a number of URNs into Identifiers all at once.
+
+        :return: A 2-tuple (identifiers_by_urn, unparseable).
+        `identifiers_by_urn` maps each URN to its Identifier; if
+        `autocreate` is False, URNs with no Identifier are left out.
+        `unparseable` is a list of the URNs that couldn't be turned
+        into identifiers.
+        """
+        keys = dict()
+        unparseable = []
+        for urn in identifier_strings:
+            try:
+                type, identifier = cls.type_and_identifier_for_urn(urn)
+            except ValueError, e:
+                type = identifier = None
+            if not type or not identifier:
+                unparseable.append(urn)
+                continue
+            keys[urn] = (type, identifier)
+
+        identifiers = cls.for_foreign_ids(
+            _db, keys.values(), autocreate=autocreate
+        )
+        identifiers_by_urn = dict(
+            (urn, identifiers[key]) for urn, key in keys.items()
+            if key in identifiers
+        )
+        return identifiers_by_urn, unparseable
+
     def equivalent_to(self, data_source, identifier, strength):
         """Make one Identifier equivalent to another.
 
@@ -1670,7 +2068,9 @@ class Identifier(Base):
         :return: The single highest-rated summary Resource.
 
         """
-        evaluator = SummaryEvaluator()
+        evaluator = SummaryEvaluator(
+            noun_phrase_extractor=Configuration.summary_noun_phrase_extractor()
+        )
 
         if privileged_data_sources and len(privileged_data_sources) > 0:
             privileged_data_source = privileged_data_sources[0]
@@ -1684,10 +2084,17 @@ class Identifier(Base):
             _db, identifier_ids, rels, privileged_data_source).all()
 
         champion = None
-        # Add each resource's content to the evaluator's corpus.
-        for r in descriptions:
-            if r.representation and r.representation.content:
-                evaluator.add(r.representation.content)
+        # Add each resource's content to the evaluator's corpus,
+        # reusing any analyses that were stored the last time these
+        # summaries were evaluated.
+        contents = [
+            r.representation.content for r in descriptions
+            if r.representation and r.representation.content
+        ]
+        SummaryAnalysis.load(_db, evaluator, contents)
+        for content in contents:
+            evaluator.add(content)
+        SummaryAnalysis.save(_db, evaluator)
         evaluator.ready()
 
         # Then have the evaluator rank each resource.
@@ -3033,8 +3440,9 @@ class Work(Base):
     # The overall current popularity of this work.
     popularity = Column(Float, index=True)
 
-    # A random number associated with this work, used for sampling/
-    random = Column(Numeric(4,3), index=True)
+    # The Timestamp whose counter is the current random order 'epoch'.
+    # Bumping the counter reshuffles every random order at once.
+    RANDOM_ORDER_SERVICE = "Work Randomness Updater"
 
     appeal_type = Enum(CHARACTER_APPEAL, LANGUAGE_APPEAL, SETTING_APPEAL,
                        STORY_APPEAL, NOT_APPLICABLE_APPEAL, NO_APPEAL,
@@ -3387,7 +3795,7 @@ class Work(Base):
             self.summary_text = resource.representation.unicode_content
         else:
             self.summary_text = ""
-        WorkCoverageRecord.add_for(
+        WorkCoverageRecord.add_or_defer(
             self, operation=WorkCoverageRecord.SUMMARY_OPERATION
         )
 
@@ -3565,7 +3973,7 @@ class Work(Base):
             self.set_presentation_edition(new_presentation_edition)
 
         # tell everyone else we tried to set work's presentation edition
-        WorkCoverageRecord.add_for(
+        WorkCoverageRecord.add_or_defer(
             self, operation=WorkCoverageRecord.CHOOSE_EDITION_OPERATION
         )
 
@@ -3627,7 +4035,7 @@ class Work(Base):
 
         if policy.classify:
             classification_changed = self.assign_genres(identifier_ids)
-            WorkCoverageRecord.add_for(
+            WorkCoverageRecord.add_or_defer(
                 self, operation=WorkCoverageRecord.CLASSIFY_OPERATION
             )
 
@@ -3785,7 +4193,7 @@ class Work(Base):
                                                force_create=True)
         if verbose is not None:
             self.verbose_opds_entry = etree.tostring(verbose)
-        WorkCoverageRecord.add_for(
+        WorkCoverageRecord.add_or_defer(
             self, operation=WorkCoverageRecord.GENERATE_OPDS_OPERATION
         )
 
@@ -3821,7 +4229,7 @@ class Work(Base):
             if client.exists(**args):
                 client.delete(**args)
         if add_coverage_record and present_in_index:
-            WorkCoverageRecord.add_for(
+            WorkCoverageRecord.add_or_defer(
                 self, operation=(WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION + "-" + client.works_index)
             )
         return present_in_index
@@ -3831,7 +4239,6 @@ class Work(Base):
         self.presentation_ready = True
         self.presentation_ready_exception = None
         self.presentation_ready_attempt = as_of
-        self.random = random.random()
         self.update_external_index(search_index_client)
 
     def set_presentation_ready_based_on_content(self, search_index_client=None):
@@ -3858,18 +4265,90 @@ class Work(Base):
         else:
             self.set_presentation_ready(search_index_client=search_index_client)
 
+    @classmethod
+    def random_order(cls, work_id_column=None):
+        """An expression for ordering works randomly.
+
+        The order comes from hashing each work's ID along with the
+        current epoch, so it stays the same (and can be paged through)
+        until WorkRandomnessUpdateMonitor moves on to the next epoch.
+
+        :param work_id_column: The column holding the work ID, e.g.
+        MaterializedWork.works_id. Defaults to Work.id.
+        """
+        if work_id_column is None:
+            work_id_column = cls.id
+        epoch = select([Timestamp.counter]).where(
+            Timestamp.service==cls.RANDOM_ORDER_SERVICE
+        ).as_scalar()
+        return func.hashtext(
+            cast(work_id_column, String) + ':'
+            + cast(func.coalesce(epoch, 0), String)
+        )
+
+    @classmethod
+    def calculate_quality_for_works(cls, _db, works, default_quality=0):
+        """Calculate the quality of many works at once.
+
+        This gives the same results as calling calculate_quality() on
+        each work, but finds identifiers, equivalents and measurements
+        for all the works with one query each.
+        """
+        works = list(works)
+        if not works:
+            return
+
+        # Find the primary identifier for each work's license pools.
+        primary_identifier_ids = defaultdict(set)
+        qu = _db.query(LicensePool.work_id, LicensePool.identifier_id).filter(
+            LicensePool.work_id.in_([work.id for work in works])
+        )
+        for work_id, identifier_id in qu:
+            if identifier_id:
+                primary_identifier_ids[work_id].add(identifier_id)
+
+        # Find everything equivalent to those identifiers.
+        all_primary_identifier_ids = set()
+        for ids in primary_identifier_ids.values():
+            all_primary_identifier_ids.update(ids)
+        equivalents = Identifier.recursively_equivalent_identifier_ids(
+            _db, list(all_primary_identifier_ids)
+        )
+        all_identifier_ids = set()
+        for ids in equivalents.values():
+            all_identifier_ids.update(ids)
+
+        # Find the relevant measurements of all those identifiers.
+        measurements = Measurement.most_recent_for_identifiers(
+            _db, list(all_identifier_ids), Measurement.QUALITY_QUANTITIES
+        )
+
+        for work in works:
+            identifier_ids = set()
+            for primary_id in primary_identifier_ids[work.id]:
+                identifier_ids.update(equivalents.get(primary_id, []))
+            work_measurements = []
+            for identifier_id in identifier_ids:
+                work_measurements.extend(measurements.get(identifier_id, []))
+            work.quality = Measurement.overall_quality(
+                work_measurements, default_value=default_quality
+            )
+        WorkCoverageRecord.bulk_add(
+            _db, [(work, WorkCoverageRecord.QUALITY_OPERATION,
+                   WorkCoverageRecord.SUCCESS, None) for work in works]
+        )
+
     def calculate_quality(self, identifier_ids, default_quality=0):
         _db = Session.object_session(self)
-        quantities = [Measurement.POPULARITY, Measurement.RATING,
-                      Measurement.DOWNLOADS, Measurement.QUALITY]
         measurements = _db.query(Measurement).filter(
             Measurement.identifier_id.in_(identifier_ids)).filter(
                 Measurement.is_most_recent==True).filter(
-                    Measurement.quantity_measured.in_(quantities)).all()
+                    Measurement.quantity_measured.in_(
+                        Measurement.QUALITY_QUANTITIES)).all()
 
         self.quality = Measurement.overall_quality(
             measurements, default_value=default_quality)
-        WorkCoverageRecord.add_for(
+        WorkCoverageRecord.add_or_defer(
             self, operation=WorkCoverageRecord.QUALITY_OPERATION
         )
 
@@ -4269,10 +4748,6 @@ class Work(Base):
         return genre.name if genre else None
 
 
-# Used for quality filter queries.
-Index("ix_works_audience_target_age_quality_random", Work.audience, Work.target_age, Work.quality, Work.random)
-Index("ix_works_audience_fiction_quality_random", Work.audience, Work.fiction, Work.quality, Work.random)
-
 class Measurement(Base):
     """A  measurement of some numeric quantity associated with a
     Identifier.
@@ -4291,6 +4766,9 @@ class Measurement(Base):
 
     GUTENBERG_FAVORITE = u"http://librarysimplified.org/terms/rel/lists/gutenberg-favorite"
 
+    # The quantities that go into a Work's overall quality.
+    QUALITY_QUANTITIES = [POPULARITY, RATING, DOWNLOADS, QUALITY]
+
     # If a book's popularity measurement is found between index n and
     # index n+1 on this list, it is in the nth percentile for
     # popularity and its 'popularity' value should be n * 0.01.
@@ -4443,27 +4921,87 @@ class Measurement(Base):
             pass
         elif not self.value:
             return None
-        elif (self.quantity_measured == self.POPULARITY
-              and self.data_source.name in self.POPULARITY_PERCENTILES):
-            d = self.POPULARITY_PERCENTILES[self.data_source.name]
-            position = bisect.bisect_left(d, self.value)
-            self._normalized_value = position * 0.01            
-        elif (self.quantity_measured == self.DOWNLOADS
-              and self.data_source.name in self.DOWNLOAD_PERCENTILES):
-            d = self.DOWNLOAD_PERCENTILES[self.data_source.name]
-            position = bisect.bisect_left(d, self.value)
-            self._normalized_value = position * 0.01            
-        elif (self.quantity_measured == self.RATING
-              and self.data_source.name in self.RATING_SCALES):
-            scale_min, scale_max = self.RATING_SCALES[self.data_source.name]
+        else:
+            self._normalized_value = self.normalize(
+                self.quantity_measured, self.data_source.name, self.value
+            )
+        return self._normalized_value
+
+    @classmethod
+    def normalize(cls, quantity_measured, data_source_name, value):
+        """Normalize a measurement of the given quantity, taken by the
+        given data source, to a 0...1 scale.
+
+        :return: The normalized value, or None if there's no way to
+        normalize it.
+        """
+        if not value:
+            return None
+        if (quantity_measured == cls.POPULARITY
+            and data_source_name in cls.POPULARITY_PERCENTILES):
+            d = cls.POPULARITY_PERCENTILES[data_source_name]
+            position = bisect.bisect_left(d, value)
+            return position * 0.01
+        elif (quantity_measured == cls.DOWNLOADS
+              and data_source_name in cls.DOWNLOAD_PERCENTILES):
+            d = cls.DOWNLOAD_PERCENTILES[data_source_name]
+            position = bisect.bisect_left(d, value)
+            return position * 0.01
+        elif (quantity_measured == cls.RATING
+              and data_source_name in cls.RATING_SCALES):
+            scale_min, scale_max = cls.RATING_SCALES[data_source_name]
             width = float(scale_max-scale_min)
-            value = self.value-scale_min
-            self._normalized_value = value / width
-        elif self.data_source.name == DataSource.METADATA_WRANGLER:
+            value = value-scale_min
+            return value / width
+        elif data_source_name == DataSource.METADATA_WRANGLER:
             # Data from the metadata wrangler comes in pre-normalized.
-            self._normalized_value = self.value
-            
-        return self._normalized_value
+            return value
+        return None
+
+    @classmethod
+    def most_recent_for_identifiers(cls, _db, identifier_ids, quantities):
+        """Find the most recent measurements of the given quantities for
+        many Identifiers at once, without loading Measurement objects.
+
+        :return: A dictionary mapping each Identifier ID to a list of
+        NormalizedMeasurement objects, which can be passed into
+        overall_quality().
+        """
+        by_identifier = defaultdict(list)
+        if not identifier_ids:
+            return by_identifier
+        qu = _db.query(
+            Measurement.identifier_id, DataSource.name,
+            Measurement.quantity_measured, Measurement.value,
+            Measurement._normalized_value, Measurement.weight
+        ).join(
+            DataSource, Measurement.data_source_id==DataSource.id
+        ).filter(
+            Measurement.identifier_id.in_(identifier_ids)
+        ).filter(
+            Measurement.is_most_recent==True
+        ).filter(
+            Measurement.quantity_measured.in_(quantities)
+        )
+        for (identifier_id, data_source_name, quantity_measured, value,
+             normalized_value, weight) in qu:
+            # Mirror the logic of the normalized_value property.
+            if not normalized_value:
+                normalized_value = cls.normalize(
+                    quantity_measured, data_source_name, value
+                )
+            by_identifier[identifier_id].append(
+                NormalizedMeasurement(
+                    quantity_measured, normalized_value, weight
+                )
+            )
+        return by_identifier
+
+
+# The parts of a Measurement needed by Measurement.overall_quality().
+NormalizedMeasurement = namedtuple(
+    'NormalizedMeasurement', ['quantity_measured', 'normalized_value', 'weight']
+)
 
 
 class LicensePoolDeliveryMechanism(Base):
@@ -4800,6 +5338,77 @@ class Resource(Base):
         return quality
 
 
+class SummaryAnalysis(Base):
+    """The noun phrases and number of sentences a SummaryEvaluator
+    found in the text of a summary.
+
+    Analyzing a summary is slow, and the same summaries are evaluated
+    every time a Work's presentation is calculated, so analyses are
+    kept here, keyed by a hash of the summary's text and the name of
+    the noun phrase extractor that did the analysis.
+    """
+    __tablename__ = 'summaryanalyses'
+    id = Column(Integer, primary_key=True)
+    content_hash = Column(Unicode, nullable=False)
+    extractor = Column(Unicode, nullable=False)
+    noun_phrases = Column(ARRAY(Unicode), default=[])
+    sentences = Column(Integer)
+
+    __table_args__ = (
+        UniqueConstraint('content_hash', 'extractor'),
+    )
+
+    @classmethod
+    def load(cls, _db, evaluator, summaries):
+        """Tell a SummaryEvaluator about every stored analysis of
+        any of the given summaries.
+        """
+        hashes = set(evaluator.content_hash(x) for x in summaries)
+        if not hashes:
+            return
+        qu = _db.query(SummaryAnalysis).filter(
+            SummaryAnalysis.extractor==evaluator.noun_phrase_extractor.name
+        ).filter(
+            SummaryAnalysis.content_hash.in_(hashes)
+        )
+        for analysis in qu:
+            evaluator.remember(
+                analysis.content_hash,
+                (analysis.noun_phrases or [], analysis.sentences)
+            )
+
+    @classmethod
+    def save(cls, _db, evaluator):
+        """Store the analyses a SummaryEvaluator had to perform
+        itself, with a single INSERT.
+        """
+        if not evaluator.new_analyses:
+            return
+        params = dict(extractor=evaluator.noun_phrase_extractor.name)
+        values = []
+        for i, (content_hash, (noun_phrases, sentences)) in enumerate(
+                sorted(evaluator.new_analyses.items())
+        ):
+            params["content_hash_%d" % i] = unicode(content_hash)
+            params["noun_phrases_%d" % i] = [unicode(x) for x in noun_phrases]
+            params["sentences_%d" % i] = sentences
+            values.append(
+                "(:content_hash_%d, :extractor, "
+                "CAST(:noun_phrases_%d AS varchar[]), :sentences_%d)"
+                % (i, i, i)
+            )
+        # Another process may have analyzed the same summary in the
+        # meantime; its analysis is as good as ours.
+        _db.execute(
+            "INSERT INTO summaryanalyses "
+            "(content_hash, extractor, noun_phrases, sentences) VALUES %s "
+            "ON CONFLICT (content_hash, extractor) DO NOTHING"
+            % ", ".join(values),
+            params
+        )
+        evaluator.new_analyses = dict()
+
+
 class Genre(Base):
     """A subject-matter classification for a book.
 
@@ -4823,6 +5432,11 @@ class Genre(Base):
             self.name, len(self.subjects), len(self.works),
             len(classifier.genres[self.name].subgenres))
 
+    @classmethod
+    def ids_by_name(cls, _db):
+        """Map the name of every Genre to its database ID."""
+        return dict(_db.query(Genre.name, Genre.id))
+
     @classmethod
     def lookup(cls, _db, name, autocreate=False):
         if isinstance(name, GenreData):
@@ -4950,6 +5564,11 @@ class Subject(Base):
     # not be checked again unless forced.
     checked = Column(Boolean, default=False, index=True)
 
+    # The Classifier.rules_hash() of the classifier that last checked
+    # this Subject. If the classifier's rules change, the Subject
+    # needs to be checked again.
+    rules_hash = Column(Unicode, default=None, index=True)
+
     # One Subject may participate in many Classifications.
     classifications = relationship(
         "Classification", backref="subject"
@@ -5018,6 +5637,32 @@ class Subject(Base):
             return True
         return False
 
+    @property
+    def needs_genre_assignment(self):
+        """Has this Subject never been checked, or been checked using
+        classification rules that have since changed?
+        """
+        if not self.checked:
+            return True
+        classifier = Classifier.lookup(self.type)
+        if not classifier:
+            return False
+        return self.rules_hash != classifier.rules_hash()
+
+    @classmethod
+    def stale_rules_clause(cls):
+        """A SQL clause matching Subjects that were checked using
+        classification rules that have since changed.
+        """
+        clauses = []
+        for type, classifier in Classifier.classifiers.items():
+            clauses.append(
+                and_(Subject.type==type,
+                     or_(Subject.rules_hash==None,
+                         Subject.rules_hash != classifier.rules_hash()))
+            )
+        return or_(*clauses)
+
     @classmethod
     def lookup(cls, _db, type, identifier, name):
         """Turn a subject type and identifier into a Subject."""
@@ -5054,37 +5699,121 @@ class Subject(Base):
         genre/audience/fiction status if possible, and mark each as
         checked.
 
+        Subjects that were checked using classification rules that
+        have since changed are checked again.
+
+        Subjects are classified in memory, one batch at a time, and
+        each batch is written back with a single UPDATE.
+
         :param type_restriction: Only consider subjects of the given type.
         :param force: Assign a genre to all subjects not just the ones that
                       have been checked.
         :param batch_size: Perform a database commit every time this many
                            subjects have been checked.
         """
-        q = _db.query(Subject).filter(Subject.locked==False)
+        q = _db.query(
+            Subject.id, Subject.type, Subject.identifier, Subject.name
+        ).filter(Subject.locked==False)
 
         if type_restriction:
             q = q.filter(Subject.type==type_restriction)
 
         if not force:
-            q = q.filter(Subject.checked==False)
-
-        counter = 0
-        for subject in q:
-            subject.assign_to_genre()
-            counter += 1
-            if not counter % batch_size:
-                _db.commit()
+            q = q.filter(
+                or_(Subject.checked==False, cls.stale_rules_clause())
+            )
+
+        genre_ids = Genre.ids_by_name(_db)
+        offset = 0
+        while True:
+            batch = q.filter(Subject.id > offset).order_by(
+                Subject.id).limit(batch_size).all()
+            if not batch:
+                break
+            cls.bulk_assign_to_genres(_db, batch, genre_ids)
+            _db.commit()
+            offset = batch[-1].id
         _db.commit()
 
-    def assign_to_genre(self):
-        """Assign this subject to a genre."""
-        classifier = Classifier.classifiers.get(self.type, None)
-        if not classifier:
+    @classmethod
+    def bulk_assign_to_genres(cls, _db, subjects, genre_ids=None):
+        """Assign many subjects to genres at once.
+
+        This does the same thing as calling assign_to_genre() on each
+        subject, but writes all the results with a single UPDATE
+        statement.
+
+        :param subjects: A list of Subjects, or of rows with `id`,
+            `type`, `identifier` and `name` attributes.
+        :param genre_ids: A dictionary mapping genre names to Genre IDs,
+            as returned by Genre.ids_by_name(). Genres not in the
+            dictionary will be created and added to it.
+        """
+        if genre_ids is None:
+            genre_ids = Genre.ids_by_name(_db)
+
+        rows = []
+        for subject in subjects:
+            classifier = Classifier.classifiers.get(subject.type, None)
+            if not classifier:
+                continue
+            genredata, audience, target_age, fiction = cls.genre_assignment(
+                classifier, subject
+            )
+            genre_id = None
+            if genredata:
+                genre_id = genre_ids.get(genredata.name)
+                if genre_id is None:
+                    genre, was_new = Genre.lookup(_db, genredata.name, True)
+                    genre_id = genre_ids[genre.name] = genre.id
+            rows.append(
+                (subject.id, genre_id, audience, target_age, fiction,
+                 classifier.rules_hash())
+            )
+        if not rows:
             return
-        self.checked = True
-        log = logging.getLogger("Subject-genre assignment")
 
-        genredata, audience, target_age, fiction = classifier.classify(self)
+        # Make sure the UPDATE sees any changes made through the ORM.
+        _db.flush()
+
+        values = []
+        params = dict()
+        columns = ['id', 'genre_id', 'audience', 'target_age', 'fiction',
+                   'rules_hash']
+        for i, row in enumerate(rows):
+            names = []
+            for column, value in zip(columns, row):
+                name = '%s_%d' % (column, i)
+                params[name] = value
+                names.append(':' + name)
+            values.append('(%s)' % ', '.join(names))
+
+        sql = """UPDATE subjects SET
+            checked = true,
+            genre_id = CAST(v.genre_id AS integer),
+            audience = CAST(v.audience AS audience),
+            target_age = CAST(v.target_age AS int4range),
+            fiction = CAST(v.fiction AS boolean),
+            rules_hash = v.rules_hash
+        FROM (VALUES %s) AS v (%s)
+        WHERE subjects.id = v.id""" % (', '.join(values), ', '.join(columns))
+        _db.execute(sql, params)
+
+        # Any Subjects in the session now have out-of-date information.
+        for subject in subjects:
+            if isinstance(subject, Subject):
+                _db.expire(subject)
+
+    @classmethod
+    def genre_assignment(cls, classifier, subject):
+        """Use a classifier to determine genre, audience, target age,
+        and fiction status for a subject.
+
+        :param subject: A Subject, or anything with `identifier` and
+            `name` attributes.
+        :return: A 4-tuple (genredata, audience, target_age, fiction)
+        """
+        genredata, audience, target_age, fiction = classifier.classify(subject)
         # If the genre is erotica, the audience will always be ADULTS_ONLY,
         # no matter what the classifier says.
         if genredata == Erotica:
@@ -5096,7 +5825,20 @@ class Subject(Base):
             # We have no audience but some target age information.
             # Try to determine an audience based on that.
             audience = Classifier.default_audience_for_target_age(target_age)
+        return genredata, audience, target_age, fiction
 
+    def assign_to_genre(self):
+        """Assign this subject to a genre."""
+        classifier = Classifier.classifiers.get(self.type, None)
+        if not classifier:
+            return
+        self.checked = True
+        self.rules_hash = classifier.rules_hash()
+        log = logging.getLogger("Subject-genre assignment")
+
+        genredata, audience, target_age, fiction = self.genre_assignment(
+            classifier, self
+        )
         if genredata:
             _db = Session.object_session(self)
             genre, was_new = Genre.lookup(_db, genredata.name, True)
@@ -5946,46 +6688,139 @@ class LicensePool(Base):
 
     @classmethod
     def consolidate_works(cls, _db, calculate_work_even_if_no_author=False,
-                          batch_size=10):
-        """Assign a (possibly new) Work to every unassigned LicensePool."""
-        a = 0
-        lps = cls.with_no_work(_db)
+                          batch_size=100):
+        """Assign a (possibly new) Work to every unassigned LicensePool.
+
+        The LicensePools are loaded `batch_size` at a time, and the
+        database is committed after each batch.
+        """
+        qu = _db.query(LicensePool).outerjoin(Work).filter(
+            Work.id==None).order_by(LicensePool.id)
+        last_id = 0
+        created = 0
+        while True:
+            batch = qu.filter(LicensePool.id > last_id).limit(batch_size).all()
+            if not batch:
+                break
+            last_id = batch[-1].id
+            created += len(cls.consolidate_batch(
+                _db, batch, calculate_work_even_if_no_author
+            ))
+            _db.commit()
         logging.info(
-            "Assigning Works to %d LicensePools with no Work.", len(lps)
+            "When consolidating works, created %d new Works.", created
         )
-        for unassigned in lps:
-            etext, new = unassigned.calculate_work(
-                even_if_no_author=calculate_work_even_if_no_author)
-            if not etext:
-                # We could not create a work for this LicensePool,
-                # most likely because it does not yet have any
-                # associated Edition.
+
+    @classmethod
+    def consolidate_batch(cls, _db, pools,
+                          calculate_work_even_if_no_author=False):
+        """Assign Works to a batch of LicensePools with no Work.
+
+        This gives the same results as calling calculate_work() on
+        each LicensePool, but open-access LicensePools are grouped by
+        permanent work ID and matched to existing Works with a single
+        query, and each Work's presentation is calculated once no
+        matter how many of the LicensePools end up in it. Anything
+        unusual is left to calculate_work().
+
+        :return: A list of the newly created Works.
+        """
+        # Open-access LicensePools, keyed by permanent work ID and medium.
+        open_access = defaultdict(list)
+        # LicensePools that get a Work to themselves.
+        solo = []
+        # LicensePools whose Edition already has a Work.
+        complicated = []
+        for pool in pools:
+            edition = pool.presentation_edition_for_work(
+                calculate_work_even_if_no_author
+            )
+            if not edition:
                 continue
-            a += 1
-            logging.info("When consolidating works, created %r", etext)
-            if a and not a % batch_size:
-                _db.commit()
-        _db.commit()
+            if edition.work:
+                complicated.append(pool)
+            elif pool.open_access and edition.permanent_work_id:
+                open_access[(edition.permanent_work_id, edition.medium)].append(
+                    pool
+                )
+            else:
+                solo.append(pool)
+
+        # Find the Works that already exist for these permanent work IDs.
+        existing = defaultdict(set)
+        if open_access:
+            pwids = set(pwid for pwid, medium in open_access)
+            qu = _db.query(LicensePool).join(
+                LicensePool.presentation_edition).filter(
+                    LicensePool.open_access==True
+                ).filter(
+                    LicensePool.work_id != None
+                ).filter(
+                    Edition.permanent_work_id.in_(pwids)
+                ).options(contains_eager(LicensePool.presentation_edition))
+            for pool in qu:
+                edition = pool.presentation_edition
+                existing[(edition.permanent_work_id, edition.medium)].add(
+                    pool.work
+                )
 
+        changed = set()
+        new_works = []
+        for key, group in open_access.items():
+            works = existing.get(key)
+            if works and len(works) > 1:
+                # There's more than one Work for this permanent work
+                # ID. calculate_work() will merge them.
+                complicated.extend(group)
+                continue
+            if works:
+                [work] = works
+                work.make_exclusive_open_access_for_permanent_work_id(*key)
+            else:
+                work = Work()
+                new_works.append(work)
+            for pool in group:
+                pool.work = work
+            changed.add(work)
 
-    def calculate_work(self, even_if_no_author=False, known_edition=None):
-        """Find or create a Work for this LicensePool.
+        for pool in solo:
+            work = Work()
+            new_works.append(work)
+            pool.work = work
+            changed.add(work)
+
+        # Create all the new Works at once.
+        _db.add_all(new_works)
+        _db.flush()
+
+        with WorkCoverageRecord.batch(_db):
+            for work in changed:
+                work.calculate_presentation()
+
+            for pool in complicated:
+                work, is_new = pool.calculate_work(
+                    calculate_work_even_if_no_author,
+                    known_edition=pool.presentation_edition
+                )
+                if is_new:
+                    new_works.append(work)
 
-        A pool that is not open-access will always have its own
-        Work. Open-access LicensePools will be grouped together with
-        other open-access LicensePools based on the permanent work ID
-        of the LicensePool's presentation edition.
+        for work in new_works:
+            logging.info("When consolidating works, created %r", work)
+        return new_works
 
-        :param even_if_no_author: Ordinarily this method will refuse
-        to create a Work for a LicensePool whose Edition has no title
-        or author. But sometimes a book just has no known author. If
-        that's really the case, pass in even_if_no_author=True and the
-        Work will be created.
+    def presentation_edition_for_work(self, even_if_no_author=False,
+                                      known_edition=None):
+        """Make sure this LicensePool's presentation Edition is ready
+        to be grouped into a Work.
+
+        :return: The presentation Edition, with its permanent work ID
+        calculated, or None if this LicensePool should not have a Work.
         """
         if not self.identifier:
             # A LicensePool with no Identifier should never have a Work.
             self.work = None
-            return None, False
+            return None
         if known_edition:
             presentation_edition = known_edition
         else:
@@ -6002,7 +6837,7 @@ class LicensePool(Base):
             # If there was a work associated with this LicensePool,
             # it was by mistake. Remove it.
             self.work = None
-            return None, False
+            return None
 
         if presentation_edition.is_presentation_for != self:
             raise ValueError(
@@ -6020,7 +6855,7 @@ class LicensePool(Base):
                 logging.info("Edition %r has no title and it will not get a Work.", presentation_edition)
             self.work = None
             self.work_id = None
-            return None, False
+            return None
 
         if (not presentation_edition.work
             and presentation_edition.author in (None, Edition.UNKNOWN_AUTHOR)
@@ -6034,9 +6869,30 @@ class LicensePool(Base):
             # it was by mistake. Remove it.
             self.work = None
             self.work_id = None
-            return None, False
+            return None
 
         presentation_edition.calculate_permanent_work_id()
+        return presentation_edition
+
+    def calculate_work(self, even_if_no_author=False, known_edition=None):
+        """Find or create a Work for this LicensePool.
+
+        A pool that is not open-access will always have its own
+        Work. Open-access LicensePools will be grouped together with
+        other open-access LicensePools based on the permanent work ID
+        of the LicensePool's presentation edition.
+
+        :param even_if_no_author: Ordinarily this method will refuse
+        to create a Work for a LicensePool whose Edition has no title
+        or author. But sometimes a book just has no known author. If
+        that's really the case, pass in even_if_no_author=True and the
+        Work will be created.
+        """
+        presentation_edition = self.presentation_edition_for_work(
+            even_if_no_author, known_edition
+        )
+        if not presentation_edition:
+            return None, False
 
         _db = Session.object_session(self)
         work = None
@@ -6574,6 +7430,106 @@ class Timestamp(Base):
             stamp.timestamp = now
         return stamp
 
+
+class RateLimit(Base):
+    """The state of a token bucket shared by every process that makes
+    requests to some third-party service.
+    """
+
+    __tablename__ = 'ratelimits'
+    name = Column(Unicode, primary_key=True)
+    tokens = Column(Float)
+    updated = Column(DateTime)
+
+    @classmethod
+    def limiter_for(cls, _db, integration_name):
+        """Create a RateLimiter for an integration, using the rate limit
+        in its configuration.
+
+        If the rate limit is shared, the bucket is kept in the
+        database. Otherwise it's shared by every thread in this
+        process.
+        """
+        config = Configuration.rate_limit(integration_name)
+        rate = config.get(Configuration.RATE_LIMIT_REQUESTS_PER_SECOND)
+        bucket = None
+        if rate:
+            capacity = config.get(Configuration.RATE_LIMIT_BURST)
+            if config.get(Configuration.RATE_LIMIT_SHARED):
+                bucket = DatabaseTokenBucket(
+                    _db.get_bind(), unicode(integration_name), rate, capacity
+                )
+            else:
+                bucket = TokenBucket.shared(integration_name, rate, capacity)
+        return RateLimiter(integration_name, bucket)
+
+
+class DatabaseTokenBucket(object):
+    """A TokenBucket whose state is kept in a RateLimit row, so that it
+    can be shared between processes and hosts.
+
+    Each operation is a single statement run outside of any ongoing
+    transaction, and the database's clock is used throughout.
+    """
+
+    # The number of tokens in the bucket right now.
+    REFILLED = """LEAST(
+  :capacity,
+  ratelimits.tokens + GREATEST(
+   EXTRACT(EPOCH FROM clock_timestamp() - ratelimits.updated), 0
+  ) * :rate
+ )"""
+
+    TAKE = """INSERT INTO ratelimits (name, tokens, updated)
+VALUES (:name, :capacity - :tokens, clock_timestamp())
+ON CONFLICT (name) DO UPDATE SET
+ tokens = %s - :tokens,
+ updated = clock_timestamp()
+RETURNING tokens""" % REFILLED
+
+    PAUSE = """INSERT INTO ratelimits (name, tokens, updated)
+VALUES (:name, :debt, clock_timestamp())
+ON CONFLICT (name) DO UPDATE SET
+ tokens = LEAST(%s, :debt),
+ updated = clock_timestamp()""" % REFILLED
+
+    def __init__(self, connectable, name, rate, capacity=None,
+                 sleep=time.sleep):
+        """Constructor.
+
+        :param connectable: An Engine or Connection.
+        """
+        if rate <= 0:
+            raise ValueError("Rate must be positive, not %r" % rate)
+        self.connectable = connectable
+        self.name = name
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.sleep = sleep
+
+    def take(self, tokens=1):
+        """Take tokens from the bucket, waiting until enough are
+        available.
+
+        :return: The number of seconds spent waiting.
+        """
+        [remaining] = self.connectable.execute(
+            text(self.TAKE), name=self.name, capacity=self.capacity,
+            tokens=float(tokens), rate=self.rate
+        ).fetchone()
+        if remaining >= 0:
+            return 0
+        delay = -remaining / self.rate
+        self.sleep(delay)
+        return delay
+
+    def pause(self, seconds):
+        """Hand out no more tokens for at least `seconds`."""
+        self.connectable.execute(
+            text(self.PAUSE), name=self.name, capacity=self.capacity,
+            rate=self.rate, debt=-seconds * self.rate
+        )
+
 class Representation(Base):
     """A cached document obtained from (and possibly mirrored to) the Web
     at large.
@@ -6670,6 +7626,10 @@ class Representation(Base):
     # to `mirror_url.
     mirror_exception = Column(Unicode, index=True)
 
+    # The SHA-256 hash of the content found at `mirror_url`. This is
+    # used to avoid mirroring the same content twice.
+    mirror_content_hash = Column(Unicode, index=True)
+
     # If this image is a scaled-down version of some other image,
     # `scaled_at` is the time it was last generated.
     scaled_at = Column(DateTime, index=True)
@@ -6716,8 +7676,13 @@ class Representation(Base):
     # If this representation is an image, the width of the image.
     image_width = Column(Integer, index=True)
 
-    # The content of the representation itself.
-    content = Column(Binary)
+    # The content of the representation itself, if it's kept in the
+    # database. Use the `content` property instead of this.
+    _content = Column("content", Binary)
+
+    # If the content of the representation is kept in the content
+    # store, this is the SHA-256 hash it's kept under.
+    content_hash = Column(Unicode, index=True)
 
     # Instead of being stored in the database, the content of the
     # representation may be stored on a local file relative to the
@@ -6740,8 +7705,48 @@ class Representation(Base):
             return 1000000
         return (datetime.datetime.utcnow() - self.fetched_at).total_seconds()
 
+    @classmethod
+    def content_store(cls):
+        """The ContentStore that holds representation content, or None
+        if content is kept in the database.
+        """
+        if not Configuration.instance:
+            return None
+        directory = Configuration.content_store_directory()
+        if not directory:
+            return None
+        return ContentStore(directory)
+
+    @property
+    def content(self):
+        if self._content is not None or not self.content_hash:
+            return self._content
+        return self._required_content_store().get(self.content_hash)
+
+    @content.setter
+    def content(self, value):
+        store = self.content_store()
+        if value is None or store is None:
+            self._content = value
+            self.content_hash = None
+        else:
+            # Identical content fetched from many URLs is only stored
+            # once.
+            self.content_hash = store.put(value)
+            self._content = None
+
+    def _required_content_store(self):
+        store = self.content_store()
+        if not store:
+            raise ValueError(
+                "Content for %s is in the content store, but no content store is configured." % self.url
+            )
+        return store
+
     @property
     def has_content(self):
+        if self.content_hash and self.status_code == 200 and self.fetch_exception is None:
+            return True
         if self.content and self.status_code == 200 and self.fetch_exception is None:
             return True
         if self.local_content_path and os.path.exists(self.local_content_path) and self.fetch_exception is None:
@@ -6800,33 +7805,10 @@ class Representation(Base):
         # the data sources we currently use, so for now we can treat
         # different representations of a URL as interchangeable.
 
-        a = dict(url=url)
-        if accept:
-            a['media_type'] = accept
-        representation = get_one(_db, Representation, 'interchangeable', **a)
-
-        # Convert a max_age timedelta to a number of seconds.
-        if isinstance(max_age, datetime.timedelta):
-            max_age = max_age.total_seconds()
-
-        # Do we already have a usable representation?
-        #
-        # 'Usable' means we tried it and either got some data or
-        # received a status code that's not in the 5xx series.
-        usable_representation = (
-            representation and not representation.fetch_exception
-            and (
-                representation.content or representation.local_path
-                or representation.status_code and representation.status_code / 100 != 5
-            )
+        representation, usable_representation, fresh_representation = (
+            cls._cached(_db, url, accept, max_age)
         )
 
-        # Assuming we have a usable representation, is it
-        # fresh?
-        fresh_representation = (
-            usable_representation and (
-                max_age is None or max_age > representation.age))
-
         if debug is True:
             debug_level = logging.DEBUG
         elif debug is False:
@@ -6843,20 +7825,10 @@ class Representation(Base):
         # We must make an HTTP request.
         if debug_level is not None:
             logging.log(debug_level, "Fetching %s", url)
-        headers = {}
-        if extra_request_headers:
-            headers.update(extra_request_headers)
-        if accept:
-            headers['Accept'] = accept
-
-        if usable_representation:
-            # We have a representation but it's not fresh. We will
-            # be making a conditional HTTP request to see if there's
-            # a new version.
-            if representation.last_modified:
-                headers['If-Modified-Since'] = representation.last_modified
-            if representation.etag:
-                headers['If-None-Match'] = representation.etag
+        headers = cls._request_headers(
+            representation, usable_representation, extra_request_headers,
+            accept
+        )
 
         fetched_at = datetime.datetime.utcnow()
         if pause_before:
@@ -6954,6 +7926,81 @@ class Representation(Base):
         representation.content = content
         return representation, False
 
+    @classmethod
+    def request_headers_for(cls, _db, url, extra_request_headers=None,
+                            accept=None, max_age=None):
+        """Find out whether get() would make an HTTP request.
+
+        This makes it possible to fetch a number of representations
+        outside of the database session, then hand the responses to
+        get().
+
+        :return: The headers get() would send, or None if get() would
+        use a cached representation.
+        """
+        representation, usable, fresh = cls._cached(
+            _db, url, accept, max_age
+        )
+        if fresh:
+            return None
+        return cls._request_headers(
+            representation, usable, extra_request_headers, accept
+        )
+
+    @classmethod
+    def _cached(cls, _db, url, accept, max_age):
+        """Look for a cached representation of `url`.
+
+        :return: A 3-tuple (representation, usable, fresh).
+        """
+        a = dict(url=url)
+        if accept:
+            a['media_type'] = accept
+        representation = get_one(_db, Representation, 'interchangeable', **a)
+
+        # Convert a max_age timedelta to a number of seconds.
+        if isinstance(max_age, datetime.timedelta):
+            max_age = max_age.total_seconds()
+
+        # Do we already have a usable representation?
+        #
+        # 'Usable' means we tried it and either got some data or
+        # received a status code that's not in the 5xx series.
+        usable_representation = (
+            representation and not representation.fetch_exception
+            and (
+                representation.content_hash or representation.content
+                or representation.local_path
+                or representation.status_code and representation.status_code / 100 != 5
+            )
+        )
+
+        # Assuming we have a usable representation, is it
+        # fresh?
+        fresh_representation = (
+            usable_representation and (
+                max_age is None or max_age > representation.age))
+        return representation, usable_representation, fresh_representation
+
+    @classmethod
+    def _request_headers(cls, representation, usable_representation,
+                         extra_request_headers, accept):
+        headers = {}
+        if extra_request_headers:
+            headers.update(extra_request_headers)
+        if accept:
+            headers['Accept'] = accept
+
+        if usable_representation:
+            # We have a representation but it's not fresh. We will
+            # be making a conditional HTTP request to see if there's
+            # a new version.
+            if representation.last_modified:
+                headers['If-Modified-Since'] = representation.last_modified
+            if representation.etag:
+                headers['If-None-Match'] = representation.etag
+        return headers
+
     @classmethod
     def _best_media_type(cls, headers, default):
         """Determine the most likely media type for the given HTTP headers.
@@ -7066,6 +8113,54 @@ class Representation(Base):
         self.update_image_size()
 
 
+    @classmethod
+    def mirrored_copies(cls, _db, mirror_content_hashes):
+        """Find Representations that have already been successfully
+        mirrored with the given content.
+
+        :return: A dictionary mapping (mirror_content_hash,
+        external_media_type) to a Representation.
+        """
+        if not mirror_content_hashes:
+            return {}
+        qu = _db.query(Representation).filter(
+            Representation.mirror_content_hash.in_(
+                set(mirror_content_hashes))
+        ).filter(
+            Representation.mirrored_at != None
+        ).filter(
+            Representation.mirror_exception == None
+        ).filter(
+            Representation.mirror_url != None
+        ).order_by(Representation.id)
+        copies = {}
+        for representation in qu:
+            key = (representation.mirror_content_hash,
+                   representation.external_media_type)
+            copies.setdefault(key, representation)
+        return copies
+
+    @classmethod
+    def mirrored_to(cls, _db, mirror_urls):
+        """Find Representations that have been successfully mirrored to
+        the given URLs.
+
+        :return: A dictionary mapping mirror_url to a Representation.
+        """
+        if not mirror_urls:
+            return {}
+        qu = _db.query(Representation).filter(
+            Representation.mirror_url.in_(set(mirror_urls))
+        ).filter(
+            Representation.mirrored_at != None
+        ).filter(
+            Representation.mirror_exception == None
+        ).order_by(Representation.id)
+        copies = {}
+        for representation in qu:
+            copies.setdefault(representation.mirror_url, representation)
+        return copies
+
     def set_as_mirrored(self):
         """Record the fact that the representation has been mirrored
         to its .mirror_url.
@@ -7247,10 +8342,12 @@ class Representation(Base):
     def content_fh(self):
         """Return an open filehandle to the representation's contents.
 
-        This works whether the representation is kept in the database
-        or in a file on disk.
+        This works whether the representation is kept in the database,
+        in the content store, or in a file on disk.
         """
-        if self.content:
+        if self.content_hash and self._content is None:
+            return self._required_content_store().open(self.content_hash)
+        elif self.content:
             return StringIO(self.content)
         elif self.local_path:
             if not os.path.exists(self.local_path):
@@ -7258,23 +8355,23 @@ class Representation(Base):
             return open(self.local_path)
         return None
 
-    def as_image(self):
-        """Load this Representation's contents as a PIL image."""
+    def image_content(self):
+        """Load this Representation's contents, making sure they're an
+        image.
+        """
         if not self.is_image:
             raise ValueError(
                 "Cannot load non-image representation as image: type %s." 
                 % self.media_type)
-        if not self.content and not self.local_path:
+        if (not self.content_hash and not self.content
+            and not self.local_path):
             raise ValueError("Image representation has no content.")
 
-        fh = self.content_fh()
-        if not fh:
-            return None
-        if self.clean_media_type == self.SVG_MEDIA_TYPE:
-            # Transparently convert the SVG to a PNG.
-            png_data = cairosvg.svg2png(fh.read())
-            fh = StringIO(png_data)
-        return Image.open(fh)
+        return self.content_fh().read()
+
+    def as_image(self):
+        """Load this Representation's contents as a PIL image."""
+        return open_image(self.image_content(), self.clean_media_type)
 
     pil_format_for_media_type = {
         "image/gif": "gif",
@@ -7294,96 +8391,178 @@ class Representation(Base):
 
         """
         _db = Session.object_session(self)
+        jobs = [(self, [(max_height, max_width, destination_url)])]
+        [result] = self.bulk_scale(
+            _db, jobs, destination_media_type, force=force, processes=1
+        )[self]
+        return result
 
-        if not destination_media_type in self.pil_format_for_media_type:
-            raise ValueError("Unsupported destination media type: %s" % destination_media_type)
-                
-        pil_format = self.pil_format_for_media_type[destination_media_type]
+    @classmethod
+    def bulk_scale(cls, _db, jobs, destination_media_type, force=False,
+                   processes=None):
+        """Scale a number of images, each to one or more sizes.
 
-        # Make sure we actually have an image to scale.
-        try:
-            image = self.as_image()
-        except Exception, e:
-            self.scale_exception = traceback.format_exc()
-            self.scaled_at = None
-            # This most likely indicates an error during the fetch
-            # phrase.
-            self.fetch_exception = "Error found while scaling: %s" % (
-                self.scale_exception)
-            logging.error("Error found while scaling %r", self, exc_info=e)
-            return self, False
-
-        # Now that we've loaded the image, take the opportunity to set
-        # the image size of the original representation.
-        self.image_width, self.image_height = image.size
-
-        # If the image is already a thumbnail-size bitmap, don't bother.
-        if (self.clean_media_type != Representation.SVG_MEDIA_TYPE
-            and self.image_height <= max_height 
-            and self.image_width <= max_width):
-            self.thumbnails = []
-            return self, False
-
-        # Do we already have a representation for the given URL?
-        thumbnail, is_new = get_one_or_create(
-            _db, Representation, url=destination_url, 
-            media_type=destination_media_type
-        )
-        if thumbnail not in self.thumbnails:
-            thumbnail.thumbnail_of = self
+        Each image is decoded only once, no matter how many sizes it's
+        scaled to, and the decoding and scaling happen in a pool of
+        worker processes. The thumbnails are written to the database
+        in a single flush.
 
-        if not is_new and not force:
-            # We found a preexisting thumbnail and we're allowed to
-            # use it.
-            return thumbnail, is_new
+        :param jobs: A list of 2-tuples (representation, sizes), where
+        `sizes` is a list of 3-tuples (max_height, max_width,
+        destination_url).
 
-        # At this point we have a parent Representation (self), we
-        # have a Representation that will contain a thumbnail
-        # (thumbnail), and we know we need to actually thumbnail the
-        # parent into the thumbnail.
-        #
-        # Because the representation of this image is being
-        # changed, it will need to be mirrored later on.
-        now = datetime.datetime.utcnow()
-        thumbnail.mirror_url = thumbnail.url
-        thumbnail.mirrored_at = None
-        thumbnail.mirror_exception = None
+        :param processes: The number of worker processes to use. See
+        ThumbnailPipeline.
 
-        args = [(max_width, max_height),
-                Image.ANTIALIAS]
-        try:
-            image.thumbnail(*args)
-        except IOError, e:
-            # I'm not sure why, but sometimes just trying
-            # it again works.
-            original_exception = traceback.format_exc()
+        :return: A dictionary mapping each Representation in `jobs` to
+        a list of 2-tuples (Representation, is_new), one for each
+        requested size, as would be returned by scale().
+        """
+        if not destination_media_type in cls.pil_format_for_media_type:
+            raise ValueError("Unsupported destination media type: %s" % destination_media_type)
+        pil_format = cls.pil_format_for_media_type[destination_media_type]
+
+        # Find all the thumbnails that already exist in one query.
+        urls = set(url for ignore, sizes in jobs for h, w, url in sizes)
+        existing = dict()
+        if urls:
+            qu = _db.query(Representation).filter(
+                Representation.url.in_(urls)).filter(
+                    Representation.media_type==destination_media_type)
+            existing = dict((x.url, x) for x in qu)
+
+        results = dict()
+        pending = []
+        for representation, sizes in jobs:
+            if (not force and all(url in existing for h, w, url in sizes)
+                and representation._load_image_size()):
+                # We found preexisting thumbnails for every size and
+                # we're allowed to use them -- except for any size the
+                # image already fits, where we don't bother.
+                small = [representation._fits(h, w) for h, w, url in sizes]
+                if all(small):
+                    representation.thumbnails = []
+                results[representation] = [
+                    (representation, False) if fits
+                    else (representation._thumbnail_at(existing[url]), False)
+                    for fits, (h, w, url) in zip(small, sizes)
+                ]
+                continue
+
+            # Make sure we actually have an image to scale.
             try:
-                image.thumbnail(*args)
-            except IOError, e:
-                self.scale_exception = original_exception
-                self.scaled_at = None
-                return self, False
-
-        # Save the thumbnail image to the database under
-        # thumbnail.content.
-        output = StringIO()
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+                content = representation.image_content()
+            except Exception, e:
+                logging.error(
+                    "Error found while scaling %r", representation, exc_info=e
+                )
+                representation._scale_failed(traceback.format_exc())
+                results[representation] = [(representation, False)] * len(sizes)
+                continue
+            pending.append((representation, sizes, content))
+
+        thumbnail_jobs = [
+            ((i, representation.url), content,
+             representation.clean_media_type,
+             [(w, h) for h, w, url in sizes], pil_format)
+            for i, (representation, sizes, content) in enumerate(pending)
+        ]
+        pipeline = ThumbnailPipeline(processes)
+        now = datetime.datetime.utcnow()
+        for scaled in pipeline.run(thumbnail_jobs):
+            representation, sizes, content = pending[scaled.key[0]]
+            if scaled.exception:
+                representation._scale_failed(scaled.exception)
+                results[representation] = [(representation, False)] * len(sizes)
+                continue
+
+            # Now that we've loaded the image, take the opportunity to
+            # set the image size of the original representation.
+            representation.image_width, representation.image_height = (
+                scaled.original_size)
+
+            # If the image is already a thumbnail-size bitmap, don't
+            # bother.
+            if not any(scaled.thumbnails):
+                representation.thumbnails = []
+
+            results[representation] = []
+            for (h, w, url), data in zip(sizes, scaled.thumbnails):
+                if data is None:
+                    results[representation].append((representation, False))
+                    continue
+
+                thumbnail = existing.get(url)
+                if thumbnail and not force:
+                    results[representation].append(
+                        (representation._thumbnail_at(thumbnail), False)
+                    )
+                    continue
+                if not thumbnail:
+                    thumbnail = Representation(
+                        url=url, media_type=destination_media_type
+                    )
+                    _db.add(thumbnail)
+                    existing[url] = thumbnail
+                representation._thumbnail_at(thumbnail)
+
+                # Because the representation of this image is being
+                # changed, it will need to be mirrored later on.
+                thumbnail.mirror_url = thumbnail.url
+                thumbnail.mirrored_at = None
+                thumbnail.mirror_exception = None
+
+                thumbnail.content, (
+                    thumbnail.image_width, thumbnail.image_height) = data
+                thumbnail.scale_exception = None
+                thumbnail.scaled_at = now
+                results[representation].append((thumbnail, True))
+
+        if len(thumbnail_jobs) > 1:
+            logging.info(pipeline.summary())
+        _db.flush()
+        return results
+
+    def _load_image_size(self):
+        """Make sure the image size of this Representation is set, as
+        it would be if the image were scaled. For a bitmap, this only
+        reads the image's header.
+
+        :return: True if the image size is known, False if the image
+        couldn't be loaded.
+        """
+        if self.image_width is not None and self.image_height is not None:
+            return True
         try:
-            image.save(output, pil_format)
+            self.image_width, self.image_height = self.as_image().size
         except Exception, e:
-            self.scale_exception = traceback.format_exc()
-            self.scaled_at = None
-            # This most likely indicates a problem during the fetch phase,
-            # Set fetch_exception so we'll retry the fetch.
-            self.fetch_exception = "Error found while scaling: %s" % (self.scale_exception)
-            return self, False
-        thumbnail.content = output.getvalue()
-        thumbnail.image_width, thumbnail.image_height = image.size
-        output.close()
-        thumbnail.scale_exception = None
-        thumbnail.scaled_at = now
-        return thumbnail, True      
+            return False
+        return True
+
+    def _fits(self, max_height, max_width):
+        """Is this image already a thumbnail-size bitmap?
+
+        An SVG can always be scaled, so it never fits.
+        """
+        return (self.clean_media_type != Representation.SVG_MEDIA_TYPE
+                and self.image_height <= max_height
+                and self.image_width <= max_width)
+
+    def _thumbnail_at(self, thumbnail):
+        """Make sure `thumbnail` is known as a thumbnail of this
+        Representation.
+        """
+        if thumbnail not in self.thumbnails:
+            thumbnail.thumbnail_of = self
+        return thumbnail
+
+    def _scale_failed(self, exception):
+        self.scale_exception = exception
+        self.scaled_at = None
+        # This most likely indicates an error during the fetch
+        # phrase.
+        self.fetch_exception = "Error found while scaling: %s" % (
+            self.scale_exception)
 
     @property
     def thumbnail_size_quality_penalty(self):
@@ -7962,6 +9141,29 @@ def dump_query(query):
         params[k] = sqlescape(v)
     return (comp.string.encode(enc) % params).decode(enc)
 
+def estimated_row_count(query):
+    """Ask the query planner roughly how many rows a query will
+    return, without running it.
+
+    This is much cheaper than query.count() when the answer is big,
+    but it's only an estimate, and it's only a best effort: if the
+    planner can't be asked, the answer is None.
+    """
+    _db = query.session
+    try:
+        statement = query.statement.compile(dialect=postgresql.dialect())
+        sql = "EXPLAIN (FORMAT JSON) " + unicode(statement)
+        # A failed EXPLAIN would abort the whole transaction, so
+        # run it inside a savepoint.
+        with _db.begin_nested():
+            [[plan]] = _db.connection().execute(sql, statement.params)
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    except Exception, e:
+        logging.warn("Could not estimate row count: %s", e, exc_info=e)
+        return None
+
 
 def numericrange_to_tuple(r):
     """Helper method to normalize NumericRange into a tuple."""
@@ -1,4 +1,5 @@
 from nose.tools import set_trace
+from collections import namedtuple
 import datetime
 import os
 import logging
@@ -12,7 +13,9 @@ from sqlalchemy.sql.expression import (
 import log # This sets the appropriate log format and level.
 from config import Configuration
 from coverage import CoverageFailure
+from s3 import S3Uploader
 from model import (
+    get_one,
     get_one_or_create,
     CoverageRecord,
     Edition,
@@ -20,9 +23,11 @@ from model import (
     Identifier,
     LicensePool,
     PresentationCalculationPolicy,
+    Representation,
     Subject,
     Timestamp,
     Work,
+    WorkCoverageRecord,
 )
 
 class Monitor(object):
@@ -53,7 +58,13 @@ class Monitor(object):
             self._log = logging.getLogger(self.service_name)
         return self._log        
 
-    def run(self):        
+    def run(self):
+        """Run through once, picking up where the last run left off.
+
+        To run a monitor every `interval_seconds`, hand it to a
+        Scheduler.
+        """
+        self.stop_running = False
         if self.keep_timestamp:
             self.timestamp, new = get_one_or_create(
                 self._db, Timestamp,
@@ -67,24 +78,12 @@ class Monitor(object):
             start = self.default_start_time
             self.timestamp = None
 
-        while not self.stop_running:
-            cutoff = datetime.datetime.utcnow()           
-            new_timestamp = self.run_once(start, cutoff) or cutoff
-            duration = datetime.datetime.utcnow() - cutoff
-            to_sleep = self.interval_seconds-duration.seconds-1
-            self.cleanup()
-            if self.keep_timestamp:
-                self.timestamp.timestamp = new_timestamp
-            self._db.commit()
-
-            # TODO: This could be a little nicer, but basically we now
-            # want monitors to run through once and then stop.
-            if True:
-                self.stop_running = True
-            elif to_sleep > 0:
-                self.log.debug("Sleeping for %.1f", to_sleep)
-                time.sleep(to_sleep)
-            start = new_timestamp
+        cutoff = datetime.datetime.utcnow()
+        new_timestamp = self.run_once(start, cutoff) or cutoff
+        self.cleanup()
+        if self.keep_timestamp:
+            self.timestamp.timestamp = new_timestamp
+        self._db.commit()
 
     def run_once(self, start, cutoff):
         raise NotImplementedError()
@@ -93,6 +92,16 @@ class Monitor(object):
         pass
 
 
+# How far one shard of a sweep has gotten. `end` is None for the last
+# shard, which has no upper bound. `started_at` is when the current
+# (or last) sweep of the shard started. `fraction` and `eta` (a
+# timedelta) are None if the shard isn't in the middle of a sweep.
+ShardProgress = namedtuple(
+    "ShardProgress",
+    ["index", "start", "end", "counter", "started_at", "fraction", "eta"]
+)
+
+
 class IdentifierSweepMonitor(Monitor):
 
     # The completion of each individual item should be logged at
@@ -105,6 +114,89 @@ class IdentifierSweepMonitor(Monitor):
             _db, name, interval_seconds)
         self.default_counter = default_counter
         self.batch_size = batch_size
+        self.sweep_name = name
+        self.shard_end = None
+
+    def shard(self, index, count):
+        """Sweep only one of `count` ranges of IDs, so that `count`
+        processes can sweep at once.
+
+        Each shard keeps its own Timestamp, so it resumes
+        independently of the others.
+        """
+        if not 0 <= index < count:
+            raise ValueError(
+                "Shard must be between 0 and %d, not %d" % (count-1, index)
+            )
+        start, self.shard_end = self.shard_ranges(count)[index]
+        self.default_counter = max(self.default_counter, start)
+        self.service_name = self.shard_service_name(index, count)
+
+    def shard_service_name(self, index, count):
+        return "%s (shard %d of %d)" % (self.sweep_name, index+1, count)
+
+    def shard_ranges(self, count):
+        """Split the ID space into `count` ranges.
+
+        The ranges are fixed the first time the sweep is split `count`
+        ways, by recording the highest ID at that time. The last range
+        has no upper bound, so it takes in everything created since.
+
+        :return: A list of (start, end) 2-tuples. A shard covers the
+        IDs above `start` and no higher than `end`.
+        """
+        plan, is_new = get_one_or_create(
+            self._db, Timestamp,
+            service="%s (%d shards)" % (self.sweep_name, count)
+        )
+        if plan.counter is None:
+            [max_id] = self._db.query(
+                func.max(self.item_id_column())
+            ).one()
+            plan.counter = max_id or 0
+            plan.timestamp = datetime.datetime.utcnow()
+            self._db.commit()
+        ranges = []
+        for i in range(count):
+            start = plan.counter * i / count
+            if i == count-1:
+                end = None
+            else:
+                end = plan.counter * (i+1) / count
+            ranges.append((start, end))
+        return ranges
+
+    def shard_progress(self, count, now=None):
+        """Find out how far each of `count` shards has gotten.
+
+        :return: A list of ShardProgress objects.
+        """
+        now = now or datetime.datetime.utcnow()
+        [max_id] = self._db.query(func.max(self.item_id_column())).one()
+        progress = []
+        for index, (start, end) in enumerate(self.shard_ranges(count)):
+            timestamp = get_one(
+                self._db, Timestamp,
+                service=self.shard_service_name(index, count)
+            )
+            counter = started_at = fraction = eta = None
+            if timestamp:
+                counter = timestamp.counter
+                started_at = timestamp.timestamp
+            if counter and started_at:
+                total = (end or max_id or 0) - start
+                done = counter - start
+                if total > 0:
+                    fraction = min(float(done) / total, 1)
+                if fraction:
+                    elapsed = (now - started_at).total_seconds()
+                    eta = datetime.timedelta(
+                        seconds=elapsed * (1 - fraction) / fraction
+                    )
+            progress.append(ShardProgress(
+                index, start, end, counter, started_at, fraction, eta
+            ))
+        return progress
 
     def run(self):        
         self.timestamp, new = get_one_or_create(
@@ -115,7 +207,14 @@ class IdentifierSweepMonitor(Monitor):
             )
         )
         offset = self.timestamp.counter or self.default_counter
+        if offset == self.default_counter:
+            # A new sweep is starting.
+            self.timestamp.timestamp = datetime.datetime.utcnow()
 
+        # Setting stop_running while a sweep is under way stops it
+        # after the current batch. The next run picks up where this
+        # one left off.
+        self.stop_running = False
         started_at = datetime.datetime.utcnow()
         while not self.stop_running:
             a = time.time()
@@ -145,16 +244,25 @@ class IdentifierSweepMonitor(Monitor):
             offset = new_offset
 
     def run_once(self, offset):
-        q = self.identifier_query().filter(
-            Identifier.id > offset).order_by(
-            Identifier.id).limit(self.batch_size)
-        identifiers = q.all()
-        if identifiers:
-            self.process_batch(identifiers)
-            return identifiers[-1].id
+        id_column = self.item_id_column()
+        q = self.item_query().filter(id_column > (offset or 0))
+        if self.shard_end is not None:
+            q = q.filter(id_column <= self.shard_end)
+        items = q.order_by(id_column).limit(self.batch_size).all()
+        if items:
+            self.process_batch(items)
+            return items[-1].id
         else:
             return 0
 
+    def item_id_column(self):
+        """The column containing the ID of each item being swept."""
+        return Identifier.id
+
+    def item_query(self):
+        """Find the items to be swept."""
+        return self.identifier_query()
+
     def identifier_query(self):
         return self._db.query(Identifier)
 
@@ -175,16 +283,11 @@ class SubjectSweepMonitor(IdentifierSweepMonitor):
         self.subject_type = subject_type
         self.filter_string = filter_string
 
-    def run_once(self, offset):
-        q = self.subject_query().filter(
-            Subject.id > offset).order_by(
-            Subject.id).limit(self.batch_size)
-        subjects = q.all()
-        if subjects:
-            self.process_batch(subjects)
-            return subjects[-1].id
-        else:
-            return 0
+    def item_id_column(self):
+        return Subject.id
+
+    def item_query(self):
+        return self.subject_query()
 
     def subject_query(self):
         qu = self._db.query(Subject)
@@ -201,16 +304,11 @@ class SubjectSweepMonitor(IdentifierSweepMonitor):
 
 class CustomListEntrySweepMonitor(IdentifierSweepMonitor):
 
-    def run_once(self, offset):
-        q = self.custom_list_entry_query().filter(
-            CustomListEntry.id > offset).order_by(
-            CustomListEntry.id).limit(self.batch_size)
-        entries = q.all()
-        if entries:
-            self.process_batch(entries)
-            return entries[-1].id
-        else:
-            return 0
+    def item_id_column(self):
+        return CustomListEntry.id
+
+    def item_query(self):
+        return self.custom_list_entry_query()
 
     def process_batch(self, entries):
         for entry in entries:
@@ -222,18 +320,11 @@ class CustomListEntrySweepMonitor(IdentifierSweepMonitor):
 
 class EditionSweepMonitor(IdentifierSweepMonitor):
 
-    def run_once(self, offset):
-        if offset is None:
-            offset = 0
-        q = self.edition_query().filter(
-            Edition.id > offset).order_by(
-            Edition.id).limit(self.batch_size)
-        editions = q.all()
-        if editions:
-            self.process_batch(editions)
-            return editions[-1].id
-        else:
-            return 0
+    def item_id_column(self):
+        return Edition.id
+
+    def item_query(self):
+        return self.edition_query()
 
     def edition_query(self):
         return self._db.query(Edition)
@@ -249,26 +340,20 @@ class EditionSweepMonitor(IdentifierSweepMonitor):
 
 class WorkSweepMonitor(IdentifierSweepMonitor):
 
-    def run_once(self, offset):
-        if offset is None:
-            offset = 0
-        q = self.work_query().filter(
-            Work.id > offset).order_by(
-            Work.id).limit(self.batch_size)
-        works = q.all()
-        if works:
-            self.process_batch(works)
-            return works[-1].id
-        else:
-            return 0
+    def item_id_column(self):
+        return Work.id
+
+    def item_query(self):
+        return self.work_query()
 
     def work_query(self):
         return self._db.query(Work)
 
     def process_batch(self, batch):
-        for work in batch:
-            self.process_work(work)
-            self.log.log(self.COMPLETION_LOG_LEVEL, "Completed %r", work)
+        with WorkCoverageRecord.batch(self._db):
+            for work in batch:
+                self.process_work(work)
+                self.log.log(self.COMPLETION_LOG_LEVEL, "Completed %r", work)
 
     def process_work(self, work):
         raise NotImplementedError()
@@ -295,6 +380,23 @@ class SimpleOPDSEntryCacheMonitor(OPDSEntryCacheMonitor):
         super(SimpleOPDSEntryCacheMonitor, self).__init__(
             _db, interval_seconds, False)
 
+class WorkQualityRefreshMonitor(WorkSweepMonitor):
+    """Recalculate the quality of every work from its Measurements,
+    a batch at a time.
+    """
+
+    def __init__(self, _db, interval_seconds=3600*24, batch_size=1000):
+        super(WorkQualityRefreshMonitor, self).__init__(
+            _db, "Work quality refresh", interval_seconds,
+            batch_size=batch_size
+        )
+
+    def process_batch(self, works):
+        Work.calculate_quality_for_works(self._db, works)
+        self.log.log(
+            self.COMPLETION_LOG_LEVEL, "Completed %d works", len(works)
+        )
+
 class SubjectAssignmentMonitor(SubjectSweepMonitor):
 
     def __init__(self, _db, subject_type=None, filter_string=None,
@@ -309,7 +411,7 @@ class SubjectAssignmentMonitor(SubjectSweepMonitor):
         for subject in subjects:
             if subject.id > highest_id:
                 highest_id = subject.id
-            subject.assign_to_genre()
+        Subject.bulk_assign_to_genres(self._db, subjects)
         self.log.log(self.COMPLETION_LOG_LEVEL, "Completed %r", subject)
         return highest_id
 
@@ -344,51 +446,52 @@ class PresentationReadyMonitor(WorkSweepMonitor):
             Work.presentation_ready==None)
         return self._db.query(Work).filter(not_presentation_ready)
 
-    def run_once(self, offset):
-        # Consolidate works.
+    def run(self):
+        # Make sure every LicensePool has a Work before sweeping the Works.
         LicensePool.consolidate_works(
             self._db,
             calculate_work_even_if_no_author=self.calculate_work_even_if_no_author)
 
-        return super(PresentationReadyMonitor, self).run_once(offset)
+        return super(PresentationReadyMonitor, self).run()
 
     def process_batch(self, batch):
         max_id = 0
         one_success = False
-        for work in batch:
-            failures = None
-            exception = None
-            if work.id > max_id:
-                max_id = work.id
-            try:
-                failures = self.prepare(work)
-            except Exception, e:
-                self.log.error(
-                    "Exception processing work %r", work, exc_info=e
-                )
-                failures = e
-            if failures and failures not in (None, True):
-                if isinstance(failures, list):
-                    # This is a list of providers that failed.
-                    if len(failures):
-                        provider_names = ", ".join(
-                            [x.service_name for x in failures])
-                        exception = "Provider(s) failed: %s" % provider_names
+        with WorkCoverageRecord.batch(self._db):
+            for work in batch:
+                failures = None
+                exception = None
+                if work.id > max_id:
+                    max_id = work.id
+                try:
+                    failures = self.prepare(work)
+                except Exception, e:
+                    self.log.error(
+                        "Exception processing work %r", work, exc_info=e
+                    )
+                    failures = e
+                if failures and failures not in (None, True):
+                    if isinstance(failures, list):
+                        # This is a list of providers that failed.
+                        if len(failures):
+                            provider_names = ", ".join(
+                                [x.service_name for x in failures])
+                            exception = "Provider(s) failed: %s" % provider_names
+                        else:
+                            # Just kidding, the list is empty, there were
+                            # no failures.
+                            pass
                     else:
-                        # Just kidding, the list is empty, there were
-                        # no failures.
-                        pass
+                        exception = str(failures)
+                if exception:
+                    work.presentation_ready_exception = exception
                 else:
-                    exception = str(failures)
-            if exception:
-                work.presentation_ready_exception = exception
-            else:
-                policy = PresentationCalculationPolicy(
-                    choose_edition=False
-                )
-                work.calculate_presentation(policy)
-                work.set_presentation_ready()                    
-                one_success = True
+                    policy = PresentationCalculationPolicy(
+                        choose_edition=False
+                    )
+                    work.calculate_presentation(policy)
+                    work.set_presentation_ready()                    
+                    one_success = True
         self.finalize_batch()
         return max_id
 
@@ -411,21 +514,57 @@ class PresentationReadyMonitor(WorkSweepMonitor):
         self._db.commit()
 
 
-class WorkRandomnessUpdateMonitor(WorkSweepMonitor):
+class WorkRandomnessUpdateMonitor(Monitor):
+    """Reshuffle the random order of works.
 
-    def __init__(self, _db, interval_seconds=3600*24,
-                 default_counter=0, batch_size=1000):
+    Work.random_order() is derived from each work's ID and an epoch
+    kept in this monitor's Timestamp, so moving on to the next epoch
+    reshuffles everything without touching the works table.
+    """
+
+    def __init__(self, _db, interval_seconds=3600*24):
         super(WorkRandomnessUpdateMonitor, self).__init__(
-            _db, "Work Randomness Updater", interval_seconds, default_counter, batch_size)
+            _db, Work.RANDOM_ORDER_SERVICE, interval_seconds
+        )
 
-    def run_once(self, offset):
-        new_offset = offset + self.batch_size
-        text = "update works set random=random() where id >= :offset and id < :new_offset;"
-        self._db.execute(text, dict(offset=offset, new_offset=new_offset))
-        [[self.max_work_id]] = self._db.execute('select max(id) from works')
-        if self.max_work_id < new_offset:
-            return 0
-        return new_offset
+    def run_once(self, start, cutoff):
+        self.timestamp.counter = (self.timestamp.counter or 0) + 1
+
+
+class MirrorRetryMonitor(IdentifierSweepMonitor):
+    """Try again to mirror every Representation whose last mirror
+    attempt failed.
+
+    The representations' `mirror_exception` fields act as a
+    persistent queue of uploads to retry.
+    """
+
+    def __init__(self, _db, mirror=None, interval_seconds=3600,
+                 batch_size=100):
+        super(MirrorRetryMonitor, self).__init__(
+            _db, "Mirror retry monitor", interval_seconds,
+            batch_size=batch_size
+        )
+        self.mirror = mirror or S3Uploader()
+
+    def item_id_column(self):
+        return Representation.id
+
+    def item_query(self):
+        return self.representation_query()
+
+    def representation_query(self):
+        return self._db.query(Representation).filter(
+            Representation.mirror_exception != None).filter(
+            Representation.mirror_url != None)
+
+    def process_batch(self, representations):
+        self.mirror.mirror_batch(representations)
+        failures = [x for x in representations if x.mirror_exception]
+        self.log.log(
+            self.COMPLETION_LOG_LEVEL, "Mirrored %d/%d representations",
+            len(representations) - len(failures), len(representations)
+        )
 
 
 class CustomListEntryLicensePoolUpdateMonitor(CustomListEntrySweepMonitor):
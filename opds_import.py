@@ -2,11 +2,21 @@ from nose.tools import set_trace
 from StringIO import StringIO
 from collections import (
     defaultdict,
+    deque,
     Counter,
 )
 import datetime
+import dateutil.parser
+import dateutil.tz
 import feedparser
+import hashlib
+import json
 import logging
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import tempfile
+import threading
 import traceback
 import urllib
 from urlparse import urlparse, urljoin
@@ -16,6 +26,7 @@ from lxml import builder, etree
 
 from monitor import Monitor
 from util import LanguageCodes
+from util.content_store import ContentStore
 from util.xmlparser import XMLParser
 from config import (
     Configuration,
@@ -29,6 +40,7 @@ from metadata_layer import (
     LinkData,
     MeasurementData,
     SubjectData,
+    LinkMirrorQueue,
     ReplacementPolicy,
 )
 from model import (
@@ -180,6 +192,7 @@ class OPDSXMLParser(XMLParser):
                    "opds": "http://opds-spec.org/2010/catalog",
                    "schema" : "http://schema.org/",
                    "atom" : "http://www.w3.org/2005/Atom",
+                   "bibframe" : "http://bibframe.org/vocab/",
     }
 
 
@@ -194,13 +207,17 @@ class OPDSImporter(object):
 
     :param mirror: Use this MirrorUploader object to mirror all
     incoming open-access books and cover images.
+
+    :param mirror_threads: Fetch up to this many books and cover
+    images at once while mirroring them.
     """
 
     COULD_NOT_CREATE_LICENSE_POOL = (
         "No existing license pool for this identifier and no way of creating one.")
    
     def __init__(self, _db, data_source_name=DataSource.METADATA_WRANGLER,
-                 identifier_mapping=None, mirror=None, http_get=None):
+                 identifier_mapping=None, mirror=None, http_get=None,
+                 mirror_threads=None):
         self._db = _db
         self.log = logging.getLogger("OPDS Importer")
         self.data_source_name = data_source_name
@@ -208,11 +225,24 @@ class OPDSImporter(object):
         self.metadata_client = SimplifiedOPDSLookup.from_config()
         self.mirror = mirror
         self.http_get = http_get
+        if mirror_threads is None:
+            if http_get:
+                # A custom http_get function may not be safe to call
+                # from several threads at once.
+                mirror_threads = 1
+            else:
+                mirror_threads = LinkMirrorQueue.DEFAULT_THREADS
+        self.mirror_threads = mirror_threads
 
 
     def import_from_feed(self, feed, even_if_no_author=False, 
                          immediately_presentation_ready=False,
-                         feed_url=None):
+                         feed_url=None, only_entries=None):
+        """Import every entry in an OPDS feed.
+
+        :param only_entries: If this is given, only entries whose
+        <id>s are in this set are imported.
+        """
 
         # Keep track of editions that were imported. Pools and works
         # for those editions may be looked up or created.
@@ -221,10 +251,21 @@ class OPDSImporter(object):
         works = {}
         # CoverageFailures that note business logic errors and non-success download statuses
         failures = {}
+        # Tracebacks for items that raised exceptions. These are turned
+        # into CoverageFailures at the end.
+        exceptions = {}
 
         # If parsing the overall feed throws an exception, we should address that before
         # moving on. Let the exception propagate.
-        metadata_objs, failures = self.extract_feed_data(feed, feed_url)
+        metadata_objs, failures = self.extract_feed_data(
+            feed, feed_url, only_entries
+        )
+
+        # Links that need to be mirrored are collected here and
+        # mirrored all at once, after the editions are created.
+        mirror_queue = None
+        if self.mirror:
+            mirror_queue = LinkMirrorQueue(threads=self.mirror_threads)
 
         # make editions.  if have problem, make sure associated pool and work aren't created.
         for key, metadata in metadata_objs.iteritems():
@@ -237,7 +278,8 @@ class OPDSImporter(object):
             try:
                 # Create an edition. This will also create a pool if there's circulation data.
                 edition = self.import_edition_from_metadata(
-                    metadata, even_if_no_author, immediately_presentation_ready
+                    metadata, even_if_no_author, immediately_presentation_ready,
+                    mirror_queue
                 )
                 if edition:
                     imported_editions[key] = edition
@@ -245,16 +287,33 @@ class OPDSImporter(object):
                 # Rather than scratch the whole import, treat this as a failure that only applies
                 # to this item.
                 self.log.error("Error importing an OPDS item", exc_info=e)
-                identifier, ignore = Identifier.parse_urn(self._db, key)
-                data_source = DataSource.lookup(self._db, self.data_source_name)
-                failure = CoverageFailure(identifier, traceback.format_exc(), data_source=data_source, transient=False)
-                failures[key] = failure
+                exceptions[key] = traceback.format_exc()
                 # clean up any edition might have created
                 if key in imported_editions:
                     del imported_editions[key]
                 # Move on to the next item, don't create a work.
                 continue
 
+        if mirror_queue:
+            keys_by_identifier = dict(
+                (edition.primary_identifier, key)
+                for key, edition in imported_editions.items()
+            )
+            for identifier, exc_info in mirror_queue.mirror_all():
+                key = keys_by_identifier.get(identifier)
+                if key is None:
+                    continue
+                data_source = DataSource.lookup(self._db, self.data_source_name)
+                failure = CoverageFailure(
+                    identifier,
+                    "".join(traceback.format_exception(*exc_info)),
+                    data_source=data_source, transient=False
+                )
+                failures[key] = failure
+                # Don't create a work for this item.
+                del imported_editions[key]
+
+        for key, edition in imported_editions.items():
             try:
                 pool, work = self.update_work_for_edition(
                     edition, even_if_no_author, immediately_presentation_ready
@@ -264,19 +323,31 @@ class OPDSImporter(object):
                 if work:
                     works[key] = work
             except Exception, e:
-                identifier, ignore = Identifier.parse_urn(self._db, key)
-                data_source = DataSource.lookup(self._db, self.data_source_name)
-                failure = CoverageFailure(identifier, traceback.format_exc(), data_source=data_source, transient=False)
-                failures[key] = failure
+                exceptions[key] = traceback.format_exc()
+
+        if exceptions:
+            identifiers, ignore = Identifier.parse_urns(
+                self._db, exceptions.keys()
+            )
+            data_source = DataSource.lookup(self._db, self.data_source_name)
+            for key, exception in exceptions.items():
+                failures[key] = CoverageFailure(
+                    identifiers.get(key), exception, data_source=data_source,
+                    transient=False
+                )
 
         return imported_editions.values(), pools.values(), works.values(), failures
 
 
     def import_edition_from_metadata(
-            self, metadata, even_if_no_author, immediately_presentation_ready
+            self, metadata, even_if_no_author, immediately_presentation_ready,
+            mirror_queue=None
     ):
         """ For the passed-in Metadata object, see if can find or create an Edition 
             in the database.  Do not set the edition's pool or work, yet.
+
+        :param mirror_queue: If this is a LinkMirrorQueue, links will be
+        added to it rather than mirrored immediately.
         """
 
         # Locate or create an Edition for this book.
@@ -291,6 +362,7 @@ class OPDSImporter(object):
             even_if_not_apparently_updated=True,
             mirror=self.mirror,
             http_get=self.http_get,
+            mirror_queue=mirror_queue,
         )
         metadata.apply(
             edition, self.metadata_client, replace=policy
@@ -322,42 +394,87 @@ class OPDSImporter(object):
         return pool, work
 
     @classmethod
-    def extract_next_links(self, feed):
-        parsed = feedparser.parse(feed)
-        feed = parsed['feed']
-        next_links = []
-        if feed and 'links' in feed:
-            next_links = [
-                link['href'] for link in feed['links'] 
-                if link['rel'] == 'next'
-            ]
-        return next_links
-        
+    def parse_feed(cls, feed):
+        """Parse an OPDS feed into an lxml tree, unless it's already
+        been parsed.
+        """
+        if isinstance(feed, etree._Element):
+            return feed
+        if isinstance(feed, unicode):
+            # lxml won't parse a unicode string with an encoding
+            # declaration.
+            feed = feed.encode("utf8")
+        return etree.parse(StringIO(feed)).getroot()
 
     @classmethod
-    def extract_last_update_dates(cls, feed):
-        parsed_feed = feedparser.parse(feed)
+    def extract_next_links(cls, feed):
+        """Find the rel="next" links of an OPDS feed.
+
+        :param feed: The feed document, or the root of its lxml tree.
+        """
+        parser = OPDSXMLParser()
         return [
-            cls.last_update_date_for_feedparser_entry(entry)
-            for entry in parsed_feed['entries']
+            unicode(href) for href in parser._xpath(
+                cls.parse_feed(feed),
+                "/atom:feed/atom:link[@rel='next']/@href"
+            )
         ]
 
+    @classmethod
+    def extract_last_update_dates(cls, feed):
+        """Find the ID and <updated> date of every entry in an OPDS
+        feed.
+
+        :param feed: The feed document, or the root of its lxml tree.
+        :return: A list of 2-tuples (id, naive UTC datetime).
+        """
+        parser = OPDSXMLParser()
+        dates = []
+        for entry in parser._xpath(
+                cls.parse_feed(feed), "/atom:feed/atom:entry"
+        ):
+            identifier = parser.text_of_optional_subtag(entry, 'atom:id')
+            if identifier:
+                identifier = identifier.strip()
+            updated = parser.text_of_optional_subtag(entry, 'atom:updated')
+            try:
+                updated = cls._parse_datetime(updated and updated.strip())
+            except ValueError:
+                # A date we can't understand is as good as no date.
+                updated = None
+            dates.append((identifier, updated))
+        return dates
 
-    def extract_feed_data(self, feed, feed_url=None):
+
+    def extract_feed_data(self, feed, feed_url=None, only_entries=None):
         """Turn an OPDS feed into lists of Metadata and CirculationData objects, 
         with associated messages and next_links.
+
+        :param only_entries: If this is given, Metadata is only created
+        for entries whose <id>s are in this set.
         """
         data_source = DataSource.lookup(self._db, self.data_source_name)
-        fp_metadata, fp_failures = self.extract_data_from_feedparser(feed=feed, data_source=data_source)
-        # gets: medium, measurements, links, contributors, etc.
-        xml_data_meta, xml_failures = self.extract_metadata_from_elementtree(
+        values, failures = self.extract_data_from_iterparse(
             feed, data_source=data_source, feed_url=feed_url
         )
 
+        # Look up the identifiers for every entry we're going to
+        # process, all at once.
+        ids = failures.keys() + [
+            id for id in values.keys()
+            if only_entries is None or id in only_entries
+        ]
+        identifiers, unparseable = Identifier.parse_urns(self._db, ids)
+        if unparseable:
+            raise ValueError(
+                "Could not turn %s into a recognized identifier." %
+                unparseable[0]
+            )
+
         # translate the id in failures to identifier.urn
         identified_failures = {}
-        for id, failure in fp_failures.items() + xml_failures.items():
-            external_identifier, ignore = Identifier.parse_urn(self._db, id)
+        for id, failure in failures.items():
+            external_identifier = identifiers[id]
             if self.identifier_mapping:
                 internal_identifier = self.identifier_mapping.get(
                     external_identifier, external_identifier)
@@ -368,8 +485,10 @@ class OPDSImporter(object):
         # Use one loop for both, since the id will be the same for both dictionaries.
         metadata = {}
         circulationdata = {}
-        for id, m_data_dict in fp_metadata.items():
-            external_identifier, ignore = Identifier.parse_urn(self._db, id)
+        for id, combined_meta in values.items():
+            if only_entries is not None and id not in only_entries:
+                continue
+            external_identifier = identifiers[id]
             if self.identifier_mapping:
                 internal_identifier = self.identifier_mapping.get(
                     external_identifier, external_identifier)
@@ -386,8 +505,6 @@ class OPDSImporter(object):
             )
 
             # form the Metadata object
-            xml_data_dict = xml_data_meta.get(id, {})
-            combined_meta = self.combine(m_data_dict, xml_data_dict)
             if combined_meta.get('data_source') is None:
                 combined_meta['data_source'] = self.data_source_name
             
@@ -396,14 +513,9 @@ class OPDSImporter(object):
             metadata[internal_identifier.urn] = Metadata(**combined_meta)
 
             # form the CirculationData that would correspond to this Metadata
-            c_data_dict = m_data_dict.get('circulation')
-
-            if c_data_dict:
-                circ_links_dict = {}
-                # extract just the links to pass to CirculationData constructor
-                if 'links' in xml_data_dict:
-                    circ_links_dict['links'] = xml_data_dict['links']
-                combined_circ = self.combine(c_data_dict, circ_links_dict)
+            combined_circ = combined_meta.get('circulation')
+
+            if combined_circ:
                 if combined_circ.get('data_source') is None:
                     combined_circ['data_source'] = self.data_source_name
             
@@ -446,6 +558,240 @@ class OPDSImporter(object):
         return new_dict
 
 
+    @classmethod
+    def extract_data_from_iterparse(cls, feed, data_source, feed_url=None):
+        """Parse an OPDS feed in a single pass.
+
+        This gives the same results as combining the output of
+        extract_data_from_feedparser() and
+        extract_metadata_from_elementtree(), but the feed is only
+        parsed once, and each <entry> is thrown away as soon as we're
+        done with it, so the whole document is never in memory.
+
+        :return: A 2-tuple (values, failures). `values` maps IDs to
+        dictionaries that can be used as keyword arguments to the
+        Metadata constructor.
+        """
+        values = {}
+        failures = {}
+        parser = OPDSXMLParser()
+        atom = parser.NAMESPACES['atom']
+        feed_tag = '{%s}feed' % atom
+        entry_tag = '{%s}entry' % atom
+        link_tag = '{%s}link' % atom
+        message_tag = '{%s}message' % parser.NAMESPACES['simplified']
+
+        if isinstance(feed, unicode):
+            # iterparse() can only read bytes.
+            feed = feed.encode("utf8")
+        for event, tag in etree.iterparse(
+                StringIO(feed), events=('end',),
+                tag=(entry_tag, link_tag, message_tag)
+        ):
+            parent = tag.getparent()
+            if parent is None or parent.tag != feed_tag:
+                # This tag is inside an <entry> or a <message>, and
+                # will be handled along with it.
+                continue
+
+            if tag.tag == link_tag:
+                # Some OPDS feeds (eg Standard Ebooks) contain
+                # relative urls, so we need the feed's self URL to
+                # extract links. The self link comes before the
+                # entries, so we'll have it by the time we need it.
+                if not feed_url and tag.get('rel') == 'self':
+                    feed_url = tag.get('href')
+            elif tag.tag == message_tag:
+                # Turn a Simplified <message> tag into a CoverageFailure.
+                message = cls.extract_message(parser, tag)
+                failure = cls.coveragefailure_from_message(
+                    data_source, message
+                )
+                if failure:
+                    failures[failure.obj.urn] = failure
+            else:
+                identifier, detail, failure = cls.data_detail_for_entry(
+                    parser, tag, data_source, feed_url
+                )
+                if identifier:
+                    if failure:
+                        failures[identifier] = failure
+                    elif detail:
+                        values[identifier] = detail
+                else:
+                    logging.error(
+                        "Tried to parse an element without a valid identifier."
+                    )
+
+            # We're done with this tag and everything that came
+            # before it.
+            tag.clear()
+            while tag.getprevious() is not None:
+                del parent[0]
+        return values, failures
+
+    @classmethod
+    def data_detail_for_entry(cls, parser, entry_tag, data_source,
+                              feed_url=None):
+        """Turn an <atom:entry> tag into a dictionary of data that can be
+        used as keyword arguments to the Metadata constructor.
+
+        :return: A 3-tuple (identifier, kwargs for Metadata constructor, failure)
+        """
+        identifier = parser._xpath1(entry_tag, 'atom:id')
+        if identifier is None or not identifier.text:
+            return None, None, None
+        identifier = identifier.text.strip()
+
+        try:
+            data = cls._data_detail_for_elementtree_entry(
+                parser, entry_tag, data_source
+            )
+            detail = cls._detail_for_elementtree_entry(
+                parser, entry_tag, feed_url
+            )
+            circulation = data.get('circulation')
+            if circulation:
+                circulation['links'].extend(detail['links'])
+            return identifier, cls.combine(data, detail), None
+        except Exception, e:
+            _db = Session.object_session(data_source)
+            identifier_obj, ignore = Identifier.parse_urn(_db, identifier)
+            failure = CoverageFailure(
+                identifier_obj, traceback.format_exc(), data_source,
+                transient=True
+            )
+            return identifier, None, failure
+
+    # How the 'type' attribute of an Atom text construct translates
+    # into a media type.
+    ATOM_TEXT_MEDIA_TYPES = {
+        'text' : 'text/plain',
+        'html' : 'text/html',
+        'xhtml' : 'application/xhtml+xml',
+    }
+
+    # Descriptions of these types are run through an HTML sanitizer.
+    SANITIZED_MEDIA_TYPES = ('text/html', 'application/xhtml+xml')
+
+    @classmethod
+    def _data_detail_for_elementtree_entry(cls, parser, entry_tag,
+                                           metadata_data_source):
+        """Extract the information from an <atom:entry> tag that
+        _data_detail_for_feedparser_entry would extract from a
+        feedparser entry.
+        """
+        def text(*paths):
+            for path in paths:
+                value = parser.text_of_optional_subtag(entry_tag, path)
+                if value:
+                    return value.strip()
+            return None
+
+        title = text('atom:title', 'dc:title')
+        if title == OPDSFeed.NO_TITLE:
+            title = None
+        subtitle = text('schema:alternativeHeadline')
+
+        # See _data_detail_for_feedparser_entry for why a book might
+        # have a different data source for its circulation data.
+        circulation_data_source = metadata_data_source
+        distribution_tag = parser._xpath1(entry_tag, 'bibframe:distribution')
+        if distribution_tag is not None:
+            circulation_data_source_name = distribution_tag.get(
+                '{%s}ProviderName' % parser.NAMESPACES['bibframe']
+            )
+            if circulation_data_source_name:
+                _db = Session.object_session(metadata_data_source)
+                circulation_data_source = DataSource.lookup(
+                    _db, circulation_data_source_name
+                )
+                if not circulation_data_source:
+                    raise ValueError(
+                        "Unrecognized circulation data source: %s" % (
+                            circulation_data_source_name
+                        )
+                    )
+        last_opds_update = cls._parse_datetime(
+            text('atom:updated', 'dcterms:modified', 'dc:date')
+        )
+        publisher = text('dc:publisher', 'dcterms:publisher')
+        language = text('dc:language', 'dcterms:language')
+
+        links = []
+        for path in ('atom:summary', 'atom:content'):
+            for tag in parser._xpath(entry_tag, path):
+                link = cls.extract_description(tag)
+                if link:
+                    links.append(link)
+
+        rights = text('atom:rights', 'dc:rights') or ""
+        rights_uri = RightsStatus.rights_uri_from_string(rights)
+
+        kwargs_meta = dict(
+            title=title,
+            subtitle=subtitle,
+            language=language,
+            publisher=publisher,
+            links=links,
+            # refers to when was updated in opds feed, not our db
+            data_source_last_updated=last_opds_update,
+        )
+
+        # Only add circulation data if both the book's distributor *and*
+        # the source of the OPDS feed are lendable data sources.
+        if (circulation_data_source and circulation_data_source.offers_licenses
+            and metadata_data_source.offers_licenses):
+            kwargs_circ = dict(
+                data_source=circulation_data_source.name,
+                links=list(links),
+                default_rights_uri=rights_uri,
+            )
+            kwargs_meta['circulation'] = kwargs_circ
+        return kwargs_meta
+
+    @classmethod
+    def extract_description(cls, tag):
+        """Turn an <atom:summary> or <atom:content> tag into a LinkData
+        for the book's description.
+        """
+        type = tag.get('type', 'text')
+        media_type = cls.ATOM_TEXT_MEDIA_TYPES.get(type, type)
+        if media_type == 'application/xhtml+xml':
+            # The content is an XHTML <div>; we want what's inside it.
+            container = tag
+            if len(tag) == 1 and etree.QName(tag[0]).localname == 'div':
+                container = tag[0]
+            content = (container.text or '') + "".join(
+                [etree.tostring(child, encoding=unicode)
+                 for child in container]
+            )
+        else:
+            content = tag.text
+        if not content or not content.strip():
+            return None
+        if media_type in cls.SANITIZED_MEDIA_TYPES:
+            # Markup from a remote feed may contain scripts or event
+            # handlers. Clean it up the same way feedparser would.
+            content = feedparser._sanitizeHTML(content, 'utf-8', media_type)
+            if isinstance(content, str):
+                content = content.decode("utf8")
+        return LinkData(
+            rel=Hyperlink.DESCRIPTION,
+            media_type=media_type,
+            content=content.strip(),
+        )
+
+    @classmethod
+    def _parse_datetime(cls, value):
+        """Turn a date from an OPDS feed into a naive UTC datetime."""
+        if not value:
+            return None
+        value = dateutil.parser.parse(value)
+        if value.tzinfo:
+            value = value.astimezone(dateutil.tz.tzutc()).replace(tzinfo=None)
+        return value
+
     @classmethod
     def extract_data_from_feedparser(cls, feed, data_source):
         feedparser_parsed = feedparser.parse(feed)
@@ -667,33 +1013,37 @@ class OPDSImporter(object):
         """
         path = '/atom:feed/simplified:message'
         for message_tag in parser._xpath(feed_tag, path):
+            yield cls.extract_message(parser, message_tag)
 
-            # First thing to do is determine which Identifier we're
-            # talking about.
-            identifier_tag = parser._xpath1(message_tag, 'atom:id')
-            if identifier_tag is None:
-                urn = None
-            else:
-                urn = identifier_tag.text
+    @classmethod
+    def extract_message(cls, parser, message_tag):
+        """Turn a <simplified:message> tag into an OPDSMessage."""
+        # First thing to do is determine which Identifier we're
+        # talking about.
+        identifier_tag = parser._xpath1(message_tag, 'atom:id')
+        if identifier_tag is None:
+            urn = None
+        else:
+            urn = identifier_tag.text
 
-            # What status code is associated with the message?
-            status_code_tag = parser._xpath1(message_tag, 'simplified:status_code')
-            if status_code_tag is None:
+        # What status code is associated with the message?
+        status_code_tag = parser._xpath1(message_tag, 'simplified:status_code')
+        if status_code_tag is None:
+            status_code = None
+        else:
+            try:
+                status_code = int(status_code_tag.text)
+            except ValueError:
                 status_code = None
-            else:
-                try:
-                    status_code = int(status_code_tag.text)
-                except ValueError:
-                    status_code = None
-
-            # What is the human-readable message?
-            description_tag = parser._xpath1(message_tag, 'schema:description')
-            if description_tag is None:
-                description = ''
-            else:
-                description = description_tag.text
-        
-            yield OPDSMessage(urn, status_code, description)
+
+        # What is the human-readable message?
+        description_tag = parser._xpath1(message_tag, 'schema:description')
+        if description_tag is None:
+            description = ''
+        else:
+            description = description_tag.text
+    
+        return OPDSMessage(urn, status_code, description)
     
     @classmethod
     def coveragefailures_from_messages(cls, data_source, parser, feed_tag):
@@ -1005,20 +1355,197 @@ class OPDSImporter(object):
             return None
 
 
+class FeedPagePrefetcher(object):
+    """Fetch the pages of an OPDS feed ahead of the page being checked.
+
+    As soon as a page comes in, the pages it links to are fetched in
+    other threads, so that while one page is being checked against the
+    database the next ones are already on their way. No more than
+    `lookahead` pages are fetched ahead of time, and fetched pages are
+    kept on disk in a ContentStore, not in memory.
+
+    Only the fetching happens in other threads. Nothing here touches
+    the database.
+    """
+
+    def __init__(self, get, extract_next_links, store, lookahead=2):
+        """Constructor.
+
+        :param get: A function with the same signature as
+        OPDSImportMonitor._get.
+        :param extract_next_links: A function that finds the next
+        links in a page.
+        :param store: A ContentStore to keep fetched pages in.
+        :param lookahead: The most pages to fetch ahead of time. If
+        this is zero, pages are only fetched when asked for.
+        """
+        self._get = get
+        self.extract_next_links = extract_next_links
+        self.store = store
+        self.lookahead = lookahead
+        self.pending = {}
+        self.deferred = []
+        self.requested = set()
+        self.spilled = set()
+        self.closed = False
+        self.lock = threading.Lock()
+        self.pool = None
+        if lookahead > 0:
+            self.pool = ThreadPool(lookahead)
+
+    def _fetch(self, link):
+        status_code, headers, content = self._get(link, None)
+        content_hash = self.store.put(content)
+        next_links = self.extract_next_links(content)
+        with self.lock:
+            self.spilled.add(content_hash)
+        self.prefetch(next_links)
+        return status_code, headers, content_hash
+
+    def prefetch(self, links):
+        """Start fetching pages in the background, as long as that
+        doesn't put us more than `lookahead` pages ahead. Pages that
+        would put us too far ahead are fetched once there's room.
+        """
+        with self.lock:
+            if not self.pool or self.closed:
+                return
+            links = self.deferred + list(links)
+            self.deferred = []
+            for link in links:
+                if link in self.requested:
+                    continue
+                if len(self.pending) >= self.lookahead:
+                    self.deferred.append(link)
+                    continue
+                self.requested.add(link)
+                self.pending[link] = self.pool.apply_async(
+                    self._fetch, (link,)
+                )
+
+    def get(self, url, headers=None):
+        """Get a page, waiting for it to finish downloading if it's
+        already been requested.
+
+        This has the same signature as OPDSImportMonitor._get, so it
+        can be passed into OPDSImportMonitor.follow_one_link.
+        """
+        with self.lock:
+            result = self.pending.pop(url, None)
+            self.requested.add(url)
+        if result:
+            # If the fetch raised an exception, it's raised again here.
+            status_code, headers, content_hash = result.get()
+        else:
+            status_code, headers, content_hash = self._fetch(url)
+
+        # There's room for one more page now.
+        self.prefetch([])
+        return status_code, headers, self.store.get(content_hash)
+
+    def close(self, keep=()):
+        """Stop fetching pages, and delete every page that was
+        fetched, except the ones in `keep`.
+
+        :param keep: The content hashes of the pages that are still
+        needed.
+        """
+        with self.lock:
+            self.closed = True
+            self.pending = {}
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+        for content_hash in self.spilled - set(keep):
+            self.store.delete(content_hash)
+
+
+class OPDSImportCheckpoint(object):
+    """How far an OPDSImportMonitor has gotten through a feed.
+
+    The checkpoint is saved after every page is crawled and after
+    every page is imported, so that if the import is interrupted, the
+    next run picks up where this one stopped.
+    """
+
+    def __init__(self, path, feed_url):
+        self.path = path
+        self.feed_url = feed_url
+
+        # The (link, content hash, new entry <id>s) of every page
+        # that needs to be imported, in the order they were found.
+        self.pages = []
+
+        # Links that still need to be crawled, and links that already
+        # have been.
+        self.queue = [feed_url]
+        self.seen = []
+        self.crawled = False
+
+        # How many pages, counting from the end, have been imported.
+        self.imported = 0
+
+    @classmethod
+    def load(cls, path, feed_url):
+        """Load the checkpoint for a feed, or start a new one."""
+        checkpoint = cls(path, feed_url)
+        if os.path.exists(path):
+            with open(path) as fh:
+                data = json.load(fh)
+            if data.get('feed_url') == feed_url:
+                checkpoint.pages = [tuple(x) for x in data['pages']]
+                checkpoint.queue = data['queue']
+                checkpoint.seen = data['seen']
+                checkpoint.crawled = data['crawled']
+                checkpoint.imported = data['imported']
+        return checkpoint
+
+    def save(self):
+        data = dict(
+            feed_url=self.feed_url, pages=self.pages, queue=self.queue,
+            seen=self.seen, crawled=self.crawled, imported=self.imported,
+        )
+        # Write to a temporary file and rename it into place, so a
+        # crash never leaves a partial checkpoint behind.
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        with os.fdopen(fd, 'w') as out:
+            json.dump(data, out)
+        os.rename(temp_path, self.path)
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
 class OPDSImportMonitor(Monitor):
 
     """Periodically monitor an OPDS archive feed and import every edition
     it mentions.
     """
-    
+
+    # How many pages of the feed to fetch ahead of the one being checked.
+    DEFAULT_LOOKAHEAD = 2
+
     def __init__(self, _db, feed_url, default_data_source, import_class, 
                  interval_seconds=0, keep_timestamp=False,
-                 immediately_presentation_ready=False, force_reimport=False):
-
+                 immediately_presentation_ready=False, force_reimport=False,
+                 lookahead=DEFAULT_LOOKAHEAD, work_directory=None):
+        """Constructor.
+
+        :param work_directory: Where to keep fetched pages and the
+        checkpoint for this feed. Defaults to the configured OPDS
+        import directory. If that isn't set either, a temporary
+        directory is used for each run, and an interrupted import
+        starts over from scratch.
+        """
         self.feed_url = feed_url
         self.importer = import_class(_db, default_data_source)
         self.force_reimport = force_reimport
         self.immediately_presentation_ready = immediately_presentation_ready
+        self.lookahead = lookahead
+        self.work_directory = (
+            work_directory or Configuration.opds_import_directory()
+        )
         super(OPDSImportMonitor, self).__init__(
             _db, "OPDS Import %s" % feed_url, interval_seconds,
             keep_timestamp=keep_timestamp, default_start_time=Monitor.NEVER
@@ -1043,40 +1570,66 @@ class OPDSImportMonitor(Monitor):
         return response.status_code, response.headers, response.content
 
     def check_for_new_data(self, feed):
-        """Check if the feed contains any entries that haven't been imported
-        yet. If force_import is set, every entry in the feed is
-        treated as new.
+        """Find the entries in the feed that haven't been imported yet,
+        or have changed since they were imported. If force_import is
+        set, every entry in the feed is treated as new.
+
+        Identifiers and CoverageRecords are looked up for the whole
+        feed at once, and nothing is created in the database.
+
+        :param feed: The feed document, or the root of its lxml tree.
+        :return: A set of entry <id>s.
         """
+        last_update_dates = self.importer.extract_last_update_dates(feed)
 
         # If force_reimport is set, we don't even need to check. Always
         # treat the feed as though it contained new data.
         if self.force_reimport:
-            return True
+            return set(urn for urn, ignore in last_update_dates)
 
-        last_update_dates = self.importer.extract_last_update_dates(feed)
+        # We'll find out what's wrong with any unparseable entries
+        # when we try to import them.
+        identifiers, unparseable = Identifier.parse_urns(
+            self._db, [urn for urn, ignore in last_update_dates],
+            autocreate=False
+        )
+        new_data = set(unparseable)
 
-        new_data = False
-        for identifier, remote_updated in last_update_dates:
+        records = {}
+        if identifiers:
+            data_source = DataSource.lookup(
+                self._db, self.importer.data_source_name
+            )
+            qu = self._db.query(CoverageRecord).filter(
+                CoverageRecord.identifier_id.in_(
+                    [x.id for x in identifiers.values()]
+                )
+            ).filter(
+                CoverageRecord.data_source==data_source
+            ).filter(
+                CoverageRecord.operation==CoverageRecord.IMPORT_OPERATION
+            )
+            for record in qu:
+                records[record.identifier_id] = record
 
-            identifier, ignore = Identifier.parse_urn(self._db, identifier)
-            data_source = DataSource.lookup(self._db, self.importer.data_source_name)
+        for urn, remote_updated in last_update_dates:
+            if urn in new_data:
+                continue
+            identifier = identifiers.get(urn)
             record = None
-
             if identifier:
-                record = CoverageRecord.lookup(
-                    identifier, data_source, operation=CoverageRecord.IMPORT_OPERATION
-                )
+                record = records.get(identifier.id)
 
             # If there was a transient failure last time we tried to
             # import this book, try again regardless of whether the
             # feed has changed.
             if record and record.status == CoverageRecord.TRANSIENT_FAILURE:
-                new_data = True
+                new_data.add(urn)
                 self.log.info(
                     "Counting %s as new because previous attempt resulted in transient failure: %s", 
-                    record.identifier, record.exception
+                    urn, record.exception
                 )
-                break
+                continue
 
             # If our last attempt was a success or a persistent
             # failure, we only want to import again if something
@@ -1089,56 +1642,68 @@ class OPDSImportMonitor(Monitor):
                 if not remote_updated:
                     # The remote isn't telling us whether the entry
                     # has been updated. Import it again to be safe.
-                    new_data = True
+                    new_data.add(urn)
                     self.log.info(
                         "Counting %s as new because remote has no information about when it was updated.", 
-                        record.identifier
+                        urn
                     )
-                    break
-
-                if remote_updated >= record.timestamp:
+                elif remote_updated >= record.timestamp:
                     # This book has been updated.
                     self.log.info(
                         "Counting %s as new because its coverage date is %s and remote has %s.", 
-                        record.identifier, record.timestamp, remote_updated
+                        urn, record.timestamp, remote_updated
                     )
-
-                    new_data = True
-                    break
+                    new_data.add(urn)
 
             else:
                 # There's no record of an attempt to import this book.
                 self.log.info(
                     "Counting %s as new because it has no CoverageRecord.", 
-                    identifier
+                    urn
                 )
-                new_data = True
-                break
+                new_data.add(urn)
         return new_data
 
     def follow_one_link(self, link, do_get=None):
+        """Fetch a page of the feed and see what's new on it.
+
+        :return: A 3-tuple (next_links, feed, new_entries). If nothing
+        on the page is new, there's no need to import it or look at
+        the next page, and this is ([], None, set()).
+        """
         self.log.info("Following next link: %s", link)
         get = do_get or self._get
         status_code, content_type, feed = get(link, None)
 
-        new_data = self.check_for_new_data(feed)
+        # Parse the page once for both the dates and the links.
+        root = self.importer.parse_feed(feed)
+        new_data = self.check_for_new_data(root)
 
         if new_data:
             # There's something new on this page, so we need to check
             # the next page as well.
-            next_links = self.importer.extract_next_links(feed)
-            return next_links, feed
+            next_links = self.importer.extract_next_links(root)
+            return next_links, feed, new_data
         else:
             # There's nothing new, so we don't need to import this
             # feed or check the next page.
             self.log.info("No new data.")
-            return [], None
+            return [], None, set()
+
+    def import_one_feed(self, feed, feed_url=None, new_entries=None):
+        """Import the entries in a page of the feed that are new or
+        have changed.
 
-    def import_one_feed(self, feed, feed_url=None):
+        :param new_entries: The <id>s of those entries, as found by
+        check_for_new_data() when the page was crawled. If this isn't
+        provided, the page is checked again.
+        """
+        if new_entries is None:
+            new_entries = self.check_for_new_data(feed)
         imported_editions, pools, works, failures = self.importer.import_from_feed(
             feed, even_if_no_author=True,
             immediately_presentation_ready = self.immediately_presentation_ready,
-            feed_url=feed_url
+            feed_url=feed_url, only_entries=new_entries
         )
 
         data_source = DataSource.lookup(self._db, self.importer.data_source_name)
@@ -1155,32 +1720,102 @@ class OPDSImportMonitor(Monitor):
             failure.to_coverage_record(operation=CoverageRecord.IMPORT_OPERATION)
         
     def run_once(self, ignore1, ignore2):
-        feeds = []
-        queue = [self.feed_url]
-        seen_links = set([])
-        
-        # First, follow the feed's next links until we reach a page with
-        # nothing new. If any link raises an exception, nothing will be imported.
-        while queue:
-            new_queue = []
-
-            for link in queue:
+        if self.work_directory:
+            directory = self.work_directory
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        else:
+            directory = tempfile.mkdtemp()
+        try:
+            store = ContentStore(os.path.join(directory, "pages"))
+            checkpoint = OPDSImportCheckpoint.load(
+                self.checkpoint_path(directory), self.feed_url
+            )
+            if checkpoint.crawled:
+                self.log.info(
+                    "Resuming import after %d/%d pages.",
+                    checkpoint.imported, len(checkpoint.pages)
+                )
+            else:
+                self.crawl(checkpoint, store)
+            if self.stop_running:
+                return
+            self.import_pages(checkpoint, store)
+            if self.stop_running:
+                return
+
+            # Everything has been imported; we don't need the pages
+            # or the checkpoint anymore.
+            for link, content_hash, ignore in checkpoint.pages:
+                store.delete(content_hash)
+            checkpoint.delete()
+        finally:
+            if not self.work_directory:
+                shutil.rmtree(directory)
+
+    def checkpoint_path(self, directory):
+        name = hashlib.sha256(self.feed_url.encode("utf8")).hexdigest()
+        return os.path.join(directory, name + ".json")
+
+    def crawl(self, checkpoint, store):
+        """Follow the feed's next links until we reach a page with
+        nothing new.
+
+        Pages are fetched ahead of time, so that network latency
+        overlaps with checking each page against the database. If any
+        link raises an exception, nothing will be imported, but the
+        next run will pick up the crawl where this one stopped.
+        """
+        prefetcher = FeedPagePrefetcher(
+            self._get, self.importer.extract_next_links, store,
+            self.lookahead
+        )
+        queue = deque(checkpoint.queue)
+        seen_links = set(checkpoint.seen)
+        try:
+            while queue:
+                if self.stop_running:
+                    return
+                link = queue.popleft()
                 if link in seen_links:
                     continue
-                next_links, feed = self.follow_one_link(link)
-                new_queue.extend(next_links)
+                next_links, feed, new_entries = self.follow_one_link(
+                    link, do_get=prefetcher.get
+                )
+                queue.extend(next_links)
                 if feed:
-                    feeds.append((link, feed))
+                    checkpoint.pages.append(
+                        (link, store.put(feed), sorted(new_entries))
+                    )
                 seen_links.add(link)
-
-            queue = new_queue
-
+                checkpoint.queue = list(queue)
+                checkpoint.seen = list(seen_links)
+                checkpoint.save()
+        finally:
+            prefetcher.close(keep=[x[1] for x in checkpoint.pages])
+        checkpoint.crawled = True
+        checkpoint.save()
+
+    def import_pages(self, checkpoint, store):
+        """Import the pages found by crawl(), saving the checkpoint
+        after each one.
+        """
         # Start importing at the end. If something fails, it will be easier to
         # pick up where we left off.
-        for link, feed in reversed(feeds):
+        pages = checkpoint.pages
+        while checkpoint.imported < len(pages):
+            if self.stop_running:
+                return
+            link, content_hash, new_entries = pages[
+                len(pages) - 1 - checkpoint.imported
+            ]
             self.log.info("Importing next feed: %s", link)
-            self.import_one_feed(feed, link)
+            self.import_one_feed(
+                store.get(content_hash), link, set(new_entries)
+            )
             self._db.commit()
+            checkpoint.imported += 1
+            checkpoint.save()
 
 
 class OPDSImporterWithS3Mirror(OPDSImporter):
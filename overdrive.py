@@ -23,6 +23,7 @@ from model import (
     Hyperlink,
     Identifier,
     Measurement,
+    RateLimit,
     Representation,
     Subject,
 )
@@ -100,6 +101,9 @@ class OverdriveAPI(object):
    
     def __init__(self, _db, testing=False):
         self._db = _db
+        self.rate_limiter = RateLimit.limiter_for(
+            _db, Configuration.OVERDRIVE_INTEGRATION
+        )
 
         # Set some stuff from environment variables
         self.testing = testing
@@ -181,9 +185,11 @@ class OverdriveAPI(object):
 
     def get(self, url, extra_headers, exception_on_401=False):
         """Make an HTTP GET request using the active Bearer Token."""
-        headers = dict(Authorization="Bearer %s" % self.token)
-        headers.update(extra_headers)
-        status_code, headers, content = self._do_get(url, headers)
+        request_headers = dict(Authorization="Bearer %s" % self.token)
+        request_headers.update(extra_headers)
+        status_code, headers, content = self.rate_limiter.request(
+            lambda: self._do_get(url, request_headers)
+        )
         if status_code == 401:
             if exception_on_401:
                 # This is our second try. Give up.
@@ -287,14 +293,19 @@ class OverdriveAPI(object):
             for i in page_inventory:
                 yield i
 
-    def metadata_lookup(self, identifier):
+    def metadata_lookup(self, identifier, exception_on_401=False):
         """Look up metadata for an Overdrive identifier.
+
+        :param exception_on_401: If the Bearer Token has expired, raise
+        BadResponseException instead of refreshing it.
         """
         url = self.METADATA_ENDPOINT % dict(
             collection_token=self.collection_token,
             item_id=identifier.identifier
         )
-        status_code, headers, content = self.get(url, {})
+        status_code, headers, content = self.get(
+            url, {}, exception_on_401=exception_on_401
+        )
         return json.loads(content)
 
     def metadata_lookup_obj(self, identifier):
@@ -894,8 +905,20 @@ class OverdriveBibliographicCoverageProvider(BibliographicCoverageProvider):
             batch_size=10, metadata_replacement_policy=metadata_replacement_policy, **kwargs
         )
 
-    def process_item(self, identifier):
-        info = self.api.metadata_lookup(identifier)
+    # Metadata lookups happen in several threads at once.
+    FETCH_THREADS = 5
+
+    def fetch_item(self, identifier):
+        # Refreshing the Bearer Token means using the database, so if
+        # it's expired, leave that for process_fetched_item().
+        try:
+            return self.api.metadata_lookup(identifier, exception_on_401=True)
+        except BadResponseException, e:
+            return None
+
+    def process_fetched_item(self, identifier, info):
+        if info is None:
+            info = self.api.metadata_lookup(identifier)
         error = None
         if info.get('errorCode') == 'NotFound':
             error = "ID not recognized by Overdrive: %s" % identifier.identifier
@@ -1,7 +1,28 @@
 from nose.tools import set_trace
 from cStringIO import StringIO
+from collections import (
+    Counter,
+    namedtuple,
+)
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from lxml import etree
+from sqlalchemy.orm.session import Session
 import tinys3
+from tinys3.multipart_upload import MultipartUpload
+from tinys3.request_factory import (
+    InitiateMultipartUploadRequest,
+    XML_PARSE_STRING,
+)
+import hashlib
 import os
+import sys
+import threading
+import time
 from urlparse import urlsplit
 import urllib
 from util.mirror import MirrorUploader
@@ -11,18 +32,85 @@ from config import Configuration
 from requests.exceptions import (
     ConnectionError, 
     HTTPError,
+    Timeout,
 )
 
+# A file that's about to be uploaded to S3 as the mirror of
+# `representation`. `content_hash` is the SHA-256 hash of the bytes
+# to be uploaded.
+S3Upload = namedtuple(
+    "S3Upload",
+    ["representation", "bucket", "remote_filename", "media_type", "size",
+     "content_hash"]
+)
+
+
 class S3Uploader(MirrorUploader):
 
-    def __init__(self, access_key=None, secret_key=None, pool=None):
-        if pool:
-            self.pool = pool
+    log = logging.getLogger("S3 uploader")
+
+    # Upload no more than this many files at once.
+    MAX_IN_FLIGHT = 5
+
+    # Don't start an upload that would put more than this many bytes
+    # in flight, unless nothing else is in flight.
+    MEMORY_BUDGET = 100 * 1024 * 1024
+
+    # Files bigger than this are uploaded in parts of PART_SIZE
+    # bytes. S3 won't accept a part smaller than 5 MiB, except for
+    # the last one.
+    MULTIPART_THRESHOLD = 16 * 1024 * 1024
+    PART_SIZE = 8 * 1024 * 1024
+
+    # A request that fails with a connection error, or with one of
+    # these status codes, is retried this many times, waiting
+    # BACKOFF_FACTOR seconds, then twice that, and so on.
+    MAX_RETRIES = 3
+    BACKOFF_FACTOR = 1
+    RETRY_STATUS_CODES = [500, 502, 503, 504]
+
+    # Content is hashed this many bytes at a time.
+    HASH_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, access_key=None, secret_key=None, connection=None,
+                 max_in_flight=None, memory_budget=None,
+                 multipart_threshold=None, part_size=None,
+                 max_retries=None, backoff_factor=None):
+        if connection:
+            self.connection = connection
+            integration = {}
         else:
             integration = Configuration.integration(Configuration.S3_INTEGRATION)
             access_key = access_key or integration[Configuration.S3_ACCESS_KEY]
             secret_key = secret_key or integration[Configuration.S3_SECRET_KEY]
-            self.pool = tinys3.Pool(access_key, secret_key)
+            self.connection = S3Connection(access_key, secret_key)
+
+        def setting(value, key, default):
+            if value is None:
+                value = integration.get(key, default)
+            return value
+        self.max_in_flight = int(setting(
+            max_in_flight, Configuration.S3_MAX_UPLOADS_IN_FLIGHT,
+            self.MAX_IN_FLIGHT
+        ))
+        self.memory_budget = int(setting(
+            memory_budget, Configuration.S3_UPLOAD_MEMORY_BUDGET,
+            self.MEMORY_BUDGET
+        ))
+        self.multipart_threshold = int(setting(
+            multipart_threshold, Configuration.S3_MULTIPART_THRESHOLD,
+            self.MULTIPART_THRESHOLD
+        ))
+        self.part_size = int(setting(
+            part_size, Configuration.S3_MULTIPART_PART_SIZE, self.PART_SIZE
+        ))
+        self.max_retries = int(setting(
+            max_retries, Configuration.S3_MAX_RETRIES, self.MAX_RETRIES
+        ))
+        self.backoff_factor = float(setting(
+            backoff_factor, Configuration.S3_BACKOFF_FACTOR,
+            self.BACKOFF_FACTOR
+        ))
 
     S3_HOSTNAME = "s3.amazonaws.com"
     S3_BASE = "http://%s/" % S3_HOSTNAME
@@ -127,65 +215,367 @@ class S3Uploader(MirrorUploader):
         return self.mirror_batch([representation])
 
     def mirror_batch(self, representations):
-        """Mirror a bunch of Representations at once."""
-        filehandles = []
-        requests = []
-        representations_by_response_url = dict()
+        """Mirror a bunch of Representations at once.
+
+        Content that has already been mirrored is not uploaded again;
+        the Representation is pointed at the existing copy instead.
+
+        Uploads run in a pool of worker threads. No more than
+        `max_in_flight` uploads happen at once, and an upload is held
+        back if it would push the number of bytes in flight over
+        `memory_budget`. Large files are uploaded in parts. All the
+        database work happens in this thread.
+
+        A Representation that can't be mirrored is left with its
+        `mirror_exception` set, so that MirrorRetryMonitor can try it
+        again later.
+        """
+        uploads = []
         for representation in representations:
-            if not representation.mirror_url:
-                representation.mirror_url = representation.url
-            # Turn the mirror URL into an s3.amazonaws.com URL.
-            bucket, filename = self.bucket_and_filename(
-                representation.mirror_url
+            upload = self._prepare_upload(representation)
+            if upload:
+                uploads.append(upload)
+        uploads, duplicates = self._deduplicate(uploads)
+
+        executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        in_flight = dict()
+        in_flight_bytes = 0
+        try:
+            for upload in uploads:
+                if upload.size > self.multipart_threshold:
+                    # Only one part is read into memory at a time.
+                    cost = self.part_size
+                else:
+                    cost = upload.size
+
+                # Wait for some uploads to finish before starting
+                # another one.
+                while in_flight and (
+                        len(in_flight) >= self.max_in_flight
+                        or in_flight_bytes + cost > self.memory_budget):
+                    done, not_done = wait(
+                        in_flight.keys(), return_when=FIRST_COMPLETED
+                    )
+                    for future in done:
+                        in_flight_bytes -= self._finish_upload(
+                            future, *in_flight.pop(future)
+                        )
+
+                # The content is only opened once it's about to be
+                # uploaded, so no more than `max_in_flight` files are
+                # open at once.
+                fh = upload.representation.external_content()
+                if fh is None:
+                    self._no_content(upload.representation)
+                    continue
+                future = executor.submit(
+                    self.upload, upload.bucket, upload.remote_filename,
+                    fh, upload.media_type, upload.size
+                )
+                in_flight[future] = (upload, fh, cost)
+                in_flight_bytes += cost
+
+            for future in as_completed(in_flight.keys()):
+                self._finish_upload(future, *in_flight.pop(future))
+        finally:
+            executor.shutdown()
+
+        for representation, original in duplicates:
+            self._use_mirrored_copy(representation, original)
+
+    def _no_content(self, representation):
+        representation.mirrored_at = None
+        representation.mirror_exception = (
+            u"No content to mirror for %s" % representation.url
+        )
+
+    def _prepare_upload(self, representation):
+        """Find out where and how to upload a Representation.
+
+        The content is hashed and measured, then closed again; it's
+        reopened when it's time to upload it.
+
+        :return: An S3Upload, or None if there's nothing to upload.
+        """
+        if not representation.mirror_url:
+            representation.mirror_url = representation.url
+        bucket, remote_filename = self.bucket_and_filename(
+            representation.mirror_url
+        )
+        fh = representation.external_content()
+        if fh is None:
+            self._no_content(representation)
+            return None
+
+        # Hash the content while finding out how big it is.
+        content_hash = hashlib.sha256()
+        size = 0
+        try:
+            while True:
+                data = fh.read(self.HASH_CHUNK_SIZE)
+                if not data:
+                    break
+                content_hash.update(data)
+                size += len(data)
+        finally:
+            fh.close()
+        return S3Upload(
+            representation, bucket, remote_filename,
+            representation.external_media_type, size,
+            unicode(content_hash.hexdigest())
+        )
+
+    # Content that's mirrored in more than one place is kept under
+    # this prefix, named after its hash. Nothing but those exact
+    # bytes is ever written to one of these keys, so it's safe for
+    # any number of Representations to share it.
+    CONTENT_ADDRESSED_PREFIX = "sha256/"
+
+    @classmethod
+    def content_addressed_url(cls, bucket, content_hash, media_type):
+        """The URL to the shared copy of some content.
+
+        S3 keeps one media type per key, so the same bytes served as
+        two different media types get two keys.
+        """
+        from model import Representation
+        path = "%s%s/%s%s" % (
+            cls.CONTENT_ADDRESSED_PREFIX,
+            urllib.quote(media_type or "unknown"), content_hash,
+            Representation._extension(media_type)
+        )
+        return cls.url(bucket, path)
+
+    def _deduplicate(self, uploads):
+        """Weed out uploads of content that's already been mirrored,
+        or that's going to be mirrored as part of this batch.
+
+        Content that turns up more than once is uploaded to its
+        content-addressed URL, and every Representation with that
+        content shares the one copy. A Representation's own mirror
+        URL may be overwritten with different content later, so it's
+        never shared.
+
+        :return: A 2-tuple (uploads, duplicates). `duplicates` is a
+        list of (representation, original) 2-tuples, where `original`
+        is the Representation whose mirrored copy `representation`
+        should use.
+        """
+        from model import Representation
+        if not uploads:
+            return uploads, []
+        shared_urls = [
+            self.content_addressed_url(
+                x.bucket, x.content_hash, x.media_type
+            ) for x in uploads
+        ]
+        _db = Session.object_session(uploads[0].representation)
+        if _db:
+            shared = Representation.mirrored_to(_db, shared_urls)
+            mirrored = Representation.mirrored_copies(
+                _db, [x.content_hash for x in uploads]
+            )
+        else:
+            shared = {}
+            mirrored = {}
+
+        counts = Counter((x.content_hash, x.media_type) for x in uploads)
+        unique = []
+        duplicates = []
+        for upload, shared_url in zip(uploads, shared_urls):
+            representation = upload.representation
+            original = shared.get(shared_url)
+            if original:
+                duplicates.append((representation, original))
+                continue
+
+            key = (upload.content_hash, upload.media_type)
+            elsewhere = mirrored.get(key)
+            if (counts[key] > 1
+                or (elsewhere and elsewhere is not representation)
+                or upload.remote_filename.startswith(
+                    self.CONTENT_ADDRESSED_PREFIX)):
+                # This content is in more than one place, or the
+                # Representation is pointed at some other content's
+                # shared copy. Upload it to its own shared copy.
+                representation.mirror_url = shared_url
+                bucket, remote_filename = self.bucket_and_filename(
+                    shared_url
+                )
+                upload = upload._replace(
+                    bucket=bucket, remote_filename=remote_filename
+                )
+                shared[shared_url] = representation
+            unique.append(upload)
+        return unique, duplicates
+
+    def _use_mirrored_copy(self, representation, original):
+        """Point a Representation at the shared mirrored copy of its
+        content.
+        """
+        if not original.mirrored_at or original.mirror_exception:
+            # The upload we were counting on failed.
+            representation.mirrored_at = None
+            representation.mirror_exception = original.mirror_exception
+            return
+        if representation.mirror_url != original.mirror_url:
+            self.log.info("ALREADY MIRRORED %s => %s",
+                          representation.mirror_url, original.mirror_url)
+        representation.mirror_url = original.mirror_url
+        representation.mirror_content_hash = original.mirror_content_hash
+        representation.set_as_mirrored()
+
+    def _finish_upload(self, future, upload, fh, cost):
+        """Record the outcome of an upload.
+
+        :return: The number of bytes no longer in flight.
+        """
+        representation = upload.representation
+        fh.close()
+        exception = future.exception()
+        if exception:
+            self.log.error(
+                "Could not mirror %s: %r", representation.mirror_url,
+                exception
             )
-            response_url = self.url(bucket, filename)
-            representations_by_response_url[response_url] = (
-                representation)
-            media_type = representation.external_media_type
-            fh = representation.external_content()
-            bucket, remote_filename = self.bucket_and_filename(
-                representation.mirror_url)
-            filehandles.append(fh)
-            request = self.pool.upload(
-                remote_filename, fh, bucket=bucket,
-                content_type=media_type
+            representation.mirrored_at = None
+            representation.mirror_exception = "%s: %s" % (
+                exception.__class__.__name__, exception
             )
-            requests.append(request)
-        # Do the upload.
-
-        def process_response(response):
-            representation = representations_by_response_url[response.url]
-            if response.status_code == 200:
-                source = representation.local_content_path
-                if representation.url != representation.mirror_url:
-                    source = representation.url
-                if source:
-                    logging.info("MIRRORED %s => %s",
-                                 source, representation.mirror_url)
-                else:
-                    logging.info("MIRRORED %s", representation.mirror_url)
-                representation.set_as_mirrored()
+            return cost
+
+        response = future.result()
+        if response.status_code == 200:
+            source = representation.local_content_path
+            if representation.url != representation.mirror_url:
+                source = representation.url
+            if source:
+                self.log.info("MIRRORED %s => %s",
+                              source, representation.mirror_url)
             else:
-                representation.mirrored_at = None
-                representation.mirror_exception = "Status code %d: %s" % (
-                    response.status_code, response.content)
+                self.log.info("MIRRORED %s", representation.mirror_url)
+            representation.mirror_content_hash = upload.content_hash
+            representation.set_as_mirrored()
+        else:
+            representation.mirrored_at = None
+            representation.mirror_exception = "Status code %d: %s" % (
+                response.status_code, response.content)
+        return cost
+
+    def upload(self, bucket, remote_filename, fh, media_type, size):
+        """Upload a file to S3, retrying transient failures.
+
+        This is called from a worker thread, so it must not touch the
+        database.
 
+        :return: The response to the last request made.
+        """
+        if size > self.multipart_threshold:
+            return self.multipart_upload(
+                bucket, remote_filename, fh, media_type
+            )
+        return self._with_retries(
+            self.connection.upload, remote_filename, fh, bucket=bucket,
+            content_type=media_type
+        )
+
+    def multipart_upload(self, bucket, remote_filename, fh, media_type):
+        """Upload a file to S3 one part at a time."""
+        upload = self._with_retries(
+            self.connection.initiate_multipart_upload, remote_filename,
+            bucket=bucket, content_type=media_type
+        )
         try:
-            for response in self.pool.as_completed(requests):
-                process_response(response)
-        except ConnectionError, e:
-            # This is a transient error; we can just try again.
-            logging.error("S3 connection error: %r", e, exc_info=e)
-            pass
-        except HTTPError, e:
-            # Probably also a transient error. In any case
-            # there's nothing we can do about it but try again.
-            logging.error("S3 HTTP error: %r", e, exc_info=e)
-            pass
-
-        # Close the filehandles
-        for fh in filehandles:
-            fh.close()
+            part_num = 0
+            while True:
+                data = fh.read(self.part_size)
+                if part_num and not data:
+                    break
+                part_num += 1
+                self._with_retries(
+                    upload.upload_part_from_file, StringIO(data), part_num
+                )
+                if len(data) < self.part_size:
+                    break
+            return self._with_retries(upload.complete_upload)
+        except Exception, e:
+            exc_info = sys.exc_info()
+            try:
+                upload.cancel_upload()
+            except Exception, cancel_exception:
+                self.log.error(
+                    "Could not cancel multipart upload of %s: %r",
+                    remote_filename, cancel_exception
+                )
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    @classmethod
+    def is_transient(cls, exception):
+        """Is this the sort of exception that might go away if we
+        try again?
+        """
+        if isinstance(exception, (ConnectionError, Timeout)):
+            return True
+        if isinstance(exception, HTTPError):
+            response = exception.response
+            return (response is None
+                    or response.status_code in cls.RETRY_STATUS_CODES)
+        return False
+
+    def _with_retries(self, method, *args, **kwargs):
+        """Call `method`, retrying with exponential backoff if it
+        fails with a transient error.
+        """
+        attempt = 0
+        while True:
+            try:
+                return method(*args, **kwargs)
+            except Exception, e:
+                if attempt >= self.max_retries or not self.is_transient(e):
+                    raise
+                delay = self.backoff_factor * (2 ** attempt)
+                self.log.warn(
+                    "S3 error, retrying in %.1fs: %r", delay, e
+                )
+                time.sleep(delay)
+                attempt += 1
+
+
+class S3Connection(tinys3.Connection):
+    """A tinys3 Connection whose multipart uploads create publicly
+    readable files with the right media type, the same as
+    single-request uploads.
+    """
+
+    def initiate_multipart_upload(self, key, bucket=None, content_type=None,
+                                  public=True):
+        upload = MultipartUpload(self, bucket, key)
+        request = InitiatePublicMultipartUploadRequest(
+            self, upload.key, upload.bucket, content_type, public
+        )
+        upload.uploadId = self.run(request)
+        return upload
+
+
+class InitiatePublicMultipartUploadRequest(InitiateMultipartUploadRequest):
+
+    def __init__(self, conn, key, bucket, content_type=None, public=True):
+        super(InitiatePublicMultipartUploadRequest, self).__init__(
+            conn, key, bucket
+        )
+        self.headers = {}
+        if content_type:
+            self.headers['Content-Type'] = content_type
+        if public:
+            self.headers['x-amz-acl'] = 'public-read'
+
+    def run(self):
+        url = self.bucket_url(self.key, self.bucket)
+        r = self.adapter().post(url, auth=self.auth, headers=self.headers)
+        r.raise_for_status()
+        root = etree.fromstring(r.content)
+        return root.find(XML_PARSE_STRING.format('UploadId')).text
+
 
 class DummyS3Uploader(S3Uploader):
     """A dummy uploader for use in tests."""
@@ -219,33 +609,70 @@ class DummyS3Uploader(S3Uploader):
                 representation.set_as_mirrored()
 
 class MockS3Response(object):
-    def __init__(self, url):
+    def __init__(self, url, status_code=200, content=""):
         self.url = url
+        self.status_code = status_code
+        self.content = content
+
+class MockS3Connection(object):
+    """This connection lets us test the real S3Uploader class against a
+    local stand-in for S3.
 
-class MockS3Pool(object):
-    """This pool lets us test the real S3Uploader class with a mocked-up S3
-    pool.
+    Exceptions put in `failures` are raised, one per request, before
+    any more requests succeed. A None in `failures` lets one request
+    through.
     """
 
     def __init__(self):
         self.uploads = []
-        self.in_progress = []
-        self.n = 0
+        self.failures = []
+        self.requests = 0
+        self.cancelled = []
+        self.lock = threading.Lock()
+
+    def request(self):
+        """Count a request, and fail it if we've been told to."""
+        with self.lock:
+            self.requests += 1
+            if self.failures:
+                failure = self.failures.pop(0)
+                if failure:
+                    raise failure
 
     def upload(self, remote_filename, fh, bucket=None, content_type=None,
                **kwargs):
+        self.request()
         self.uploads.append((remote_filename, fh.read(), bucket, content_type, 
                              kwargs))
-        # TODO: Instead of generating a fake URL we should be able to
-        # generate the same URL the s3 module would generate in this
-        # situation. Without this, we can't properly test the code at the
-        # end of mirror_batch which calls process_response.
-        response = MockS3Response("http://s3/%s" % self.n)
-        self.n += 1
-        self.in_progress = []
-        return response
-
-    def as_completed(self, requests):
-        for i in self.in_progress:
-            yield i
-        self.in_progress = []
+        return MockS3Response(S3Uploader.url(bucket, remote_filename))
+
+    def initiate_multipart_upload(self, key, bucket=None, content_type=None,
+                                  public=True):
+        self.request()
+        return MockMultipartUpload(self, key, bucket, content_type)
+
+class MockMultipartUpload(object):
+
+    def __init__(self, connection, key, bucket, content_type):
+        self.connection = connection
+        self.key = key
+        self.bucket = bucket
+        self.content_type = content_type
+        self.parts = {}
+
+    def upload_part_from_file(self, fp, part_num, **kwargs):
+        self.connection.request()
+        self.parts[part_num] = fp.read()
+        return MockS3Response(S3Uploader.url(self.bucket, self.key))
+
+    def complete_upload(self):
+        self.connection.request()
+        content = "".join(self.parts[i] for i in sorted(self.parts))
+        self.connection.uploads.append(
+            (self.key, content, self.bucket, self.content_type,
+             dict(parts=len(self.parts)))
+        )
+        return MockS3Response(S3Uploader.url(self.bucket, self.key))
+
+    def cancel_upload(self):
+        self.connection.cancelled.append(self.key)
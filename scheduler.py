@@ -0,0 +1,268 @@
+"""Run many Monitors and CoverageProviders from one long-lived process."""
+from nose.tools import set_trace
+import logging
+import random
+import signal
+import threading
+import time
+from sqlalchemy.sql import text
+
+
+class JobLocks(object):
+    """Postgres advisory locks that keep two processes from running
+    the same job at once.
+
+    Whatever runs a job -- the Scheduler, RunMonitorScript or
+    RunCoverageProviderScript -- takes the lock on the job's name
+    first, and skips the job if some other process holds it.
+
+    Advisory locks belong to a database connection, and a session
+    may hand its connection back to the pool whenever it commits, so
+    the locks are taken on a connection of their own.
+    """
+
+    def __init__(self, _db):
+        self._db = _db
+        self._connection = None
+
+    def _execute(self, sql, **params):
+        if self._connection is None:
+            self._connection = self._db.get_bind().engine.connect()
+        # Commit right away, so the connection is never left idle
+        # in a transaction. Advisory locks outlive the transaction.
+        statement = text(sql).execution_options(autocommit=True)
+        return self._connection.execute(statement, **params).scalar()
+
+    def lock(self, name):
+        """Try to take the lock on a job's name.
+
+        :return: True if we got the lock, False if some other process
+        holds it.
+        """
+        return self._execute(
+            "select pg_try_advisory_lock(hashtext(:name))", name=name
+        )
+
+    def unlock(self, name):
+        """Release the lock on a job's name.
+
+        :return: True if the lock was held, False otherwise.
+        """
+        return self._execute(
+            "select pg_advisory_unlock(hashtext(:name))", name=name
+        )
+
+    def close(self):
+        """Release any locks and the connection that holds them."""
+        if self._connection is None:
+            return
+        try:
+            self._execute("select pg_advisory_unlock_all()")
+        finally:
+            self._connection.close()
+            self._connection = None
+
+
+class ScheduledJob(object):
+    """Something the Scheduler runs every so often.
+
+    This can be a Monitor, a CoverageProvider, or anything else with a
+    `service_name` and a `run()` method.
+    """
+
+    def __init__(self, runnable, interval_seconds=None):
+        self.runnable = runnable
+        self.name = runnable.service_name
+        if interval_seconds is None:
+            interval_seconds = getattr(
+                runnable, 'interval_seconds',
+                Scheduler.DEFAULT_INTERVAL_SECONDS
+            )
+        self.interval_seconds = interval_seconds
+        self.next_run = None
+        self.running = False
+
+        # How the job has been doing.
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.total_time = 0
+        self.max_time = 0
+        self.last_time = None
+        self.last_exception = None
+
+    def stop(self):
+        """Ask the job to wind down as soon as it can."""
+        if hasattr(self.runnable, 'stop_running'):
+            self.runnable.stop_running = True
+
+    def record(self, elapsed, exception=None):
+        self.runs += 1
+        self.total_time += elapsed
+        self.last_time = elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.last_exception = exception
+        if exception:
+            self.failures += 1
+
+    def summary(self):
+        """Summarize the job's run times."""
+        if not self.runs:
+            return "%s: never run, %d skipped." % (self.name, self.skipped)
+        return "%s: %d runs, %d failures, %d skipped. Last run %.2fs, average %.2fs, longest %.2fs." % (
+            self.name, self.runs, self.failures, self.skipped,
+            self.last_time, self.total_time/self.runs, self.max_time
+        )
+
+
+class Scheduler(object):
+    """Run a number of jobs, each one every `interval_seconds`, in a
+    single process with a single database session.
+
+    Jobs run one at a time, on the thread that called run(). A job
+    that takes a long time -- such as an IdentifierSweepMonitor
+    sweeping the whole table -- holds up every other job until it's
+    done, so give jobs like that a process of their own (for
+    instance, one RunSweepMonitorShardScript per shard) rather than
+    scheduling them here.
+
+    If a job takes longer than its interval, its next run starts when
+    it's done, rather than piling up. A job that's already running
+    in another Scheduler, or from RunMonitorScript or
+    RunCoverageProviderScript (say, from cron), is skipped; see
+    JobLocks.
+    """
+
+    DEFAULT_INTERVAL_SECONDS = 600
+
+    # Each interval is stretched or shrunk by up to this fraction, so
+    # jobs with the same interval don't all run at once.
+    JITTER = 0.1
+
+    log = logging.getLogger("Scheduler")
+
+    def __init__(self, _db, runnables=[], jitter=JITTER, clock=time.time):
+        self._db = _db
+        self.jitter = jitter
+        self.clock = clock
+        self.jobs = []
+        self.current_job = None
+        self.stopping = threading.Event()
+        self.locks = JobLocks(_db)
+        for runnable in runnables:
+            self.add(runnable)
+
+    def add(self, runnable, interval_seconds=None):
+        """Schedule a job.
+
+        The first run happens at some random point during the job's
+        first interval, so that jobs don't all start at once.
+        """
+        job = ScheduledJob(runnable, interval_seconds)
+        job.next_run = self.clock() + (
+            random.uniform(0, self.jitter) * job.interval_seconds
+        )
+        self.jobs.append(job)
+        return job
+
+    def next_interval(self, job):
+        return job.interval_seconds * random.uniform(
+            1 - self.jitter, 1 + self.jitter
+        )
+
+    def run(self):
+        """Run jobs until shutdown() is called or the process is told to
+        stop.
+        """
+        self.stopping.clear()
+        old_handlers = dict()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            old_handlers[signum] = signal.signal(signum, self._handle_signal)
+        self.log.info("Scheduling %d jobs.", len(self.jobs))
+        try:
+            while not self.stopping.is_set():
+                self.run_pending()
+                to_sleep = self.time_until_next_run()
+                if to_sleep > 0:
+                    # Wake up right away if we're told to shut down.
+                    self.stopping.wait(to_sleep)
+        finally:
+            for signum, handler in old_handlers.items():
+                signal.signal(signum, handler)
+            self.close()
+            for job in self.jobs:
+                self.log.info(job.summary())
+
+    def _handle_signal(self, signum, frame):
+        self.log.info("Got signal %d, shutting down.", signum)
+        self.shutdown()
+
+    def shutdown(self):
+        """Stop scheduling jobs, and ask the current job to stop as soon
+        as it can.
+        """
+        self.stopping.set()
+        job = self.current_job
+        if job:
+            job.stop()
+
+    def time_until_next_run(self):
+        if not self.jobs:
+            return self.DEFAULT_INTERVAL_SECONDS
+        return min(job.next_run for job in self.jobs) - self.clock()
+
+    def run_pending(self):
+        """Run every job that's due, most overdue first."""
+        due = [job for job in self.jobs if job.next_run <= self.clock()]
+        for job in sorted(due, key=lambda x: x.next_run):
+            if self.stopping.is_set():
+                break
+            self.run_job(job)
+
+    def run_job(self, job):
+        """Run a job once, unless it's already running somewhere."""
+        if job.running or not self.lock(job):
+            self.log.info("%s is already running, skipping.", job.name)
+            job.skipped += 1
+            job.next_run = self.clock() + self.next_interval(job)
+            return
+
+        job.running = True
+        self.current_job = job
+        start = self.clock()
+        exception = None
+        try:
+            job.runnable.run()
+        except Exception, e:
+            exception = e
+            self.log.error(
+                "Error running %s: %s", job.name, e, exc_info=e
+            )
+            self._db.rollback()
+        finally:
+            elapsed = self.clock() - start
+            job.record(elapsed, exception)
+            job.running = False
+            self.current_job = None
+            self.unlock(job)
+            # The next run is scheduled from the end of this one, so
+            # a slow job never overlaps with itself.
+            job.next_run = self.clock() + self.next_interval(job)
+        self.log.info("Ran %s in %.2fs.", job.name, elapsed)
+
+    def lock(self, job):
+        """Take the lock that keeps any other process from running the
+        same job at the same time.
+        """
+        return self.locks.lock(job.name)
+
+    def unlock(self, job):
+        """Release a job's lock.
+
+        :return: True if the lock was held, False otherwise.
+        """
+        return self.locks.unlock(job.name)
+
+    def close(self):
+        """Release any locks and the connection that holds them."""
+        self.locks.close()
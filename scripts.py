@@ -45,6 +45,10 @@ from opds_import import OPDSImportMonitor
 from util.opds_writer import OPDSFeed
 
 from monitor import SubjectAssignmentMonitor
+from scheduler import (
+    JobLocks,
+    Scheduler,
+)
 
 from overdrive import (
     OverdriveBibliographicCoverageProvider,
@@ -126,6 +130,22 @@ class Script(object):
         if not Configuration.instance:
             Configuration.load()
 
+    def run_exclusively(self, name, function):
+        """Call `function`, unless a job called `name` is already
+        running in some other process.
+
+        :return: True if `function` was called, False if it was skipped.
+        """
+        locks = JobLocks(self._db)
+        try:
+            if not locks.lock(name):
+                self.log.info("%s is already running, skipping.", name)
+                return False
+            function()
+            return True
+        finally:
+            locks.close()
+
 
 class RunMonitorScript(Script):
 
@@ -136,7 +156,83 @@ class RunMonitorScript(Script):
         self.name = self.monitor.service_name
 
     def do_run(self):
-        self.monitor.run()
+        self.run_exclusively(self.name, self.monitor.run)
+
+
+class RunSweepMonitorShardScript(Script):
+    """Run one shard of an IdentifierSweepMonitor, or report on how
+    far each shard has gotten.
+
+    Running this script once for each shard sweeps all the shards
+    at the same time.
+    """
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '--shards', help='Split the sweep into this many shards.',
+            type=int, required=True
+        )
+        parser.add_argument(
+            '--shard',
+            help='Run this shard, counting from zero. If this is not given, report on the progress of every shard.',
+            type=int
+        )
+        return parser
+
+    def __init__(self, monitor, _db=None, cmd_args=None, **kwargs):
+        super(RunSweepMonitorShardScript, self).__init__(_db)
+        args = self.parse_command_line(self._db, cmd_args)
+        if callable(monitor):
+            monitor = monitor(self._db, **kwargs)
+        self.monitor = monitor
+        self.name = self.monitor.service_name
+        self.shards = args.shards
+        self.shard = args.shard
+
+    def do_run(self, output=sys.stdout):
+        if self.shard is not None:
+            self.monitor.shard(self.shard, self.shards)
+            self.monitor.run()
+            return
+
+        for progress in self.monitor.shard_progress(self.shards):
+            if progress.end is None:
+                id_range = "%d-" % progress.start
+            else:
+                id_range = "%d-%d" % (progress.start, progress.end)
+            if progress.fraction is None:
+                status = "not sweeping"
+            else:
+                status = "%.1f%% done, ETA %s" % (
+                    progress.fraction * 100, progress.eta
+                )
+            output.write("Shard %d (IDs %s): %s\n" % (
+                progress.index, id_range, status
+            ))
+
+
+class RunSchedulerScript(Script):
+    """Run a number of monitors and coverage providers, each on its own
+    schedule, in one long-lived process.
+    """
+
+    def __init__(self, runnables, _db=None):
+        """Constructor.
+
+        :param runnables: A list of Monitors and CoverageProviders, or
+        of classes to be instantiated with a database session.
+        """
+        super(RunSchedulerScript, self).__init__(_db)
+        self.scheduler = Scheduler(self._db)
+        for runnable in runnables:
+            if callable(runnable):
+                runnable = runnable(self._db)
+            self.scheduler.add(runnable)
+
+    def do_run(self):
+        self.scheduler.run()
 
 
 class RunCoverageProvidersScript(Script):
@@ -253,10 +349,12 @@ class IdentifierInputScript(Script):
         if not identifier_type:
             raise ValueError("No identifier type specified!")
         identifiers = []
+        found = Identifier.for_foreign_ids(
+            _db, [(identifier_type, arg) for arg in arguments],
+            autocreate=autocreate
+        )
         for arg in arguments:
-            identifier, ignore = Identifier.for_foreign_id(
-                _db, identifier_type, arg, autocreate=autocreate
-            )
+            identifier = found.get((identifier_type, arg))
             if not identifier:
                 logging.warn(
                     "Could not load identifier %s/%s", identifier_type, arg
@@ -297,6 +395,11 @@ class RunCoverageProviderScript(IdentifierInputScript):
             '--cutoff-time', 
             help='Update existing coverage records if they were originally created after this time.'
         )
+        parser.add_argument(
+            '--claim-items',
+            help='Claim each batch of items before covering it, so that several copies of this script can run at once.',
+            action='store_true'
+        )
         return parser
 
     @classmethod
@@ -327,6 +430,8 @@ class RunCoverageProviderScript(IdentifierInputScript):
                 cutoff_time=args.cutoff_time,
                 **kwargs
             )
+        if args.claim_items:
+            provider.claim_items = True
         self.provider = provider
         self.name = self.provider.service_name
         self.identifiers = args.identifiers
@@ -347,8 +452,12 @@ class RunCoverageProviderScript(IdentifierInputScript):
     def do_run(self):
         if self.identifiers:
             self.provider.run_on_specific_identifiers(self.identifiers)
-        else:
+        elif getattr(self.provider, 'claim_items', False):
+            # Claiming items is how several copies of this provider
+            # run at once, so don't keep them out.
             self.provider.run()
+        else:
+            self.run_exclusively(self.name, self.provider.run)
 
 
 class BibliographicRefreshScript(RunCoverageProviderScript):
@@ -470,8 +579,9 @@ class WorkProcessingScript(IdentifierInputScript):
         offset = 0
         while works:
             works = self.query.offset(offset).limit(self.batch_size).all()
-            for work in works:
-                self.process_work(work)
+            with WorkCoverageRecord.batch(self._db):
+                for work in works:
+                    self.process_work(work)
             offset += self.batch_size
             self._db.commit()
         self._db.commit()
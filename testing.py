@@ -275,7 +275,6 @@ class DatabaseTest(object):
             if not isinstance(genre, Genre):
                 genre, ignore = Genre.lookup(self._db, genre, autocreate=True)
             work.genres = [genre]
-        work.random = 0.5
 
         work.set_presentation_edition(presentation_edition)
         work.calculate_presentation_edition()
@@ -10,6 +10,7 @@ from nose.tools import (
     eq_,
     set_trace,
 )
+from sqlalchemy import event
 
 from . import (
     DatabaseTest,
@@ -116,6 +117,61 @@ class TestURNLookupController(DatabaseTest):
             self.controller.works
         )
 
+    def test_resolve_urns(self):
+        work = self._work(with_license_pool=True)
+        identifier = work.license_pools[0].identifier
+        invalid = "not even a URN"
+        self.controller.resolve_urns([identifier.urn, invalid])
+        eq_({identifier.urn : identifier, invalid : None},
+            self.controller.identifiers_by_urn)
+
+        # process_urn uses the identifiers that were already looked up.
+        self.controller.process_urn(invalid)
+        self.controller.process_urn(identifier.urn)
+        [message] = self.controller.precomposed_entries
+        eq_(400, message.status_code)
+        eq_([(identifier, work)], self.controller.works)
+
+    def count_queries(self, f, *args, **kwargs):
+        """Call a function and count the SQL statements it runs."""
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        connection = self._db.connection()
+        event.listen(connection, "before_cursor_execute", count)
+        try:
+            f(*args, **kwargs)
+        finally:
+            event.remove(connection, "before_cursor_execute", count)
+        return len(statements)
+
+    def test_process_urns(self):
+        def lookup(how_many):
+            works = [self._work(with_license_pool=True)
+                     for i in range(how_many)]
+            urns = [work.license_pools[0].identifier.urn for work in works]
+            urns.append("not even a URN")
+            self._db.commit()
+            self._db.expunge_all()
+
+            controller = URNLookupController(self._db)
+            queries = self.count_queries(controller.process_urns, urns)
+            eq_(how_many, len(controller.works))
+            eq_(1, len(controller.precomposed_entries))
+
+            # Everything we'd need to build the feed is already loaded.
+            def follow():
+                for identifier, work in controller.works:
+                    pool = identifier.licensed_through
+                    pool.presentation_edition.title
+                    work.presentation_edition.title
+                    work.simple_opds_entry
+            eq_(0, self.count_queries(follow))
+            return queries
+
+        # Looking up more URNs doesn't take more queries.
+        eq_(lookup(2), lookup(5))
+
     # Set up a mock Flask app for testing the controller methods.
     app = Flask(__name__)
     @app.route('/lookup')
@@ -70,6 +70,17 @@ class TestAxis360API(AxisTest):
         response = api.request("http://url/")
         eq_("The data", response.content)
 
+    def test_request_is_retried_when_throttled(self):
+        api = MockAxis360API(self._db)
+        slept = []
+        api.rate_limiter.sleep = slept.append
+        api.queue_response(429, headers={"Retry-After": "3"})
+        api.queue_response(200, content="The data")
+        response = api.request("http://url/")
+        eq_("The data", response.content)
+        eq_(2, len(api.requests))
+        eq_([3], slept)
+
     def test_refresh_bearer_token_error(self):
         """Raise an exception if we don't get a 200 status code when
         refreshing the bearer token.
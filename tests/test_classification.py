@@ -3,6 +3,8 @@
 from nose.tools import eq_, set_trace
 from . import DatabaseTest
 from collections import Counter
+import re
+import mock
 from psycopg2.extras import NumericRange
 from model import (
     Genre,
@@ -25,6 +27,9 @@ from classifier import (
     AgeClassifier,
     AgeOrGradeClassifier,
     InterestLevelClassifier,
+    Eg,
+    classification_cache,
+    match_kw,
     Axis360AudienceClassifier,
     WorkClassifier,
     fiction_genres,
@@ -98,6 +103,78 @@ class TestClassifier(object):
         eq_(17, u(14, "14+."))
         eq_(18, u(18, "18+"))
 
+class TestClassificationCache(object):
+
+    def test_classify_uses_cache(self):
+        classification_cache.clear()
+        subject = DummySubject("pets", "Pets")
+        with mock.patch.object(
+                Keyword, '_classify', wraps=Keyword._classify
+        ) as _classify:
+            first = Keyword.classify(subject)
+            second = Keyword.classify(subject)
+            eq_(first, second)
+            eq_(1, _classify.call_count)
+
+            # A subclass runs its own rules.
+            LCSH.classify(subject)
+            eq_(2, _classify.call_count)
+        eq_(classifier.Pets, first[0])
+
+    def test_rules_hash(self):
+        # The hash is stable.
+        eq_(LCSH.rules_hash(), LCSH.rules_hash())
+
+        # Each classifier has its own rules.
+        assert LCSH.rules_hash() != DDC.rules_hash()
+        assert LCSH.rules_hash() != FAST.rules_hash()
+
+    def test_rules_hash_covers_resource_files(self):
+        class Loader(Classifier):
+            RESOURCE_FILES = ["dewey_1000.json"]
+        Loader.__module__ = DDC.__module__
+        before = Loader.rules_hash()
+
+        # Changing the table a classifier loads changes its hash.
+        class Loader(Classifier):
+            RESOURCE_FILES = ["lcc_one_level.json"]
+        Loader.__module__ = DDC.__module__
+        assert before != Loader.rules_hash()
+
+    def test_rules_hash_covers_module(self):
+        # Changing anything in the module -- a module-level keyword
+        # table, or a classifier this one delegates to -- changes
+        # every classifier's hash.
+        before = AgeOrGradeClassifier.rules_hash()
+        try:
+            classifier._rules_hashes.clear()
+            with mock.patch.object(
+                    classifier.inspect, 'getsource',
+                    return_value="different rules"
+            ):
+                assert before != AgeOrGradeClassifier.rules_hash()
+
+            # If the source can't be read, RULES_VERSION stands in
+            # for it.
+            classifier._rules_hashes.clear()
+            with mock.patch.object(
+                    classifier.inspect, 'getsource', side_effect=IOError
+            ):
+                old_version = AgeOrGradeClassifier.rules_hash()
+                classifier._rules_hashes.clear()
+                with mock.patch.object(classifier, 'RULES_VERSION', 2):
+                    assert old_version != AgeOrGradeClassifier.rules_hash()
+        finally:
+            classifier._rules_hashes.clear()
+        eq_(before, AgeOrGradeClassifier.rules_hash())
+
+
+class DummySubject(object):
+    def __init__(self, identifier, name):
+        self.identifier = identifier
+        self.name = name
+
+
 class TestClassifierLookup(object):
 
     def test_lookup(self):
@@ -414,6 +491,29 @@ class TestLCSH(object):
         eq_(None, aud("Runaway children"))
         eq_(None, aud("Humor"))
 
+class TestMatchKeyword(object):
+
+    def test_examples_may_be_excluded(self):
+        pets = match_kw("pets", Eg("cats"))
+        eq_("pets", pets["search"]("pets / general").group())
+        eq_("cats", pets["search"]("cats").group())
+        eq_(None, pets["search"]("Cats", exclude_examples=True))
+
+        only_examples = match_kw(Eg("cats"))
+        eq_(None, only_examples["search"]("cats", exclude_examples=True))
+        eq_(None, match_kw()["search"]("cats"))
+
+    def test_regular_expression_compiled_once(self):
+        pets = match_kw("pets", Eg("cats"))
+        with mock.patch.object(
+                classifier.re, 'compile', wraps=re.compile
+        ) as compile:
+            for i in range(5):
+                pets["search"]("pets")
+                pets["search"]("pets", exclude_examples=True)
+            # One regular expression with the examples, one without.
+            eq_(2, compile.call_count)
+
 class TestKeyword(object):
     def genre(self, keyword):
         scrub = Keyword.scrub_identifier(keyword)
@@ -1,5 +1,9 @@
 import datetime
+import random
+import threading
+import time
 from nose.tools import (
+    assert_raises_regexp,
     set_trace,
     eq_,
 )
@@ -18,6 +22,7 @@ from testing import (
 )
 from model import (
     Contributor,
+    CoverageClaim,
     CoverageRecord,
     DataSource,
     Edition,
@@ -45,6 +50,33 @@ from coverage import (
     CoverageFailure,
 )
 
+class ConcurrentFetchCoverageProvider(CoverageProvider):
+    """Fetches data for its items in several threads at once."""
+
+    FETCH_THREADS = 3
+
+    def __init__(self, *args, **kwargs):
+        super(ConcurrentFetchCoverageProvider, self).__init__(*args, **kwargs)
+        self.fetch_threads_used = set()
+        self.process_threads_used = set()
+
+    def fetch_item(self, identifier):
+        self.fetch_threads_used.add(threading.current_thread().name)
+        if identifier.identifier == 'broken':
+            raise Exception("Could not fetch!")
+        # Make sure the fetches finish out of order.
+        time.sleep(random.random() / 100)
+        return identifier.identifier.upper()
+
+    def process_fetched_item(self, identifier, data):
+        self.process_threads_used.add(threading.current_thread().name)
+        if data == 'FAIL':
+            return CoverageFailure(
+                identifier, "Failed", data_source=self.output_source
+            )
+        return identifier
+
+
 class TestCoverageProvider(DatabaseTest):
 
     def setup(self):
@@ -335,6 +367,102 @@ class TestCoverageProvider(DatabaseTest):
         # attempted, then we process identifiers with transient failures.
         eq_([no_coverage, self.identifier], provider.attempts)
 
+    def test_run_once_pages_through_items_by_id(self):
+        # Here are three identifiers that need coverage.
+        i2 = self._identifier()
+        i3 = self._identifier()
+        identifiers = sorted([self.identifier, i2, i3], key=lambda x: x.id)
+
+        # This provider can never cover anything, so every identifier
+        # will keep showing up in items_that_need_coverage().
+        provider = TransientFailureCoverageProvider(
+            "Transient failure", self.input_identifier_types,
+            self.output_source, batch_size=2
+        )
+        count_as_covered = CoverageRecord.DEFAULT_COUNT_AS_COVERED
+
+        # But each batch picks up where the last one left off.
+        last_id = provider.run_once(0, count_as_covered)
+        eq_(identifiers[1].id, last_id)
+        last_id = provider.run_once(last_id, count_as_covered)
+        eq_(identifiers[2].id, last_id)
+        eq_(None, provider.run_once(last_id, count_as_covered))
+        eq_(identifiers, provider.attempts)
+
+    def test_run_once_with_claims(self):
+        i2 = self._identifier()
+        i3 = self._identifier()
+        identifiers = sorted([self.identifier, i2, i3], key=lambda x: x.id)
+
+        provider = AlwaysSuccessfulCoverageProvider(
+            "Always successful", self.input_identifier_types,
+            self.output_source
+        )
+        provider.claim_items = True
+
+        # Another worker is already covering one of the identifiers.
+        CoverageClaim.claim(
+            self._db, provider.service_name, [identifiers[1].id],
+            u"another worker", datetime.timedelta(hours=1)
+        )
+        # And a worker that crashed left a claim on another one, which
+        # has since expired.
+        CoverageClaim.claim(
+            self._db, provider.service_name, [identifiers[2].id],
+            u"crashed worker", datetime.timedelta(hours=-1)
+        )
+
+        eq_(identifiers[2].id, provider.run_once(0))
+
+        # The identifier claimed by the other worker was left alone.
+        covered = [
+            x for x in identifiers
+            if CoverageRecord.lookup(x, self.output_source)
+        ]
+        eq_([identifiers[0], identifiers[2]], covered)
+
+        # Our claims were released, and so was the expired one. The
+        # other worker's claim is still there.
+        [claim] = self._db.query(CoverageClaim).all()
+        eq_(identifiers[1].id, claim.item_id)
+        eq_(u"another worker", claim.worker)
+
+    def test_concurrent_fetch(self):
+        identifiers = []
+        for foreign_id in ['a', 'fail', 'b', 'c']:
+            identifier = self._identifier()
+            identifier.identifier = foreign_id
+            identifiers.append(identifier)
+        provider = ConcurrentFetchCoverageProvider(
+            "Concurrent", self.input_identifier_types, self.output_source
+        )
+        results = provider.process_batch(identifiers)
+
+        # Results come back in the original order, even though the
+        # items were fetched in several threads.
+        eq_(identifiers[0], results[0])
+        assert isinstance(results[1], CoverageFailure)
+        eq_(identifiers[2:], results[2:])
+        assert len(provider.fetch_threads_used) > 1
+        assert threading.current_thread().name not in provider.fetch_threads_used
+
+        # But the fetched data was processed in this thread.
+        eq_(set([threading.current_thread().name]),
+            provider.process_threads_used)
+
+    def test_concurrent_fetch_exception(self):
+        identifiers = [self._identifier(), self._identifier()]
+        identifiers[1].identifier = 'broken'
+        provider = ConcurrentFetchCoverageProvider(
+            "Concurrent", self.input_identifier_types, self.output_source
+        )
+        # An exception raised in a worker thread is raised here, just
+        # as it would be if the items were processed one at a time.
+        assert_raises_regexp(
+            Exception, "Could not fetch!", provider.process_batch,
+            identifiers
+        )
+
     def test_never_successful(self):
 
         # We start with no CoverageRecords and no Timestamp.
@@ -646,6 +774,7 @@ class TestWorkCoverageProvider(DatabaseTest):
         [record] = qu.all()
         eq_(self.work, record.work)
         eq_(self.operation, record.operation)
+        eq_([self.work], provider.attempts)
 
         # The timestamp is now set.
         [timestamp] = self._db.query(Timestamp).all()
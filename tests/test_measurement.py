@@ -9,6 +9,7 @@ from nose.tools import (
 from model import (
     DataSource,
     Measurement,
+    Work,
     get_one_or_create
 )
 
@@ -231,3 +232,54 @@ class TestMeasurement(DatabaseTest):
         eq_(0, w.quality)
         w.calculate_quality([], 0.4)
         eq_(0.4, w.quality)
+
+    def test_calculate_quality_for_works(self):
+        # This work has a popularity measurement for its primary
+        # identifier, and a rating for an equivalent identifier.
+        w1 = self._work(with_license_pool=True)
+        identifier = w1.license_pools[0].identifier
+        identifier.add_measurement(self.source, Measurement.POPULARITY, 59)
+        equivalent = self._identifier()
+        equivalent.add_measurement(self.source, Measurement.RATING, 8)
+        identifier.equivalent_to(self.source, equivalent, 1)
+
+        # This work has a quality measurement from the metadata wrangler.
+        w2 = self._work(with_license_pool=True)
+        wrangler = DataSource.lookup(self._db, DataSource.METADATA_WRANGLER)
+        w2.license_pools[0].identifier.add_measurement(
+            wrangler, Measurement.QUALITY, 0.3
+        )
+
+        # This work has no measurements at all.
+        w3 = self._work(with_license_pool=True)
+        works = [w1, w2, w3]
+
+        # Calculate each work's quality the normal way.
+        for work in works:
+            work.calculate_quality(work.all_identifier_ids(), 0.1)
+        expect = [work.quality for work in works]
+        eq_(0.3, w2.quality)
+        eq_(0.1, w3.quality)
+
+        # Calculating the qualities all at once gives the same results.
+        for work in works:
+            work.quality = None
+        Work.calculate_quality_for_works(self._db, works, 0.1)
+        eq_(expect, [work.quality for work in works])
+
+    def test_most_recent_for_identifiers(self):
+        identifier = self._identifier()
+        identifier.add_measurement(self.source, Measurement.POPULARITY, 6000)
+        identifier.add_measurement(self.source, Measurement.POPULARITY, 59)
+        identifier.add_measurement(self.source, "Some other quantity", 42)
+        identifier.add_measurement(self.source, Measurement.RATING, 8, 2)
+
+        results = Measurement.most_recent_for_identifiers(
+            self._db, [identifier.id], Measurement.QUALITY_QUANTITIES
+        )
+        eq_([identifier.id], results.keys())
+        eq_(
+            sorted([(Measurement.POPULARITY, 0.5, 1), 
+                    (Measurement.RATING, 7/9.0, 2)]),
+            sorted([tuple(x) for x in results[identifier.id]])
+        )
@@ -1,5 +1,6 @@
 from StringIO import StringIO
 from nose.tools import (
+    assert_raises_regexp,
     eq_,
     set_trace,
 )
@@ -16,6 +17,7 @@ from metadata_layer import (
     MeasurementData,
     FormatData,
     LinkData,
+    LinkMirrorQueue,
     Metadata,
     IdentifierData,
     ReplacementPolicy,
@@ -366,6 +368,152 @@ class TestMetadataImporter(DatabaseTest):
         # if fetch failed on getting an Hyperlink.OPEN_ACCESS_DOWNLOAD-type epub.
         eq_(None, pool.license_exception)
 
+    def test_mirror_queue(self):
+        data_source = DataSource.lookup(self._db, DataSource.GUTENBERG)
+        cover = open(self.sample_cover_path("test-book-cover.png")).read()
+        cover_url = "http://example.com/cover.png"
+
+        class URLKeyedHTTPClient(object):
+            """Safe to call from several threads at once."""
+            def __init__(self):
+                self.requests = []
+
+            def do_get(self, url, headers):
+                self.requests.append(url)
+                if url == cover_url:
+                    return 200, {"content-type": "image/png"}, cover
+                return 200, {"content-type": Representation.EPUB_MEDIA_TYPE}, "Book at " + url
+
+        class BatchRecordingUploader(DummyS3Uploader):
+            def __init__(self, *args, **kwargs):
+                super(BatchRecordingUploader, self).__init__(*args, **kwargs)
+                self.batches = []
+
+            def mirror_batch(self, representations):
+                self.batches.append(len(representations))
+                super(BatchRecordingUploader, self).mirror_batch(
+                    representations
+                )
+
+        h = URLKeyedHTTPClient()
+        mirror = BatchRecordingUploader()
+        queue = LinkMirrorQueue(threads=3, batch_size=2, thumbnail_processes=1)
+        policy = ReplacementPolicy(
+            mirror=mirror, http_get=h.do_get, mirror_queue=queue
+        )
+
+        # Three books, two of which share a cover.
+        editions = []
+        for i in range(3):
+            edition, pool = self._edition(with_license_pool=True)
+            editions.append(edition)
+            links = [LinkData(
+                rel=Hyperlink.OPEN_ACCESS_DOWNLOAD,
+                media_type=Representation.EPUB_MEDIA_TYPE,
+                href="http://example.com/%d.epub" % i
+            )]
+            if i < 2:
+                links.append(LinkData(
+                    rel=Hyperlink.IMAGE, media_type="image/png",
+                    href=cover_url
+                ))
+            for link in links:
+                self._queue_link(edition, pool, data_source, link, policy)
+
+        # Nothing has happened yet.
+        eq_(5, len(queue))
+        eq_([], h.requests)
+        eq_([], mirror.uploaded)
+
+        eq_([], queue.mirror_all())
+        eq_(0, len(queue))
+
+        # Each URL was only fetched once.
+        eq_(4, len(h.requests))
+        eq_(1, h.requests.count(cover_url))
+
+        # The books, the cover and a thumbnail of the cover for each
+        # book were uploaded in batches.
+        eq_(6, len(mirror.uploaded))
+        eq_([2, 2, 2], mirror.batches)
+        for edition in editions:
+            [book] = [x.resource.representation
+                      for x in edition.primary_identifier.links
+                      if x.rel == Hyperlink.OPEN_ACCESS_DOWNLOAD]
+            assert book.mirrored_at != None
+            assert book.mirror_url.endswith(".epub")
+            # Book content isn't kept once it's mirrored.
+            eq_(None, book.content)
+
+        [image_link] = [x for x in editions[0].primary_identifier.links
+                        if x.rel == Hyperlink.IMAGE]
+        image = image_link.resource.representation
+        eq_(2, len(image.thumbnails))
+        for thumbnail in image.thumbnails:
+            assert thumbnail in mirror.uploaded
+            eq_(Edition.MAX_THUMBNAIL_HEIGHT, thumbnail.image_height)
+
+    def test_mirror_queue_failure(self):
+        data_source = DataSource.lookup(self._db, DataSource.GUTENBERG)
+        doomed, ignore = self._edition(with_license_pool=True)
+        fine, ignore = self._edition(with_license_pool=True)
+
+        class DoomedUploader(DummyS3Uploader):
+            @classmethod
+            def book_url(cls, identifier, *args, **kwargs):
+                if identifier == doomed.primary_identifier:
+                    raise Exception("Doomed!")
+                return super(DoomedUploader, cls).book_url(
+                    identifier, *args, **kwargs)
+
+        h = DummyHTTPClient()
+        h.queue_response(200, media_type=Representation.EPUB_MEDIA_TYPE)
+        h.queue_response(200, media_type=Representation.EPUB_MEDIA_TYPE)
+        mirror = DoomedUploader()
+        queue = LinkMirrorQueue(threads=1)
+        policy = ReplacementPolicy(
+            mirror=mirror, http_get=h.do_get, mirror_queue=queue
+        )
+        for edition in (doomed, fine):
+            link = LinkData(
+                rel=Hyperlink.OPEN_ACCESS_DOWNLOAD,
+                media_type=Representation.EPUB_MEDIA_TYPE,
+                href=self._url
+            )
+            self._queue_link(edition, edition.license_pool, data_source,
+                             link, policy)
+
+        # The failure is reported, and the other book is still mirrored.
+        [(identifier, exc_info)] = queue.mirror_all()
+        eq_(doomed.primary_identifier, identifier)
+        eq_("Doomed!", str(exc_info[1]))
+        [representation] = mirror.uploaded
+        eq_(fine.primary_identifier.links[0].resource.representation,
+            representation)
+
+        # Without a queue, the exception is raised immediately.
+        h.queue_response(200, media_type=Representation.EPUB_MEDIA_TYPE)
+        policy = ReplacementPolicy(mirror=mirror, http_get=h.do_get)
+        link = LinkData(
+            rel=Hyperlink.OPEN_ACCESS_DOWNLOAD,
+            media_type=Representation.EPUB_MEDIA_TYPE,
+            href=self._url
+        )
+        assert_raises_regexp(
+            Exception, "Doomed!",
+            self._queue_link, doomed, doomed.license_pool, data_source,
+            link, policy
+        )
+
+    def _queue_link(self, edition, pool, data_source, link, policy):
+        link_obj, ignore = edition.primary_identifier.add_link(
+            rel=link.rel, href=link.href, data_source=data_source,
+            license_pool=pool, media_type=link.media_type,
+            content=link.content,
+        )
+        m = Metadata(data_source=data_source)
+        m.mirror_link(edition, data_source, link, link_obj, policy)
+
     def test_measurements(self):
         edition = self._edition()
         measurement = MeasurementData(quantity_measured=Measurement.POPULARITY,
@@ -5,6 +5,7 @@ import os
 import sys
 import site
 import re
+import shutil
 import tempfile
 
 from nose.tools import (
@@ -16,6 +17,7 @@ from nose.tools import (
 )
 
 from psycopg2.extras import NumericRange
+from sqlalchemy import func
 from sqlalchemy.orm.exc import (
     NoResultFound,
 )
@@ -33,7 +35,9 @@ from model import (
     Collection,
     Complaint,
     Contributor,
+    CoverageClaim,
     CoverageRecord,
+    DatabaseTokenBucket,
     Credential,
     CustomListEntry,
     DataSource,
@@ -44,11 +48,13 @@ from model import (
     LicensePool,
     Measurement,
     Patron,
+    RateLimit,
     Representation,
     Resource,
     RightsStatus,
     SessionManager,
     Subject,
+    SummaryAnalysis,
     Timestamp,
     Work,
     WorkCoverageRecord,
@@ -56,12 +62,17 @@ from model import (
     Identifier,
     Edition,
     create,
+    estimated_row_count,
     get_one,
     get_one_or_create,
 )
 from external_search import (
     DummyExternalSearchIndex,
 )
+from util.summary import (
+    RegexNounPhraseExtractor,
+    SummaryEvaluator,
+)
 
 import classifier
 from classifier import (
@@ -70,6 +81,7 @@ from classifier import (
     Romance,
     Science_Fiction,
     Drama,
+    TAGClassifier,
 )
 
 from . import (
@@ -250,7 +262,72 @@ class TestIdentifier(DatabaseTest):
 
         # Pass in None and you get None.
         eq_(None, Identifier.parse_urn(self._db, None))
-        
+
+    def test_parse_urns(self):
+        identifier = self._identifier()
+        overdrive, ignore = Identifier.for_foreign_id(
+            self._db, Identifier.OVERDRIVE_ID, "abcd"
+        )
+        overdrive_urn = overdrive.urn.replace("abcd", "ABCD")
+        isbn_urn = "urn:isbn:1449358063"
+        gutenberg_urn = "http://www.gutenberg.org/ebooks/9999"
+        bad_urns = ["ftp://example.com", "urn:isbn:notanisbn", None]
+        urns = [identifier.urn, overdrive_urn, isbn_urn, gutenberg_urn
+        ] + bad_urns
+
+        # Without autocreate, only the identifiers that already exist
+        # are found.
+        found, unparseable = Identifier.parse_urns(
+            self._db, urns, autocreate=False
+        )
+        eq_({identifier.urn : identifier, overdrive_urn : overdrive}, found)
+        eq_(bad_urns, unparseable)
+
+        # With autocreate, the missing identifiers are created.
+        found, unparseable = Identifier.parse_urns(self._db, urns)
+        eq_(bad_urns, unparseable)
+        eq_(4, len(found))
+        eq_(overdrive, found[overdrive_urn])
+        isbn = found[isbn_urn]
+        eq_((Identifier.ISBN, "9781449358068"), (isbn.type, isbn.identifier))
+        gutenberg = found[gutenberg_urn]
+        eq_((Identifier.GUTENBERG_ID, "9999"),
+            (gutenberg.type, gutenberg.identifier))
+
+        # They're the same identifiers parse_urn would have found.
+        eq_(isbn, Identifier.parse_urn(self._db, isbn_urn)[0])
+
+        # Parsing them again doesn't create anything new.
+        count = self._db.query(Identifier).count()
+        again, ignore = Identifier.parse_urns(self._db, urns)
+        eq_(found, again)
+        eq_(count, self._db.query(Identifier).count())
+
+    def test_for_foreign_ids(self):
+        existing, ignore = Identifier.for_foreign_id(
+            self._db, Identifier.THREEM_ID, "abc"
+        )
+        keys = [("3M ID", "ABC"), (Identifier.ISBN, "9781449358068"),
+                (None, "1"), (Identifier.ISBN, None)]
+
+        found = Identifier.for_foreign_ids(self._db, keys, autocreate=False)
+        eq_({("3M ID", "ABC") : existing}, found)
+
+        found = Identifier.for_foreign_ids(self._db, keys)
+        eq_(existing, found[("3M ID", "ABC")])
+        isbn = found[(Identifier.ISBN, "9781449358068")]
+        eq_(Identifier.ISBN, isbn.type)
+        eq_(2, len(found))
+
+        # An identifier that's created but not yet written to the
+        # database is found rather than created a second time.
+        pending = Identifier(type=Identifier.ISBN, identifier="9780000000002")
+        self._db.add(pending)
+        found = Identifier.for_foreign_ids(
+            self._db, [(Identifier.ISBN, "9780000000002")]
+        )
+        eq_(pending, found[(Identifier.ISBN, "9780000000002")])
+
     def parse_urn_must_support_license_pools(self):
         # We have no way of associating ISBNs with license pools.
         # If we try to parse an ISBN URN in a context that only accepts
@@ -524,6 +601,81 @@ class TestSubject(DatabaseTest):
         eq_(None, subject.genre)
         eq_(None, subject.fiction)
 
+    def test_assign_to_genre_records_rules_hash(self):
+        subject, was_new = Subject.lookup(self._db, Subject.TAG, "pets", None)
+        eq_(True, subject.needs_genre_assignment)
+        subject.assign_to_genre()
+        eq_(TAGClassifier.rules_hash(), subject.rules_hash)
+        eq_(False, subject.needs_genre_assignment)
+
+        # If the rules change, the subject needs to be checked again.
+        subject.rules_hash = u"old rules"
+        eq_(True, subject.needs_genre_assignment)
+
+    def test_assign_to_genres_rechecks_subjects_with_stale_rules(self):
+        fresh, ignore = Subject.lookup(self._db, Subject.TAG, "pets", None)
+        stale, ignore = Subject.lookup(self._db, Subject.TAG, "gardening", None)
+        Subject.assign_to_genres(self._db)
+        eq_("Pets", fresh.genre.name)
+        eq_("Gardening", stale.genre.name)
+
+        # Pretend both subjects were checked with the current rules
+        # but got the genre wrong. One of them was actually checked
+        # with an older version of the rules.
+        fresh.genre = None
+        stale.genre = None
+        stale.rules_hash = u"old rules"
+        Subject.assign_to_genres(self._db)
+
+        # Only the subject checked with the old rules was checked again.
+        eq_(None, fresh.genre)
+        eq_("Gardening", stale.genre.name)
+
+    def test_bulk_assign_to_genres(self):
+        # Here are some subjects of different types.
+        erotica, ignore = Subject.lookup(
+            self._db, Subject.TAG, "erotica", None
+        )
+        children, ignore = Subject.lookup(
+            self._db, Subject.TAG, "Children's books", None
+        )
+        age, ignore = Subject.lookup(self._db, Subject.AGE_RANGE, "9-12", None)
+        dewey, ignore = Subject.lookup(self._db, Subject.DDC, "641.5", None)
+        unknown, ignore = Subject.lookup(self._db, u"Unknown", "pets", None)
+        subjects = [erotica, children, age, dewey, unknown]
+
+        # Run assign_to_genre() on each one and note the results.
+        def assignments():
+            return [(x.checked, x.genre, x.audience, x.target_age, x.fiction,
+                     x.rules_hash) for x in subjects]
+
+        for subject in subjects:
+            subject.assign_to_genre()
+        self._db.flush()
+        for subject in subjects:
+            self._db.expire(subject)
+        expect = assignments()
+
+        # Reset the subjects, and assign them all at once.
+        for subject in subjects:
+            subject.checked = False
+            subject.genre = None
+            subject.audience = None
+            subject.target_age = None
+            subject.fiction = None
+            subject.rules_hash = None
+        Subject.bulk_assign_to_genres(self._db, subjects)
+
+        # The results are the same.
+        eq_(expect, assignments())
+        eq_("Erotica", erotica.genre.name)
+        eq_(Classifier.AUDIENCE_ADULTS_ONLY, erotica.audience)
+        eq_(9, age.target_age.lower)
+        eq_(False, dewey.fiction)
+
+        # A subject with no classifier was left alone.
+        eq_(False, unknown.checked)
+
 
 class TestContributor(DatabaseTest):
 
@@ -2352,6 +2504,49 @@ class TestWorkConsolidation(DatabaseTest):
         eq_(set([edition1.license_pool, edition2.license_pool]), set(work1.license_pools))
 
 
+    def test_consolidate_works(self):
+        # This open-access book already has a Work.
+        edition1, pool1 = self._edition(with_license_pool=True)
+        work1, ignore = pool1.calculate_work()
+
+        # This one has the same permanent work ID, so it will join
+        # the existing Work.
+        edition2, pool2 = self._edition(
+            title=edition1.title, authors=edition1.author,
+            with_license_pool=True)
+
+        # These two share a permanent work ID with each other but not
+        # with anything else, so they'll get a new Work together, even
+        # though they're consolidated in different batches.
+        edition3, pool3 = self._edition(with_license_pool=True)
+        edition4, pool4 = self._edition(
+            title=edition3.title, authors=edition3.author,
+            with_license_pool=True)
+
+        # This commercially licensed book gets a Work to itself, even
+        # though it has the same permanent work ID as the first book.
+        edition5, pool5 = self._edition(
+            title=edition1.title, authors=edition1.author,
+            with_license_pool=True)
+        pool5.open_access = False
+
+        # This book has no title, so it won't get a Work.
+        edition6, pool6 = self._edition(with_license_pool=True)
+        edition6.title = None
+
+        LicensePool.consolidate_works(self._db, batch_size=2)
+
+        eq_(set([pool1, pool2]), set(work1.license_pools))
+        assert pool3.work not in (None, work1)
+        eq_(set([pool3, pool4]), set(pool3.work.license_pools))
+        eq_([pool5], pool5.work.license_pools)
+        assert pool5.work not in (work1, pool3.work)
+        eq_(None, pool6.work)
+
+        # Each Work's presentation was calculated.
+        eq_(edition3.title, pool3.work.title)
+        eq_(edition5.title, pool5.work.title)
+
     def test_calculate_work_for_licensepool_creates_new_work(self):
         edition1, ignore = self._edition(data_source_name=DataSource.GUTENBERG, identifier_type=Identifier.GUTENBERG_ID, 
             title=self._str, authors=[self._str], with_license_pool=True)
@@ -3324,6 +3519,81 @@ class TestHyperlink(DatabaseTest):
         eq_("cover-thumbnail", m(Hyperlink.THUMBNAIL_IMAGE))
 
 
+class TestSummaryAnalysis(DatabaseTest):
+
+    def test_analyses_are_stored(self):
+        SummaryEvaluator.analysis_cache.clear()
+        evaluator = SummaryEvaluator(
+            noun_phrase_extractor=RegexNounPhraseExtractor.name
+        )
+        summaries = [u"Alice meets the Mock Turtle.", u"Nobody here."]
+        SummaryAnalysis.load(self._db, evaluator, summaries)
+        for summary in summaries:
+            evaluator.add(summary)
+        SummaryAnalysis.save(self._db, evaluator)
+        eq_({}, evaluator.new_analyses)
+
+        eq_(2, self._db.query(SummaryAnalysis).count())
+        turtle = get_one(
+            self._db, SummaryAnalysis,
+            content_hash=SummaryEvaluator.content_hash(summaries[0])
+        )
+        eq_(RegexNounPhraseExtractor.name, turtle.extractor)
+        eq_([u"alice meets", u"mock turtle"], turtle.noun_phrases)
+        eq_(1, turtle.sentences)
+
+        # Another process finds the analyses in the database instead
+        # of analyzing the summaries again.
+        SummaryEvaluator.analysis_cache.clear()
+        evaluator = SummaryEvaluator(
+            noun_phrase_extractor=RegexNounPhraseExtractor.name
+        )
+        SummaryAnalysis.load(self._db, evaluator, summaries)
+        for summary in summaries:
+            evaluator.add(summary)
+        eq_({}, evaluator.new_analyses)
+        eq_(([u"alice meets", u"mock turtle"], 1),
+            evaluator.analyses[u"Alice meets the Mock Turtle."])
+
+        # Saving an analysis that's already stored does nothing.
+        evaluator.new_analyses[turtle.content_hash] = ([u"oops"], 5)
+        SummaryAnalysis.save(self._db, evaluator)
+        eq_(2, self._db.query(SummaryAnalysis).count())
+
+    def test_evaluate_summary_quality_stores_analyses(self):
+        SummaryEvaluator.analysis_cache.clear()
+        edition, pool = self._edition(with_license_pool=True)
+        source = DataSource.lookup(self._db, DataSource.OCLC)
+        link, ignore = pool.add_link(
+            Hyperlink.DESCRIPTION, None, source, "text/plain",
+            u"Alice meets the Mock Turtle."
+        )
+        config = {
+            Configuration.POLICIES : {
+                Configuration.SUMMARY_NOUN_PHRASE_EXTRACTOR_POLICY :
+                RegexNounPhraseExtractor.name
+            }
+        }
+        with temp_config(config):
+            champion, resources = Identifier.evaluate_summary_quality(
+                self._db, [edition.primary_identifier.id]
+            )
+        eq_(link.resource, champion)
+        [analysis] = self._db.query(SummaryAnalysis).all()
+        eq_(SummaryEvaluator.content_hash(u"Alice meets the Mock Turtle."),
+            analysis.content_hash)
+
+    def test_default_extractor_without_configuration(self):
+        # With no configuration file loaded, SummaryEvaluator's
+        # default noun phrase extractor is used.
+        old_instance = Configuration.instance
+        Configuration.instance = None
+        try:
+            eq_(None, Configuration.summary_noun_phrase_extractor())
+        finally:
+            Configuration.instance = old_instance
+
+
 class TestRepresentation(DatabaseTest):
 
     def test_normalized_content_path(self):
@@ -3700,6 +3970,82 @@ class TestRepresentation(DatabaseTest):
         eq_(Representation.PNG_MEDIA_TYPE, thumbnail.media_type)
 
 
+class TestRepresentationContentStore(DatabaseTest):
+
+    def setup(self):
+        super(TestRepresentationContentStore, self).setup()
+        self.root = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.root)
+        super(TestRepresentationContentStore, self).teardown()
+
+    def test_content_is_kept_in_database_by_default(self):
+        with temp_config() as config:
+            config[Configuration.CONTENT_STORE_DIRECTORY] = None
+            representation, ignore = self._representation(
+                media_type="text/plain")
+            representation.set_fetched_content("some content")
+            eq_("some content", representation._content)
+            eq_(None, representation.content_hash)
+
+    def test_content_is_kept_in_content_store(self):
+        with temp_config() as config:
+            config[Configuration.CONTENT_STORE_DIRECTORY] = self.root
+            representation, ignore = self._representation(
+                media_type="text/plain")
+            representation.set_fetched_content("some content")
+            self._db.flush()
+
+            # The content isn't in the database.
+            eq_(None, representation._content)
+            path = Representation.content_store().path(
+                representation.content_hash)
+            eq_("some content", open(path).read())
+
+            # But it's available as though it were.
+            eq_("some content", representation.content)
+            eq_("some content", representation.content_fh().read())
+            eq_("some content", representation.external_content().read())
+            eq_(True, representation.has_content)
+
+            # Two representations with the same content share a blob.
+            other, ignore = self._representation(media_type="text/plain")
+            other.content = "some content"
+            eq_(representation.content_hash, other.content_hash)
+
+            # Clearing the content clears the hash.
+            other.content = None
+            eq_(None, other.content_hash)
+            eq_(None, other.content_fh())
+
+    def test_image_in_content_store(self):
+        base_path = os.path.split(__file__)[0]
+        path = os.path.join(
+            base_path, "files", "covers", "test-book-cover.png")
+        with temp_config() as config:
+            config[Configuration.CONTENT_STORE_DIRECTORY] = self.root
+            cover, ignore = self._representation(
+                media_type="image/png", content=open(path).read())
+            assert cover.content_hash
+            thumbnail, is_new = cover.scale(300, 600, self._url, "image/png")
+            eq_(True, is_new)
+            eq_(300, thumbnail.image_height)
+            assert thumbnail.content_hash
+
+    def test_content_store_not_configured(self):
+        with temp_config() as config:
+            config[Configuration.CONTENT_STORE_DIRECTORY] = self.root
+            representation, ignore = self._representation(
+                media_type="text/plain", content="some content")
+        with temp_config() as config:
+            config[Configuration.CONTENT_STORE_DIRECTORY] = None
+            assert_raises_regexp(
+                ValueError, "no content store is configured",
+                lambda: representation.content
+            )
+
+
 class TestCoverResource(DatabaseTest):
 
     def sample_cover_path(self, name):
@@ -3790,6 +4136,14 @@ class TestCoverResource(DatabaseTest):
         eq_(thumbnail2, thumbnail)
         eq_(False, is_new)
 
+        # Even when the existing thumbnail is used, the image size of
+        # the original is filled in.
+        cover.image_width = cover.image_height = None
+        thumbnail2, is_new = cover.scale(400, 700, url, "image/png")
+        eq_(thumbnail2, thumbnail)
+        eq_(False, is_new)
+        eq_((400, 600), (cover.image_width, cover.image_height))
+
         # Let's say the thumbnail has been mirrored.
         thumbnail.mirrored_at = datetime.datetime.utcnow()
 
@@ -3826,6 +4180,51 @@ class TestCoverResource(DatabaseTest):
         # though this takes it below max_height.
         eq_(200, thumbnail.image_height)
 
+    def test_bulk_scale(self):
+        cover = self.sample_cover_representation("test-book-cover.png")
+        tiny = self.sample_cover_representation("tiny-image-cover.png")
+        broken, ignore = self._representation(
+            media_type="image/png", content="not an image")
+        large_url = self._url
+        small_url = self._url
+        tiny_url = self._url
+        jobs = [
+            (cover, [(300, 200, large_url), (150, 100, small_url)]),
+            (tiny, [(150, 100, tiny_url)]),
+            (broken, [(150, 100, self._url)]),
+        ]
+        results = Representation.bulk_scale(
+            self._db, jobs, Representation.PNG_MEDIA_TYPE, processes=1
+        )
+
+        # The cover was decoded once and scaled to both sizes.
+        [(large, is_new), (small, is_new_2)] = results[cover]
+        eq_(True, is_new)
+        eq_(True, is_new_2)
+        eq_(large_url, large.url)
+        eq_((200, 300), (large.image_width, large.image_height))
+        eq_((100, 150), (small.image_width, small.image_height))
+        eq_(set([large, small]), set(cover.thumbnails))
+        eq_((400, 600), (cover.image_width, cover.image_height))
+        assert large.id is not None
+
+        # The tiny image was scaled down too.
+        [(tiny_thumbnail, is_new)] = results[tiny]
+        eq_(True, is_new)
+        eq_(100, tiny_thumbnail.image_width)
+
+        # The broken image couldn't be scaled.
+        eq_([(broken, False)], results[broken])
+        assert "IOError" in broken.scale_exception
+        assert broken.fetch_exception.startswith("Error found while scaling")
+
+        # Scaling again finds the existing thumbnails without
+        # decoding anything.
+        results = Representation.bulk_scale(
+            self._db, jobs[:1], Representation.PNG_MEDIA_TYPE, processes=1
+        )
+        eq_([(large, False), (small, False)], results[cover])
+
     def test_book_smaller_than_thumbnail_size(self):
         # This book is 200x200. No thumbnail will be created.
         cover = self.sample_cover_representation("tiny-image-cover.png")
@@ -3837,6 +4236,37 @@ class TestCoverResource(DatabaseTest):
         eq_(None, thumbnail.thumbnail_of)
         assert thumbnail.url != url
 
+    def test_bulk_scale_existing_thumbnail_of_small_book(self):
+        # This book is 200x200, so it can be scaled down to 150x100...
+        cover = self.sample_cover_representation("tiny-image-cover.png")
+        small_url = self._url
+        small, is_new = cover.scale(150, 100, small_url, "image/png")
+        eq_(True, is_new)
+
+        # ...and there's also a thumbnail at a size it already fits,
+        # left over from before.
+        large_url = self._url
+        large, ignore = self._representation(
+            url=large_url, media_type="image/png"
+        )
+        large.thumbnail_of = cover
+
+        # Even though both thumbnails exist, the image itself is used
+        # for the size it already fits.
+        results = Representation.bulk_scale(
+            self._db, [(cover, [(150, 100, small_url), (300, 600, large_url)])],
+            Representation.PNG_MEDIA_TYPE, processes=1
+        )
+        eq_([(small, False), (cover, False)], results[cover])
+
+        # If it fits every size, it has no thumbnails at all.
+        results = Representation.bulk_scale(
+            self._db, [(cover, [(300, 600, large_url)])],
+            Representation.PNG_MEDIA_TYPE, processes=1
+        )
+        eq_([(cover, False)], results[cover])
+        eq_([], cover.thumbnails)
+
     def test_best_covers_among(self):
         # Here's a book with a thumbnail image.
         edition, pool = self._edition(with_license_pool=True)
@@ -4034,6 +4464,78 @@ class TestRightsStatus(DatabaseTest):
         eq_(RightsStatus.NAMES.get(RightsStatus.UNKNOWN), status.name)
 
 
+class TestRateLimit(DatabaseTest):
+
+    def test_limiter_for(self):
+        with temp_config() as config:
+            config[Configuration.INTEGRATIONS]["Service"] = {}
+            limiter = RateLimit.limiter_for(self._db, "Service")
+            eq_(None, limiter.bucket)
+
+            config[Configuration.INTEGRATIONS]["Service"] = {
+                Configuration.RATE_LIMIT : {
+                    Configuration.RATE_LIMIT_REQUESTS_PER_SECOND : 2,
+                    Configuration.RATE_LIMIT_BURST : 10,
+                }
+            }
+            limiter = RateLimit.limiter_for(self._db, "Service")
+            eq_(2, limiter.bucket.rate)
+            eq_(10, limiter.bucket.capacity)
+
+            # Every limiter for the integration shares a bucket.
+            eq_(limiter.bucket,
+                RateLimit.limiter_for(self._db, "Service").bucket)
+
+            config[Configuration.INTEGRATIONS]["Service"][
+                Configuration.RATE_LIMIT][Configuration.RATE_LIMIT_SHARED] = True
+            limiter = RateLimit.limiter_for(self._db, "Service")
+            assert isinstance(limiter.bucket, DatabaseTokenBucket)
+            eq_(u"Service", limiter.bucket.name)
+
+
+class TestDatabaseTokenBucket(DatabaseTest):
+
+    def test_take_and_pause(self):
+        slept = []
+        # One token every hundred seconds, so the time these tests
+        # take to run doesn't matter.
+        bucket = DatabaseTokenBucket(
+            self.connection, u"service", 0.01, 2, sleep=slept.append
+        )
+        eq_(0, bucket.take())
+        eq_(0, bucket.take())
+        eq_([], slept)
+
+        # The bucket is empty, so we have to wait.
+        delay = bucket.take()
+        assert 99 < delay <= 100
+        eq_([delay], slept)
+
+        [state] = self._db.query(RateLimit).all()
+        eq_(u"service", state.name)
+        assert state.tokens < 0
+
+        # Another process using the same bucket has to wait its turn.
+        other = DatabaseTokenBucket(
+            self.connection, u"service", 0.01, 2, sleep=slept.append
+        )
+        assert 199 < other.take() <= 200
+
+        # Pausing the bucket can only make the wait longer.
+        bucket.pause(1)
+        assert 299 < bucket.take() <= 300
+        bucket.pause(1000)
+        assert 1000 < bucket.take() <= 1100
+
+        # A bucket that's paused before it's ever used starts out in
+        # debt.
+        new = DatabaseTokenBucket(
+            self.connection, u"new service", 1, sleep=slept.append
+        )
+        new.pause(5)
+        assert 5 < new.take() <= 6
+
+
 class TestCredentials(DatabaseTest):
     
     def test_temporary_token(self):
@@ -4302,6 +4804,51 @@ class TestCoverageRecord(DatabaseTest):
         eq_(record5, record)
         eq_(CoverageRecord.PERSISTENT_FAILURE, record.status)
 
+    def test_bulk_add(self):
+        source = DataSource.lookup(self._db, DataSource.OCLC)
+        edition = self._edition()
+        identifier = self._identifier()
+        existing, ignore = CoverageRecord.add_for(edition, source, 'foo')
+        existing_no_operation, ignore = CoverageRecord.add_for(
+            identifier, source
+        )
+
+        a_week_ago = datetime.datetime.utcnow() - datetime.timedelta(days=7)
+        records = CoverageRecord.bulk_add(self._db, [
+            (edition, source, 'foo', CoverageRecord.TRANSIENT_FAILURE,
+             u"oops"),
+            (identifier, source, None, CoverageRecord.PERSISTENT_FAILURE,
+             u"no way"),
+            (identifier, source, 'foo', CoverageRecord.SUCCESS, None),
+            # The same record twice: the last one wins.
+            (identifier, source, 'foo', CoverageRecord.SUCCESS, u"again"),
+        ], timestamp=a_week_ago)
+
+        [updated, updated_no_operation, new, new_again] = records
+
+        # Existing records were updated in place, and the objects
+        # already in the session reflect the change.
+        eq_(existing, updated)
+        eq_(CoverageRecord.TRANSIENT_FAILURE, existing.status)
+        eq_(u"oops", existing.exception)
+        eq_(a_week_ago, existing.timestamp)
+
+        # A record with no operation is still unique.
+        eq_(existing_no_operation, updated_no_operation)
+        eq_(CoverageRecord.PERSISTENT_FAILURE, existing_no_operation.status)
+        eq_(1, self._db.query(CoverageRecord).filter(
+            CoverageRecord.identifier==identifier).filter(
+                CoverageRecord.operation==None).count())
+
+        # A new record was created.
+        eq_(new, new_again)
+        eq_(identifier, new.identifier)
+        eq_(source, new.data_source)
+        eq_('foo', new.operation)
+        eq_(u"again", new.exception)
+
+        eq_([], CoverageRecord.bulk_add(self._db, []))
+
 class TestWorkCoverageRecord(DatabaseTest):
 
     def test_lookup(self):
@@ -4353,6 +4900,144 @@ class TestWorkCoverageRecord(DatabaseTest):
         eq_(record5, record)
         eq_(WorkCoverageRecord.PERSISTENT_FAILURE, record.status)
 
+    def test_bulk_add(self):
+        work = self._work()
+        work2 = self._work()
+        existing, ignore = WorkCoverageRecord.add_for(work, None)
+
+        records = WorkCoverageRecord.bulk_add(self._db, [
+            (work, None, WorkCoverageRecord.TRANSIENT_FAILURE, u"oops"),
+            (work2, 'foo', WorkCoverageRecord.SUCCESS, None),
+        ])
+        [updated, new] = records
+        eq_(existing, updated)
+        eq_(WorkCoverageRecord.TRANSIENT_FAILURE, existing.status)
+        eq_(u"oops", existing.exception)
+        eq_(work2, new.work)
+        eq_('foo', new.operation)
+        eq_(WorkCoverageRecord.SUCCESS, new.status)
+        eq_(1, self._db.query(WorkCoverageRecord).filter(
+            WorkCoverageRecord.work==work).filter(
+                WorkCoverageRecord.operation==None).count())
+
+    def test_add_or_defer(self):
+        work = self._work()
+        new_work = Work()
+        merged = self._work()
+        operation = WorkCoverageRecord.GENERATE_OPDS_OPERATION
+
+        def records(w):
+            return self._db.query(WorkCoverageRecord).filter(
+                WorkCoverageRecord.work==w).filter(
+                    WorkCoverageRecord.operation==operation).all()
+
+        # Outside a batch, the record is written immediately.
+        WorkCoverageRecord.add_or_defer(work, operation)
+        [record] = records(work)
+        self._db.delete(record)
+        self._db.flush()
+
+        with WorkCoverageRecord.batch(self._db):
+            WorkCoverageRecord.add_or_defer(work, operation)
+            self._db.add(new_work)
+            WorkCoverageRecord.add_or_defer(new_work, operation)
+            WorkCoverageRecord.add_or_defer(merged, operation)
+            self._db.delete(merged)
+
+            # A nested batch doesn't write anything on its own.
+            with WorkCoverageRecord.batch(self._db):
+                WorkCoverageRecord.add_or_defer(work, operation)
+            eq_([], records(work))
+
+        # When the batch ends, the records are written -- except for
+        # the one whose Work was deleted in the meantime.
+        [record] = records(work)
+        eq_(WorkCoverageRecord.SUCCESS, record.status)
+        [record] = records(new_work)
+        eq_(0, self._db.query(WorkCoverageRecord).filter(
+            WorkCoverageRecord.work_id==merged.id).count())
+
+        # If the block raises an exception, nothing is written.
+        other = self._work()
+        try:
+            with WorkCoverageRecord.batch(self._db):
+                WorkCoverageRecord.add_or_defer(other, operation)
+                raise ValueError()
+        except ValueError:
+            pass
+        eq_([], records(other))
+
+    def test_batch_of_presentation_calculations(self):
+        works = [self._work(with_license_pool=True) for i in range(3)]
+        self._db.query(WorkCoverageRecord).delete()
+
+        with WorkCoverageRecord.batch(self._db):
+            for work in works:
+                work.calculate_presentation()
+            eq_(0, self._db.query(WorkCoverageRecord).count())
+
+        for work in works:
+            self._db.expire(work, ['coverage_records'])
+            operations = set(x.operation for x in work.coverage_records)
+            assert WorkCoverageRecord.CHOOSE_EDITION_OPERATION in operations
+            assert WorkCoverageRecord.CLASSIFY_OPERATION in operations
+            assert WorkCoverageRecord.SUMMARY_OPERATION in operations
+            assert WorkCoverageRecord.QUALITY_OPERATION in operations
+            assert WorkCoverageRecord.GENERATE_OPDS_OPERATION in operations
+
+class TestCoverageClaim(DatabaseTest):
+
+    def test_claim_and_release(self):
+        hour = datetime.timedelta(hours=1)
+        claimed = CoverageClaim.claim(
+            self._db, u"service", [1, 2], u"worker 1", hour
+        )
+        eq_(set([1, 2]), claimed)
+
+        # A second worker can't claim items that are already claimed,
+        # but it can claim other items. The same item ID can be claimed
+        # separately for a different service.
+        claimed = CoverageClaim.claim(
+            self._db, u"service", [2, 3], u"worker 2", hour
+        )
+        eq_(set([3]), claimed)
+        eq_(set([2]), CoverageClaim.claim(
+            self._db, u"other service", [2], u"worker 2", hour
+        ))
+
+        # Once a claim expires, anyone can claim the item.
+        in_two_hours = datetime.datetime.utcnow() + 2*hour
+        claimed = CoverageClaim.claim(
+            self._db, u"service", [1, 2, 3], u"worker 3", hour,
+            now=in_two_hours
+        )
+        eq_(set([1, 2, 3]), claimed)
+
+        # Releasing a worker's claims only affects that worker.
+        CoverageClaim.release(self._db, u"service", [1, 2], u"worker 1")
+        eq_(3, self._db.query(CoverageClaim).filter(
+            CoverageClaim.service_name==u"service").count())
+        CoverageClaim.release(self._db, u"service", [1, 2], u"worker 3")
+        [claim] = self._db.query(CoverageClaim).filter(
+            CoverageClaim.service_name==u"service").all()
+        eq_(3, claim.item_id)
+
+    def test_unclaimed(self):
+        i1 = self._identifier()
+        i2 = self._identifier()
+        CoverageClaim.claim(
+            self._db, u"service", [i1.id], u"worker",
+            datetime.timedelta(hours=1)
+        )
+        qu = self._db.query(Identifier).filter(
+            Identifier.id.in_([i1.id, i2.id])
+        )
+        eq_([i2], qu.filter(
+            CoverageClaim.unclaimed(u"service", Identifier.id)).all())
+        eq_(2, qu.filter(
+            CoverageClaim.unclaimed(u"other service", Identifier.id)).count())
+
+
 class TestComplaint(DatabaseTest):
 
     def setup(self):
@@ -4683,3 +5368,35 @@ class TestMaterializedViews(DatabaseTest):
         # to be the data source ID of the presentation edition.
         eq_(presentation_edition.data_source.id, mw.data_source_id)
         eq_(presentation_edition.data_source.id, mwg.data_source_id)
+
+
+class TestEstimatedRowCount(DatabaseTest):
+
+    def test_estimated_row_count(self):
+        self._identifier()
+        qu = self._db.query(Identifier).filter(
+            Identifier.type==Identifier.GUTENBERG_ID
+        )
+        # The estimate comes from the planner's statistics, so we
+        # can't know exactly what it'll be...
+        assert estimated_row_count(qu) > 0
+
+        # ...but it can never be more than a query's LIMIT.
+        eq_(1, estimated_row_count(qu.limit(1)))
+
+        # Parameters are passed along to the database rather than
+        # being pasted into the SQL.
+        qu = self._db.query(Identifier).filter(
+            Identifier.identifier==u"it's 100% \"quoted\"; --"
+        )
+        assert estimated_row_count(qu) >= 0
+
+    def test_estimate_is_best_effort(self):
+        identifier = self._identifier()
+        qu = self._db.query(Identifier).filter(
+            func.no_such_function(Identifier.id)
+        )
+        eq_(None, estimated_row_count(qu))
+
+        # The failure didn't spoil the transaction.
+        eq_(identifier, self._db.query(Identifier).one())
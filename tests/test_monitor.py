@@ -13,17 +13,27 @@ from testing import (
     BrokenCoverageProvider,
 )
 
+from s3 import DummyS3Uploader
+
 from model import (
     DataSource,
     Identifier,
+    Measurement,
+    Representation,
     Subject,
     Timestamp,
+    Work,
 )
 
 from monitor import (
+    IdentifierSweepMonitor,
+    MirrorRetryMonitor,
+    WorkRandomnessUpdateMonitor,
     Monitor,
     PresentationReadyMonitor,
+    SubjectAssignmentMonitor,
     SubjectSweepMonitor,
+    WorkQualityRefreshMonitor,
 )
 
 class DummyMonitor(Monitor):
@@ -69,6 +79,91 @@ class TestMonitor(DatabaseTest):
         # called.
         assert timestamp.timestamp > monitor.original_timestamp
 
+        # Running the monitor again picks up where the last run left
+        # off.
+        last_run = timestamp.timestamp
+        monitor.run()
+        eq_([True, True], monitor.run_records)
+        eq_(last_run, monitor.original_timestamp)
+
+class DummySweepMonitor(IdentifierSweepMonitor):
+
+    def __init__(self, _db):
+        super(DummySweepMonitor, self).__init__(
+            _db, "Dummy sweep monitor for test", batch_size=2
+        )
+        self.swept = []
+
+    def process_identifier(self, identifier):
+        self.swept.append(identifier)
+
+
+class TestIdentifierSweepMonitor(DatabaseTest):
+
+    def test_sharded_sweep(self):
+        identifiers = [self._identifier() for i in range(6)]
+        max_id = identifiers[-1].id
+
+        monitor = DummySweepMonitor(self._db)
+        ranges = monitor.shard_ranges(3)
+        eq_([(0, max_id/3), (max_id/3, max_id*2/3), (max_id*2/3, None)],
+            ranges)
+
+        # Once they're set, the ranges don't change, and anything
+        # new goes into the last shard.
+        new_identifier = self._identifier()
+        identifiers.append(new_identifier)
+        eq_(ranges, monitor.shard_ranges(3))
+
+        swept = []
+        service_names = set()
+        for index in range(3):
+            monitor = DummySweepMonitor(self._db)
+            monitor.shard(index, 3)
+            service_names.add(monitor.service_name)
+            monitor.run()
+            start, end = ranges[index]
+            for identifier in monitor.swept:
+                assert identifier.id > start
+                assert end is None or identifier.id <= end
+            swept.extend(monitor.swept)
+
+        # Between them, the shards swept every identifier once, and
+        # each one kept its own timestamp.
+        eq_(sorted(x.id for x in identifiers),
+            sorted(x.id for x in swept if x in identifiers))
+        eq_(len(swept), len(set(swept)))
+        eq_(3, self._db.query(Timestamp).filter(
+            Timestamp.service.in_(service_names)).count())
+
+        assert_raises_regexp(
+            ValueError, "Shard must be between 0 and 2, not 3",
+            monitor.shard, 3, 3
+        )
+
+    def test_shard_progress(self):
+        identifiers = [self._identifier() for i in range(10)]
+        monitor = DummySweepMonitor(self._db)
+        [(start, end), (start2, end2)] = monitor.shard_ranges(2)
+
+        # The first shard is halfway done after an hour.
+        now = datetime.datetime.utcnow()
+        timestamp = Timestamp.stamp(
+            self._db, monitor.shard_service_name(0, 2)
+        )
+        timestamp.timestamp = now - datetime.timedelta(hours=1)
+        timestamp.counter = start + (end - start) / 2
+
+        [first, second] = monitor.shard_progress(2, now=now)
+        eq_((0, start, end, timestamp.counter), first[:4])
+        fraction = float(timestamp.counter - start) / (end - start)
+        eq_(fraction, first.fraction)
+        eq_(datetime.timedelta(hours=(1-fraction)/fraction), first.eta)
+
+        # The second shard hasn't started.
+        eq_((1, start2, None, None, None, None, None), second)
+
+
 class TestPresentationReadyMonitor(DatabaseTest):
 
     def setup(self):
@@ -161,4 +256,80 @@ class TestSubjectSweepMonitor(DatabaseTest):
             self._db, "Test Monitor", Subject.TAG, "Years"
         )
         eq_([s2], specific_tag_monitor.subject_query().all())
+
+
+class TestSubjectAssignmentMonitor(DatabaseTest):
+
+    def test_process_batch(self):
+        s1, ignore = Subject.lookup(self._db, Subject.TAG, "pets", None)
+        s2, ignore = Subject.lookup(self._db, Subject.TAG, "gardening", None)
+        monitor = SubjectAssignmentMonitor(self._db)
+        eq_(s2.id, monitor.process_batch([s1, s2]))
+        eq_("Pets", s1.genre.name)
+        eq_("Gardening", s2.genre.name)
+        eq_(True, s1.checked)
+        eq_(True, s2.checked)
         
+
+
+class TestWorkQualityRefreshMonitor(DatabaseTest):
+
+    def test_run(self):
+        work = self._work(with_license_pool=True)
+        work.quality = 0.9
+        identifier = work.license_pools[0].identifier
+        wrangler = DataSource.lookup(self._db, DataSource.METADATA_WRANGLER)
+        identifier.add_measurement(wrangler, Measurement.QUALITY, 0.3)
+
+        WorkQualityRefreshMonitor(self._db).run()
+        eq_(0.3, float(work.quality))
+
+
+class TestWorkRandomnessUpdateMonitor(DatabaseTest):
+
+    def test_run(self):
+        works = [self._work() for i in range(20)]
+        ids = [x.id for x in works]
+        def random_order():
+            return [x.id for x in self._db.query(Work).filter(
+                Work.id.in_(ids)).order_by(Work.random_order())]
+
+        before = random_order()
+        eq_(sorted(ids), sorted(before))
+        eq_(before, random_order())
+
+        # Running the monitor moves on to the next epoch, which
+        # reshuffles the works without changing them.
+        monitor = WorkRandomnessUpdateMonitor(self._db)
+        monitor.run()
+        eq_(1, monitor.timestamp.counter)
+        after = random_order()
+        eq_(sorted(ids), sorted(after))
+        assert before != after
+
+        monitor.run()
+        eq_(2, monitor.timestamp.counter)
+
+
+class TestMirrorRetryMonitor(DatabaseTest):
+
+    def test_run(self):
+        failed, ignore = self._representation(
+            media_type="text/plain", content="a"
+        )
+        failed.mirror_url = self._url
+        failed.mirror_exception = u"ConnectionError: oops"
+        mirrored, ignore = self._representation(
+            media_type="text/plain", content="b", mirrored=True
+        )
+
+        mirror = DummyS3Uploader()
+        monitor = MirrorRetryMonitor(self._db, mirror=mirror)
+        eq_([failed], monitor.representation_query().all())
+        monitor.run()
+
+        # Only the representation that failed was mirrored again.
+        eq_([failed], mirror.uploaded)
+        eq_(None, failed.mirror_exception)
+        assert failed.mirrored_at
+        eq_([], monitor.representation_query().all())
@@ -1,5 +1,7 @@
 import os
 import datetime
+import shutil
+import tempfile
 from StringIO import StringIO
 from lxml import builder
 from nose.tools import (
@@ -22,11 +24,13 @@ from config import (
 )
 from opds_import import (
     SimplifiedOPDSLookup,
+    FeedPagePrefetcher,
     OPDSImporter,
     OPDSImporterWithS3Mirror,
     OPDSImportMonitor,
     OPDSXMLParser,
 )
+from util.content_store import ContentStore
 from util.opds_writer import OPDSMessage
 from metadata_layer import (
     LinkData
@@ -152,6 +156,33 @@ class TestOPDSImporter(OPDSImporterTest):
         eq_("urn:librarysimplified.org/terms/id/Gutenberg%20ID/10557", identifier2)
         eq_(datetime.datetime(2015, 1, 2, 16, 56, 40), updated2)
 
+    def test_extract_links_and_dates_match_feedparser(self):
+        # The feed is read with lxml, but the answers are the same
+        # ones feedparser would give.
+        importer = OPDSImporter(self._db, DataSource.NYT)
+        for filename in sorted(os.listdir(self.resource_path)):
+            if not filename.endswith(".opds"):
+                continue
+            feed = open(os.path.join(self.resource_path, filename)).read()
+            parsed = feedparser.parse(feed)
+            expect_links = [
+                x['href'] for x in parsed['feed'].get('links', [])
+                if x['rel'] == 'next'
+            ]
+            expect_dates = [
+                importer.last_update_date_for_feedparser_entry(entry)
+                for entry in parsed['entries']
+            ]
+            eq_(expect_links, importer.extract_next_links(feed))
+            eq_(expect_dates, importer.extract_last_update_dates(feed))
+
+        # A parsed feed can be passed in instead of the document.
+        root = importer.parse_feed(self.content_server_mini_feed)
+        eq_(
+            importer.extract_last_update_dates(self.content_server_mini_feed),
+            importer.extract_last_update_dates(root)
+        )
+
 
     def test_extract_metadata(self):
         importer = OPDSImporter(self._db, DataSource.NYT)
@@ -192,6 +223,98 @@ class TestOPDSImporter(OPDSImporterTest):
         link = OPDSImporter.extract_link(relative, "http://server")
         eq_("http://server/foo/bar", link.href)
 
+    def _comparable(self, value):
+        """Turn the output of one of the extract_* methods into
+        something that can be compared with eq_.
+        """
+        if isinstance(value, dict):
+            return dict(
+                (k, self._comparable(v)) for k, v in value.items()
+            )
+        if isinstance(value, list):
+            return [self._comparable(x) for x in value]
+        if isinstance(value, CoverageFailure):
+            return (value.obj.urn, value.transient,
+                    value.exception.split("\n")[0])
+        if hasattr(value, '__dict__'):
+            # MeasurementData.taken_at is the time the object was
+            # created, so ignore it.
+            data = dict(
+                (k, v) for k, v in value.__dict__.items() if k != 'taken_at'
+            )
+            return (value.__class__.__name__, self._comparable(data))
+        return value
+
+    def test_extract_data_from_iterparse_sanitizes_descriptions(self):
+        feed = open(
+            os.path.join(self.resource_path, "unsafe_descriptions.opds")
+        ).read()
+        data_source = DataSource.lookup(self._db, DataSource.OA_CONTENT_SERVER)
+        values, failures = OPDSImporter.extract_data_from_iterparse(
+            feed, data_source
+        )
+        [data] = values.values()
+        html, xhtml = [x.content for x in data['links']]
+        eq_(u'<p>A book with <b>bold</b> claims.</p><a href="">link</a>', html)
+        eq_(u'<p>More <i>about</i> the book.</p><img src="http://example.com/cover.png" />', xhtml)
+
+    def test_extract_data_from_iterparse_matches_feedparser(self):
+        # The single-pass parser gets the same results as combining
+        # the results of feedparser with the results of lxml, for
+        # every test feed.
+        for data_source_name in (DataSource.OA_CONTENT_SERVER,
+                                 DataSource.METADATA_WRANGLER):
+            data_source = DataSource.lookup(self._db, data_source_name)
+            for filename in sorted(os.listdir(self.resource_path)):
+                feed = open(os.path.join(self.resource_path, filename)).read()
+
+                fp_values, fp_failures = OPDSImporter.extract_data_from_feedparser(
+                    feed, data_source
+                )
+                xml_values, xml_failures = OPDSImporter.extract_metadata_from_elementtree(
+                    feed, data_source
+                )
+                expect_failures = dict(fp_failures)
+                expect_failures.update(xml_failures)
+                expect_values = {}
+                for id, fp_data in fp_values.items():
+                    if id in expect_failures:
+                        continue
+                    xml_data = xml_values.get(id, {})
+                    circulation = fp_data.get('circulation')
+                    if circulation and 'links' in xml_data:
+                        circulation['links'] = (
+                            circulation['links'] + xml_data['links']
+                        )
+                    expect_values[id] = OPDSImporter.combine(fp_data, xml_data)
+
+                values, failures = OPDSImporter.extract_data_from_iterparse(
+                    feed, data_source
+                )
+                eq_(self._comparable(expect_values), self._comparable(values))
+                eq_(self._comparable(expect_failures),
+                    self._comparable(failures))
+
+    def test_extract_data_from_iterparse_handles_exception(self):
+        class DoomedIterparseOPDSImporter(OPDSImporter):
+            @classmethod
+            def _data_detail_for_elementtree_entry(cls, *args, **kwargs):
+                raise Exception("Utter failure!")
+
+        data_source = DataSource.lookup(self._db, DataSource.OA_CONTENT_SERVER)
+        values, failures = DoomedIterparseOPDSImporter.extract_data_from_iterparse(
+            self.content_server_mini_feed, data_source
+        )
+
+        # No metadata was extracted. Both entries became
+        # CoverageFailures, as did the <simplified:message>.
+        eq_({}, values)
+        eq_(3, len(failures))
+        failure = failures['urn:librarysimplified.org/terms/id/Gutenberg%20ID/10441']
+        eq_(True, failure.transient)
+        assert "Utter failure!" in failure.exception
+        assert failures['http://www.gutenberg.org/ebooks/1984'].exception.startswith('202')
+
     def test_extract_data_from_feedparser(self):
 
         data_source = DataSource.lookup(self._db, DataSource.OA_CONTENT_SERVER)
@@ -971,7 +1094,13 @@ class TestOPDSImportMonitor(OPDSImporterTest):
         monitor = OPDSImportMonitor(self._db, "http://url", DataSource.OA_CONTENT_SERVER, OPDSImporter)
 
         # Nothing has been imported yet, so all data is new.
-        eq_(True, monitor.check_for_new_data(feed))
+        urn1 = "urn:librarysimplified.org/terms/id/Gutenberg%20ID/10441"
+        urn2 = "urn:librarysimplified.org/terms/id/Gutenberg%20ID/10557"
+        everything = set([urn1, urn2])
+        eq_(everything, monitor.check_for_new_data(feed))
+
+        # Checking didn't create any Identifiers.
+        eq_(0, self._db.query(Identifier).count())
 
         # Now import the editions.
         monitor = MockOPDSImportMonitor(
@@ -986,7 +1115,11 @@ class TestOPDSImportMonitor(OPDSImporterTest):
         # doesn't store a Timestamp.
         assert not hasattr(monitor, 'timestamp')
 
-        editions = self._db.query(Edition).all()
+        editions = sorted(
+            self._db.query(Edition), key=lambda x: x.primary_identifier.urn
+        )
+        eq_(["10441", "10557"],
+            [x.primary_identifier.identifier for x in editions])
         data_source = DataSource.lookup(self._db, DataSource.OA_CONTENT_SERVER)
 
         # If there are CoverageRecords that record work are after the updated
@@ -1001,18 +1134,18 @@ class TestOPDSImportMonitor(OPDSImporterTest):
         )
         record2.timestamp = datetime.datetime(2016, 1, 1, 1, 1, 1)
 
-        eq_(False, monitor.check_for_new_data(feed))
+        eq_(set(), monitor.check_for_new_data(feed))
 
         # If the monitor is set up to force reimport, it doesn't
         # matter that there's nothing new--we act as though there is.
         monitor.force_reimport = True
-        eq_(True, monitor.check_for_new_data(feed))
+        eq_(everything, monitor.check_for_new_data(feed))
         monitor.force_reimport = False
 
         # If an entry was updated after the date given in that entry's
         # CoverageRecord, there's new data.
         record2.timestamp = datetime.datetime(1970, 1, 1, 1, 1, 1)
-        eq_(True, monitor.check_for_new_data(feed))
+        eq_(set([urn2]), monitor.check_for_new_data(feed))
 
         # If a CoverageRecord is a transient failure, we try again
         # regardless of whether it's been updated.
@@ -1020,16 +1153,22 @@ class TestOPDSImportMonitor(OPDSImporterTest):
             r.timestamp = datetime.datetime(2016, 1, 1, 1, 1, 1)
             r.exception = "Failure!"
             r.status = CoverageRecord.TRANSIENT_FAILURE
-        eq_(True, monitor.check_for_new_data(feed))
+        eq_(everything, monitor.check_for_new_data(feed))
 
         # If a CoverageRecord is a persistent failure, we don't try again...
         for r in [record, record2]:
             r.status = CoverageRecord.PERSISTENT_FAILURE
-        eq_(False, monitor.check_for_new_data(feed))
+        eq_(set(), monitor.check_for_new_data(feed))
 
         # ...unless the feed updates.
         record.timestamp = datetime.datetime(1970, 1, 1, 1, 1, 1)
-        eq_(True, monitor.check_for_new_data(feed))
+        eq_(set([urn1]), monitor.check_for_new_data(feed))
+
+        # Only the entries that are new get imported.
+        monitor.import_one_feed(feed)
+        assert record.timestamp > datetime.datetime(2016, 1, 1)
+        eq_(CoverageRecord.PERSISTENT_FAILURE, record2.status)
+        eq_(datetime.datetime(2016, 1, 1, 1, 1, 1), record2.timestamp)
 
     def test_follow_one_link(self):
         monitor = OPDSImportMonitor(self._db, "http://url", DataSource.OA_CONTENT_SERVER, OPDSImporter)
@@ -1040,13 +1179,22 @@ class TestOPDSImportMonitor(OPDSImporterTest):
         http = DummyHTTPClient()
         http.queue_response(200, content=feed)
 
-        next_links, content = monitor.follow_one_link("http://url", do_get=http.do_get)
+        next_links, content, new_entries = monitor.follow_one_link(
+            "http://url", do_get=http.do_get
+        )
         
         eq_(1, len(next_links))
         eq_("http://localhost:5000/?after=327&size=100", next_links[0])
 
         eq_(feed, content)
 
+        # It also finds the entries that need to be imported, so the
+        # page doesn't have to be checked again when it's imported.
+        eq_(set([
+            "urn:librarysimplified.org/terms/id/Gutenberg%20ID/10441",
+            "urn:librarysimplified.org/terms/id/Gutenberg%20ID/10557",
+        ]), new_entries)
+
         # Now import the editions and add coverage records.
         monitor.importer.import_from_feed(feed)
         eq_(2, self._db.query(Edition).count())
@@ -1064,10 +1212,13 @@ class TestOPDSImportMonitor(OPDSImporterTest):
         # If there's no new data, follow_one_link returns no next links and no content.
         http.queue_response(200, content=feed)
 
-        next_links, content = monitor.follow_one_link("http://url", do_get=http.do_get)
+        next_links, content, new_entries = monitor.follow_one_link(
+            "http://url", do_get=http.do_get
+        )
 
         eq_(0, len(next_links))
         eq_(None, content)
+        eq_(set(), new_entries)
 
 
     def test_import_one_feed(self):
@@ -1135,16 +1286,200 @@ class TestOPDSImportMonitor(OPDSImporterTest):
             def follow_one_link(self, link, cutoff_date=None, do_get=None):
                 return self.responses.pop()
 
-            def import_one_feed(self, feed, feed_url):
+            def import_one_feed(self, feed, feed_url, new_entries=None):
                 self.imports.append(feed)
+                self.new_entries.append(new_entries)
 
         monitor = MockOPDSImportMonitor(self._db, "http://url", DataSource.OA_CONTENT_SERVER, OPDSImporter)
+        monitor.new_entries = []
         
-        monitor.queue_response([[], "last page"])
-        monitor.queue_response([["second next link"], "second page"])
-        monitor.queue_response([["next link"], "first page"])
+        monitor.queue_response([[], "last page", set(["c"])])
+        monitor.queue_response([["second next link"], "second page", set(["b"])])
+        monitor.queue_response([["next link"], "first page", set(["a"])])
 
         monitor.run_once(None, None)
 
         # Feeds are imported in reverse order
         eq_(["last page", "second page", "first page"], monitor.imports)
+
+        # Each page is imported with the new entries found when it
+        # was crawled.
+        eq_([set(["c"]), set(["b"]), set(["a"])], monitor.new_entries)
+
+    def test_run_once_resumes_from_checkpoint(self):
+        class MockOPDSImportMonitor(OPDSImportMonitor):
+            def __init__(self, *args, **kwargs):
+                super(MockOPDSImportMonitor, self).__init__(*args, **kwargs)
+                self.pages = {
+                    "http://url" : (["page 2"], "first page", set(["a"])),
+                    "page 2" : (["page 3"], "second page", set(["b"])),
+                    "page 3" : ([], "last page", set(["c"])),
+                }
+                self.followed = []
+                self.imports = []
+                self.new_entries = []
+                self.fail_on = None
+
+            def follow_one_link(self, link, do_get=None):
+                self.followed.append(link)
+                return self.pages[link]
+
+            def import_one_feed(self, feed, feed_url, new_entries=None):
+                if feed == self.fail_on:
+                    raise Exception("Interrupted!")
+                self.imports.append(feed)
+                self.new_entries.append(new_entries)
+
+        directory = tempfile.mkdtemp()
+        try:
+            monitor = MockOPDSImportMonitor(
+                self._db, "http://url", DataSource.OA_CONTENT_SERVER,
+                OPDSImporter, work_directory=directory
+            )
+            monitor.fail_on = "second page"
+            assert_raises(Exception, monitor.run_once, None, None)
+            eq_(["http://url", "page 2", "page 3"], monitor.followed)
+            eq_(["last page"], monitor.imports)
+
+            # The pages are on disk, along with a checkpoint.
+            path = monitor.checkpoint_path(directory)
+            assert os.path.exists(path)
+
+            # The next run doesn't crawl the feed again. It picks up
+            # with the page that failed.
+            monitor.fail_on = None
+            monitor.followed = []
+            monitor.run_once(None, None)
+            eq_([], monitor.followed)
+            eq_(["last page", "second page", "first page"], monitor.imports)
+
+            # The new entries found during the crawl were kept in the
+            # checkpoint along with the pages.
+            eq_(set(["b"]), monitor.new_entries[-2])
+            eq_(set(["a"]), monitor.new_entries[-1])
+
+            # Now that the import is done, the checkpoint and the
+            # pages are gone.
+            assert not os.path.exists(path)
+            pages = os.path.join(directory, "pages")
+            eq_([], [f for d, ignore, fs in os.walk(pages) for f in fs])
+
+            # The run after that starts from scratch.
+            monitor.imports = []
+            monitor.run_once(None, None)
+            eq_(["http://url", "page 2", "page 3"], monitor.followed)
+            eq_(["last page", "second page", "first page"], monitor.imports)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_run_once_resumes_interrupted_crawl(self):
+        class MockOPDSImportMonitor(OPDSImportMonitor):
+            def follow_one_link(self, link, do_get=None):
+                self.followed.append(link)
+                if link == "page 2" and self.fail:
+                    raise Exception("Network trouble!")
+                if link == "http://url":
+                    return ["page 2"], "first page", set(["a"])
+                return [], "last page", set(["b"])
+
+            def import_one_feed(self, feed, feed_url, new_entries=None):
+                self.imports.append(feed)
+
+        directory = tempfile.mkdtemp()
+        try:
+            monitor = MockOPDSImportMonitor(
+                self._db, "http://url", DataSource.OA_CONTENT_SERVER,
+                OPDSImporter, work_directory=directory
+            )
+            monitor.followed = []
+            monitor.imports = []
+            monitor.fail = True
+            assert_raises(Exception, monitor.run_once, None, None)
+            eq_([], monitor.imports)
+
+            # The crawl picks up with the link that failed.
+            monitor.followed = []
+            monitor.fail = False
+            monitor.run_once(None, None)
+            eq_(["page 2"], monitor.followed)
+            eq_(["last page", "first page"], monitor.imports)
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestFeedPagePrefetcher(object):
+
+    def setup(self):
+        self.root = tempfile.mkdtemp()
+        self.store = ContentStore(self.root)
+
+        # Each page links to the next one.
+        self.fetched = []
+        def get(url, headers):
+            if url == "broken":
+                raise Exception("Couldn't get %s" % url)
+            self.fetched.append(url)
+            return 200, {}, "content of page %s" % url
+        def extract_next_links(content):
+            page = int(content.split()[-1])
+            if page >= 5:
+                return []
+            return [str(page + 1)]
+        self.get = get
+        self.extract_next_links = extract_next_links
+
+    def teardown(self):
+        shutil.rmtree(self.root)
+
+    def test_lookahead(self):
+        prefetcher = FeedPagePrefetcher(
+            self.get, self.extract_next_links, self.store, lookahead=2
+        )
+        eq_((200, {}, "content of page 1"), prefetcher.get("1"))
+
+        # The next two pages are fetched in the background, but
+        # no more than that.
+        prefetcher.pending["2"].wait()
+        prefetcher.pending["3"].wait()
+        eq_(["1", "2", "3"], self.fetched)
+        eq_(["4"], prefetcher.deferred)
+
+        # Once a page is taken, the next one starts downloading.
+        eq_("content of page 2", prefetcher.get("2")[2])
+        prefetcher.pending["4"].wait()
+        eq_(["1", "2", "3", "4"], self.fetched)
+
+        # Fetched pages are kept on disk.
+        hashes = [
+            ContentStore.content_hash("content of page %d" % x)
+            for x in range(1, 5)
+        ]
+        for content_hash in hashes:
+            assert content_hash in self.store
+
+        # Closing the prefetcher deletes every page except the
+        # ones we want to keep.
+        prefetcher.close(keep=hashes[:1])
+        assert hashes[0] in self.store
+        for content_hash in hashes[1:]:
+            assert content_hash not in self.store
+        eq_({}, prefetcher.pending)
+
+    def test_no_lookahead(self):
+        prefetcher = FeedPagePrefetcher(
+            self.get, self.extract_next_links, self.store, lookahead=0
+        )
+        eq_("content of page 1", prefetcher.get("1")[2])
+        eq_("content of page 3", prefetcher.get("3")[2])
+        eq_(["1", "3"], self.fetched)
+        prefetcher.close()
+
+    def test_exception_raised_when_page_is_taken(self):
+        def extract_next_links(content):
+            return ["broken"]
+        prefetcher = FeedPagePrefetcher(
+            self.get, extract_next_links, self.store, lookahead=1
+        )
+        prefetcher.get("1")
+        assert_raises(Exception, prefetcher.get, "broken")
+        prefetcher.close()
@@ -1,5 +1,8 @@
 import os
 import contextlib
+import hashlib
+import threading
+import time
 from PIL import Image
 from StringIO import StringIO
 from nose.tools import (
@@ -18,10 +21,15 @@ from model import (
     Hyperlink,
     Representation,
 )
+from requests.exceptions import (
+    ConnectionError,
+    HTTPError,
+)
 from s3 import (
     S3Uploader,
     DummyS3Uploader,
-    MockS3Pool,
+    MockS3Connection,
+    MockS3Response,
 )
 
 class TestS3URLGeneration(DatabaseTest):
@@ -75,13 +83,255 @@ class TestUpload(DatabaseTest):
             content=svg)
 
         # 'Upload' it to S3.
-        s3pool = MockS3Pool()
-        s3 = S3Uploader(pool=s3pool)
+        connection = MockS3Connection()
+        s3 = S3Uploader(connection=connection)
         s3.mirror_one(hyperlink.resource.representation)
-        [[filename, data, bucket, media_type, ignore]] = s3pool.uploads
+        [[filename, data, bucket, media_type, ignore]] = connection.uploads
 
         # The thing that got uploaded was a PNG, not the original SVG
         # file.
         eq_(Representation.PNG_MEDIA_TYPE, media_type)
         assert 'PNG' in data
         assert 'svg' not in data
+
+
+class SlowMockS3Connection(MockS3Connection):
+    """Keeps track of how many uploads are happening at once."""
+
+    def __init__(self):
+        super(SlowMockS3Connection, self).__init__()
+        self.current = 0
+        self.most_at_once = 0
+
+    def upload(self, *args, **kwargs):
+        with self.lock:
+            self.current += 1
+            self.most_at_once = max(self.most_at_once, self.current)
+        time.sleep(0.05)
+        try:
+            return super(SlowMockS3Connection, self).upload(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.current -= 1
+
+
+class TestMirrorBatch(DatabaseTest):
+
+    def representation(self, content="content"):
+        url = "http://example.com/" + self._str
+        representation, ignore = self._representation(
+            url=url, media_type="text/plain", content=content,
+            mirrored=False
+        )
+        representation.mirror_url = (
+            "http://s3.amazonaws.com/bucket/" + self._str
+        )
+        return representation
+
+    def uploader(self, connection, **kwargs):
+        kwargs.setdefault('backoff_factor', 0)
+        return S3Uploader(connection=connection, **kwargs)
+
+    def test_success(self):
+        connection = MockS3Connection()
+        representations = [self.representation("a"), self.representation("b")]
+        self.uploader(connection).mirror_batch(representations)
+        for r in representations:
+            assert r.mirrored_at
+            eq_(None, r.mirror_exception)
+        eq_(set(["a", "b"]), set(x[1] for x in connection.uploads))
+        eq_(set(["bucket"]), set(x[2] for x in connection.uploads))
+
+        # The hash of the mirrored content was recorded.
+        eq_(hashlib.sha256("a").hexdigest(),
+            representations[0].mirror_content_hash)
+
+    def shared_url(self, content, media_type="text/plain"):
+        return S3Uploader.content_addressed_url(
+            "bucket", hashlib.sha256(content).hexdigest(), media_type
+        )
+
+    def test_duplicate_content_is_uploaded_once(self):
+        connection = MockS3Connection()
+        original = self.representation("same")
+        duplicate = self.representation("same")
+        different = self.representation("different")
+        different_url = different.mirror_url
+        self.uploader(connection).mirror_batch(
+            [original, duplicate, different]
+        )
+        eq_(2, len(connection.uploads))
+
+        # The duplicated content was uploaded to a key named after
+        # its hash, and both Representations use that copy.
+        shared = self.shared_url("same")
+        assert duplicate.mirrored_at
+        eq_(shared, original.mirror_url)
+        eq_(shared, duplicate.mirror_url)
+        eq_(original.mirror_content_hash, duplicate.mirror_content_hash)
+
+        # Content that only shows up once goes where it was going.
+        eq_(different_url, different.mirror_url)
+
+    def test_content_already_mirrored_is_not_uploaded(self):
+        connection = MockS3Connection()
+        uploader = self.uploader(connection)
+        original = self.representation("same")
+        original_url = original.mirror_url
+        uploader.mirror_one(original)
+        eq_(1, len(connection.uploads))
+        eq_(original_url, original.mirror_url)
+
+        # The original's copy isn't shared, since it might be
+        # overwritten with different content. The second copy goes to
+        # the content-addressed key.
+        duplicate = self.representation("same")
+        uploader.mirror_one(duplicate)
+        eq_(2, len(connection.uploads))
+        eq_(self.shared_url("same"), duplicate.mirror_url)
+        eq_(original_url, original.mirror_url)
+
+        # Every copy after that uses the shared copy.
+        third = self.representation("same")
+        uploader.mirror_one(third)
+        eq_(2, len(connection.uploads))
+        eq_(duplicate.mirror_url, third.mirror_url)
+        assert third.mirrored_at
+
+        # The same content with a different media type is a different
+        # file as far as S3 is concerned.
+        html = self.representation("same")
+        html.media_type = "text/html"
+        uploader.mirror_one(html)
+        eq_(3, len(connection.uploads))
+        assert html.mirror_url != duplicate.mirror_url
+
+    def test_shared_copy_is_never_overwritten(self):
+        connection = MockS3Connection()
+        uploader = self.uploader(connection)
+        original = self.representation("same")
+        duplicate = self.representation("same")
+        uploader.mirror_batch([original, duplicate])
+        shared = self.shared_url("same")
+        eq_(shared, original.mirror_url)
+
+        # The original gets new content, but its mirror_url still
+        # points at the shared copy. The new content goes to its own
+        # content-addressed key instead.
+        original.content = "new content"
+        uploader.mirror_one(original)
+        [filename, data, bucket, media_type, extra] = connection.uploads[-1]
+        eq_("new content", data)
+        eq_(self.shared_url("new content"), original.mirror_url)
+        eq_(shared, duplicate.mirror_url)
+
+        # Nothing but the original content was ever written to the
+        # shared key.
+        ignore, shared_key = S3Uploader.bucket_and_filename(shared)
+        eq_(["same"], [x[1] for x in connection.uploads if x[0] == shared_key])
+
+    def test_content_is_opened_only_when_uploaded(self):
+        connection = SlowMockS3Connection()
+        representations = [self.representation(str(i)) for i in range(6)]
+        open_files = []
+        most_open = []
+        for representation in representations:
+            original = representation.external_content
+            def external_content(original=original):
+                fh = original()
+                open_files.append(fh)
+                most_open.append(len([x for x in open_files if not x.closed]))
+                return fh
+            representation.external_content = external_content
+        self.uploader(connection, max_in_flight=2).mirror_batch(
+            representations
+        )
+        eq_(6, len(connection.uploads))
+        assert max(most_open) <= 2
+
+    def test_duplicate_of_failed_upload_also_fails(self):
+        connection = MockS3Connection()
+        connection.failures = [ConnectionError("oops")]
+        original = self.representation("same")
+        duplicate = self.representation("same")
+        self.uploader(connection, max_retries=0).mirror_batch(
+            [original, duplicate]
+        )
+        eq_(None, duplicate.mirrored_at)
+        eq_("ConnectionError: oops", duplicate.mirror_exception)
+
+    def test_large_file_is_uploaded_in_parts(self):
+        connection = MockS3Connection()
+        representation = self.representation("0123456789")
+        uploader = self.uploader(
+            connection, multipart_threshold=5, part_size=4
+        )
+        uploader.mirror_one(representation)
+        assert representation.mirrored_at
+        [[filename, data, bucket, media_type, extra]] = connection.uploads
+        eq_("0123456789", data)
+        eq_("text/plain", media_type)
+        eq_(3, extra['parts'])
+
+    def test_transient_failures_are_retried(self):
+        connection = MockS3Connection()
+        connection.failures = [ConnectionError("oops"), ConnectionError("oops")]
+        representation = self.representation()
+        self.uploader(connection, max_retries=2).mirror_one(representation)
+        assert representation.mirrored_at
+        eq_(3, connection.requests)
+
+    def test_too_many_transient_failures(self):
+        connection = MockS3Connection()
+        connection.failures = [ConnectionError("oops")] * 3
+        representation = self.representation()
+        self.uploader(connection, max_retries=2).mirror_one(representation)
+        eq_(None, representation.mirrored_at)
+        eq_("ConnectionError: oops", representation.mirror_exception)
+        eq_([], connection.uploads)
+
+    def test_permanent_failure_is_not_retried(self):
+        connection = MockS3Connection()
+        forbidden = HTTPError(
+            "403 Forbidden", response=MockS3Response("url", 403)
+        )
+        connection.failures = [forbidden]
+        representation = self.representation()
+        self.uploader(connection, max_retries=2).mirror_one(representation)
+        eq_(1, connection.requests)
+        assert "403 Forbidden" in representation.mirror_exception
+
+    def test_failed_multipart_upload_is_cancelled(self):
+        connection = MockS3Connection()
+        representation = self.representation("0123456789")
+        uploader = self.uploader(
+            connection, multipart_threshold=5, part_size=4, max_retries=0
+        )
+        # The upload is initiated, then the first part fails.
+        connection.failures = [None, ConnectionError("oops")]
+        uploader.mirror_one(representation)
+        eq_(None, representation.mirrored_at)
+        eq_([representation.mirror_url.split("/bucket/")[1]],
+            connection.cancelled)
+
+    def test_concurrency_limit(self):
+        connection = SlowMockS3Connection()
+        representations = [self.representation(str(i)) for i in range(6)]
+        self.uploader(connection, max_in_flight=2).mirror_batch(
+            representations
+        )
+        eq_(6, len(connection.uploads))
+        eq_(2, connection.most_at_once)
+
+    def test_memory_budget(self):
+        connection = SlowMockS3Connection()
+        representations = [
+            self.representation(str(i) * 10) for i in range(4)
+        ]
+        uploader = self.uploader(
+            connection, max_in_flight=4, memory_budget=15
+        )
+        uploader.mirror_batch(representations)
+        eq_(4, len(connection.uploads))
+        # Only one 10-byte file fits in the budget at a time.
+        eq_(1, connection.most_at_once)
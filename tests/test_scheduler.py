@@ -0,0 +1,175 @@
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+
+from . import DatabaseTest
+from scheduler import (
+    ScheduledJob,
+    Scheduler,
+)
+
+
+class MockClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class MockJob(object):
+
+    def __init__(self, name, interval_seconds=60, clock=None,
+                 duration=0, exception=None):
+        self.service_name = name
+        self.interval_seconds = interval_seconds
+        self.clock = clock
+        self.duration = duration
+        self.exception = exception
+        self.stop_running = False
+        self.runs = 0
+
+    def run(self):
+        self.runs += 1
+        if self.clock:
+            self.clock.now += self.duration
+        if self.exception:
+            raise self.exception
+
+
+class TestScheduledJob(object):
+
+    def test_interval(self):
+        job = ScheduledJob(MockJob("job", 30))
+        eq_(30, job.interval_seconds)
+        eq_(10, ScheduledJob(MockJob("job", 30), 10).interval_seconds)
+
+        # A job without an interval of its own gets the default.
+        runnable = MockJob("job")
+        del runnable.interval_seconds
+        eq_(Scheduler.DEFAULT_INTERVAL_SECONDS,
+            ScheduledJob(runnable).interval_seconds)
+
+    def test_record(self):
+        job = ScheduledJob(MockJob("job"))
+        eq_("job: never run, 0 skipped.", job.summary())
+        job.record(1)
+        job.record(3, Exception("oops"))
+        eq_(2, job.runs)
+        eq_(1, job.failures)
+        eq_(3, job.max_time)
+        eq_("job: 2 runs, 1 failures, 0 skipped. Last run 3.00s, average 2.00s, longest 3.00s.", job.summary())
+
+    def test_stop(self):
+        runnable = MockJob("job")
+        ScheduledJob(runnable).stop()
+        eq_(True, runnable.stop_running)
+
+
+class TestScheduler(DatabaseTest):
+
+    def setup(self):
+        super(TestScheduler, self).setup()
+        self.clock = MockClock()
+        self.scheduler = Scheduler(self._db, clock=self.clock.time)
+
+    def teardown(self):
+        self.scheduler.close()
+        super(TestScheduler, self).teardown()
+
+    def test_add(self):
+        job = self.scheduler.add(MockJob("job", 100))
+
+        # The first run happens sometime during the first interval.
+        assert 1000 <= job.next_run <= 1000 + 100 * Scheduler.JITTER
+        eq_([job], self.scheduler.jobs)
+
+    def test_run_pending(self):
+        slow = self.scheduler.add(
+            MockJob("slow", 60, self.clock, duration=100)
+        )
+        later = self.scheduler.add(MockJob("later", 60))
+        broken = self.scheduler.add(
+            MockJob("broken", 60, exception=Exception("oops"))
+        )
+        slow.next_run = 900
+        broken.next_run = 1000
+        later.next_run = 2000
+
+        self.scheduler.run_pending()
+        eq_(1, slow.runnable.runs)
+        eq_(1, broken.runnable.runs)
+        eq_(0, later.runnable.runs)
+
+        # The slow job's next run is scheduled from when it finished,
+        # so it doesn't overlap with itself.
+        eq_(100, slow.last_time)
+        assert 1100 + 54 <= slow.next_run <= 1100 + 66
+
+        # The broken job's exception was recorded, not raised.
+        eq_(1, broken.failures)
+        eq_("oops", broken.last_exception.message)
+
+    def test_job_running_elsewhere_is_skipped(self):
+        job = self.scheduler.add(MockJob("job"))
+        job.next_run = 0
+
+        # Another process is running this job.
+        other = self._db.get_bind().engine.connect()
+        try:
+            other.execute("select pg_advisory_lock(hashtext('job'))")
+            self.scheduler.run_pending()
+            eq_(0, job.runnable.runs)
+            eq_(1, job.skipped)
+            other.execute("select pg_advisory_unlock(hashtext('job'))")
+        finally:
+            other.close()
+
+        job.next_run = 0
+        self.scheduler.run_pending()
+        eq_(1, job.runnable.runs)
+
+        # Our lock was released after the run.
+        eq_(True, self._db.execute(
+            "select pg_try_advisory_lock(hashtext('job'))").scalar())
+        self._db.execute("select pg_advisory_unlock(hashtext('job'))")
+
+    def test_lock_survives_commit(self):
+        job = self.scheduler.add(MockJob("job"))
+        eq_(True, self.scheduler.lock(job))
+
+        # Committing hands the session's connection back to the pool,
+        # but the lock is held on a connection of its own.
+        self._db.commit()
+        other = self._db.get_bind().engine.connect()
+        try:
+            eq_(False, other.execute(
+                "select pg_try_advisory_lock(hashtext('job'))").scalar())
+        finally:
+            other.close()
+
+        eq_(True, self.scheduler.unlock(job))
+        eq_(True, self.scheduler.lock(job))
+        self.scheduler.close()
+        eq_(None, self.scheduler.locks._connection)
+
+    def test_run_until_shutdown(self):
+        scheduler = self.scheduler
+
+        class ShutdownJob(MockJob):
+            def run(self):
+                super(ShutdownJob, self).run()
+                if self.runs == 2:
+                    scheduler.shutdown()
+
+        job = scheduler.add(ShutdownJob("job", 0))
+        other = scheduler.add(MockJob("other", 0))
+        scheduler.run()
+
+        # The job that called shutdown() was asked to stop.
+        eq_(2, job.runnable.runs)
+        eq_(True, job.runnable.stop_running)
+        assert other.runnable.runs in (1, 2)
+        eq_(None, scheduler.current_job)
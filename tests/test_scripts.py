@@ -1,5 +1,6 @@
 import datetime
 import os
+from StringIO import StringIO
 import tempfile
 
 from nose.tools import (
@@ -25,9 +26,11 @@ from scripts import (
     DatabaseMigrationScript,
     IdentifierInputScript,
     RunCoverageProviderScript,
+    RunSweepMonitorShardScript,
     WorkProcessingScript,
     MockStdin,
 )
+from .test_monitor import DummySweepMonitor
 from util.opds_writer import (
     OPDSFeed,
 )
@@ -47,6 +50,29 @@ class TestScript(DatabaseTest):
 
         assert_raises(ValueError, Script.parse_time, "201601-01")
 
+    def test_run_exclusively(self):
+        script = Script(self._db)
+        runs = []
+        run = lambda: runs.append(1)
+
+        # Another process is running this job.
+        other = self._db.get_bind().engine.connect()
+        try:
+            other.execute("select pg_advisory_lock(hashtext('job'))")
+            eq_(False, script.run_exclusively("job", run))
+            eq_([], runs)
+            other.execute("select pg_advisory_unlock(hashtext('job'))")
+        finally:
+            other.close()
+
+        eq_(True, script.run_exclusively("job", run))
+        eq_([1], runs)
+
+        # Our lock was released after the run.
+        eq_(True, self._db.execute(
+            "select pg_try_advisory_lock(hashtext('job'))").scalar())
+        self._db.execute("select pg_advisory_unlock(hashtext('job'))")
+
 
 class TestIdentifierInputScript(DatabaseTest):
 
@@ -109,8 +135,37 @@ class TestRunCoverageProviderScript(DatabaseTest):
         eq_(datetime.datetime(2016, 5, 1), parsed.cutoff_time)
         eq_([identifier], parsed.identifiers)
         eq_(identifier.type, parsed.identifier_type)
+        eq_(False, parsed.claim_items)
+
+        parsed = RunCoverageProviderScript.parse_command_line(
+            self._db, ["--claim-items"], MockStdin()
+        )
+        eq_(True, parsed.claim_items)
 
         
+class TestRunSweepMonitorShardScript(DatabaseTest):
+
+    def test_run_one_shard(self):
+        identifiers = [self._identifier() for i in range(4)]
+        script = RunSweepMonitorShardScript(
+            DummySweepMonitor, self._db, ["--shards=2", "--shard=1"]
+        )
+        script.do_run()
+        [(start, end), (start2, end2)] = script.monitor.shard_ranges(2)
+        eq_([x for x in identifiers if x.id > start2], script.monitor.swept)
+
+    def test_report_progress(self):
+        identifiers = [self._identifier() for i in range(4)]
+        script = RunSweepMonitorShardScript(
+            DummySweepMonitor, self._db, ["--shards=2"]
+        )
+        output = StringIO()
+        script.do_run(output)
+        [(start, end), (start2, end2)] = script.monitor.shard_ranges(2)
+        eq_("Shard 0 (IDs %d-%d): not sweeping\nShard 1 (IDs %d-): not sweeping\n" % (start, end, start2),
+            output.getvalue())
+
+
 class TestWorkProcessingScript(DatabaseTest):
 
     def test_make_query(self):
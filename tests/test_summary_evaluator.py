@@ -1,12 +1,20 @@
 """Test the code that evaluates the quality of summaries."""
 
-from util.summary import SummaryEvaluator
+from util.summary import (
+    NounPhraseExtractor,
+    RegexNounPhraseExtractor,
+    SummaryEvaluator,
+    noun_phrase_agreement,
+)
 from nose.tools import eq_, set_trace
 
 class TestSummaryEvaluator(object):
 
+    # Use the default noun phrase extractor.
+    extractor = None
+
     def _best(self, *summaries):
-        e = SummaryEvaluator()
+        e = SummaryEvaluator(noun_phrase_extractor=self.extractor)
         for s in summaries:
             e.add(s)
         e.ready()
@@ -42,7 +50,7 @@ class TestSummaryEvaluator(object):
         """
         dutch = "Op haar nieuwe school leert de jarige Bella (ik-figuur) een mysterieuze jongen kennen op wie ze ogenblikkelijk verliefd wordt. Hij blijkt een groot geheim te hebben. Vanaf ca. jaar."
         
-        evaluator = SummaryEvaluator()
+        evaluator = SummaryEvaluator(noun_phrase_extractor=self.extractor)
         evaluator.add(dutch)
         evaluator.ready()
 
@@ -59,7 +67,7 @@ class TestSummaryEvaluator(object):
 
         english = "After the warrior cat Clans settle into their new homes, the harmony they once had disappears as the clans start fighting each other, until the day their common enemy the badger."
 
-        evaluator = SummaryEvaluator()
+        evaluator = SummaryEvaluator(noun_phrase_extractor=self.extractor)
         evaluator.add(english)
         evaluator.ready()
 
@@ -69,3 +77,123 @@ class TestSummaryEvaluator(object):
         english_language_penalty = evaluator.score(
             english, apply_language_penalty=True)
         eq_(english_language_penalty, english_no_language_penalty)
+
+
+class TestSummaryEvaluatorWithRegexExtractor(object):
+
+    def _best(self, *summaries):
+        e = SummaryEvaluator(
+            noun_phrase_extractor=RegexNounPhraseExtractor.name
+        )
+        for s in summaries:
+            e.add(s)
+        e.ready()
+        return e.best_choice()[0]
+
+    def test_four_sentences_is_better_than_three(self):
+        s1 = "Hey, this is Sentence one. And now, here is Sentence two."
+        s2 = "Sentence one. Sentence two. Sentence three. Sentence four."
+        eq_(s2, self._best(s1, s2))
+
+    def test_four_sentences_is_better_than_five(self):
+        s1 = "Sentence 1. Sentence 2. Sentence 3. Sentence 4. Sentence 5."
+        s2 = "Sentence one. Sentence two. Sentence three.  Sentence four."
+        eq_(s2, self._best(s1, s2))
+
+    def test_noun_phrase_coverage_is_important(self):
+        s1 = "The story of Alice and the White Rabbit."
+        s2 = "The story of Alice and the Mock Turtle."
+        s3 = "Alice meets the Mock Turtle and the White Rabbit."
+        eq_(s3, self._best(s1, s2, s3))
+
+
+class MockExtractor(NounPhraseExtractor):
+
+    name = "mock"
+
+    def __init__(self, noun_phrases=None):
+        self.noun_phrases = noun_phrases or {}
+        self.analyzed = []
+
+    def analyze(self, summary):
+        self.analyzed.append(summary)
+        return self.noun_phrases.get(summary, []), 1
+
+
+class TestRegexNounPhraseExtractor(object):
+
+    def test_analyze(self):
+        extractor = RegexNounPhraseExtractor()
+        phrases, sentences = extractor.analyze(
+            u"They meet Alice and the Mock Turtle. The White Rabbit's "
+            u"pocket watch is late!"
+        )
+        eq_([u"alice", u"mock turtle", u"white rabbit", u"pocket watch"],
+            phrases)
+        eq_(2, sentences)
+
+        # The first word of a sentence is capitalized no matter what.
+        phrases, sentences = extractor.analyze(u"Tiny sentence. Alice")
+        eq_([u"tiny sentence", u"alice"], phrases)
+
+        phrases, sentences = extractor.analyze(
+            u"A tale of tragic misadventure and Victorian London."
+        )
+        eq_([u"tragic misadventure", u"victorian london"], phrases)
+        eq_(1, sentences)
+
+        eq_(([], 1), extractor.analyze(u""))
+
+
+class TestAnalysisCache(object):
+
+    def test_summary_is_analyzed_once(self):
+        SummaryEvaluator.analysis_cache.clear()
+        extractor = MockExtractor()
+        evaluator = SummaryEvaluator(noun_phrase_extractor=extractor)
+        evaluator.add("Some text.")
+
+        # A different evaluator looking at the same text can reuse
+        # the analysis.
+        evaluator = SummaryEvaluator(noun_phrase_extractor=extractor)
+        evaluator.add("Some text.")
+        evaluator.add("Some other text.")
+        eq_(["Some text.", "Some other text."], extractor.analyzed)
+
+        # The evaluator knows which analyses it had to perform itself.
+        eq_([SummaryEvaluator.content_hash("Some other text.")],
+            evaluator.new_analyses.keys())
+
+    def test_remember(self):
+        SummaryEvaluator.analysis_cache.clear()
+        extractor = MockExtractor()
+        evaluator = SummaryEvaluator(noun_phrase_extractor=extractor)
+
+        # An analysis performed elsewhere is used instead of analyzing
+        # the summary again.
+        evaluator.remember(
+            SummaryEvaluator.content_hash(u"Some text."), ([u"text"], 3)
+        )
+        evaluator.add("Some text.")
+        eq_([], extractor.analyzed)
+        eq_(([u"text"], 3), evaluator.analyses[u"Some text."])
+        eq_({}, evaluator.new_analyses)
+
+
+class TestNounPhraseAgreement(object):
+
+    def test_noun_phrase_agreement(self):
+        baseline = MockExtractor({
+            "a" : ["alice", "white rabbit"],
+            "b" : ["mock turtle"],
+        })
+        same = MockExtractor(baseline.noun_phrases)
+        eq_(1, noun_phrase_agreement(["a", "b", "c"], same, baseline))
+
+        different = MockExtractor({
+            "a" : ["alice"],
+            "b" : ["turtle"],
+        })
+        # Half the phrases in "a" match, none of the phrases in "b"
+        # match, and the extractors agree "c" has no noun phrases.
+        eq_(0.5, noun_phrase_agreement(["a", "b", "c"], different, baseline))
@@ -18,6 +18,7 @@ from util import (
     Bigrams,
     english_bigrams,
     LanguageCodes,
+    LRUCache,
     MetadataSimilarity,
     TitleProcessor,
     fast_query_count,
@@ -469,6 +470,25 @@ class TestOPDSAuthenticationDocument(object):
 
         eq_(doc['links'], {'complex-link': {'href': 'http://baz', 'type': 'text/html'}, 'double-link': [{'href': 'http://bar1'}, {'href': 'http://bar2'}], 'single-link': {'href': 'http://foo'}, 'complex-links': [{'href': 'http://comp1', 'type': 'text/html'}, {'href': 'http://comp2', 'type': 'text/plain'}]})
 
+class TestLRUCache(object):
+
+    def test_least_recently_used_item_is_evicted(self):
+        cache = LRUCache(capacity=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        eq_(1, cache.get("a"))
+        cache.set("c", 3)
+        eq_(2, len(cache))
+        assert "b" not in cache
+        eq_(None, cache.get("b"))
+        eq_("default", cache.get("b", "default"))
+        eq_(1, cache.get("a"))
+        eq_(3, cache.get("c"))
+
+        cache.clear()
+        eq_(0, len(cache))
+
+
 class TestMedian(object):
 
     def test_median(self):
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+from nose.tools import (
+    assert_raises_regexp,
+    eq_,
+    set_trace,
+)
+
+from util.content_store import (
+    ContentStore,
+    default_file_mode,
+)
+
+class TestContentStore(object):
+
+    def setup(self):
+        self.root = tempfile.mkdtemp()
+        self.store = ContentStore(self.root)
+
+    def teardown(self):
+        shutil.rmtree(self.root)
+
+    def test_put_and_get(self):
+        content_hash = self.store.put("some content")
+        eq_(ContentStore.content_hash("some content"), content_hash)
+        assert content_hash in self.store
+        eq_("some content", self.store.get(content_hash))
+
+        # The blob is sharded into subdirectories by its hash.
+        path = self.store.path(content_hash)
+        eq_(os.path.join(self.root, content_hash[:2], content_hash[2:4],
+                         content_hash), path)
+        assert os.path.exists(path)
+
+    def test_file_mode(self):
+        # Blobs can be read by anyone the umask allows, just like
+        # any other new file.
+        old_umask = os.umask(022)
+        try:
+            eq_(0644, default_file_mode())
+        finally:
+            os.umask(old_umask)
+
+        content_hash = self.store.put("some content")
+        mode = os.stat(self.store.path(content_hash)).st_mode & 0777
+        eq_(ContentStore.FILE_MODE, mode)
+
+    def test_identical_content_is_stored_once(self):
+        h1 = self.store.put("some content")
+        h2 = self.store.put(u"some content")
+        eq_(h1, h2)
+        files = [f for d, ignore, fs in os.walk(self.root) for f in fs]
+        eq_([h1], files)
+
+    def test_open(self):
+        content_hash = self.store.put("some content")
+        fh = self.store.open(content_hash)
+        eq_("some", fh.read(4))
+        eq_(" content", fh.read())
+
+        # Empty content can be stored and read.
+        eq_("", self.store.open(self.store.put("")).read())
+
+    def test_missing_content(self):
+        assert "abcd" not in self.store
+        assert_raises_regexp(
+            ValueError, "does not exist", self.store.get, "abcd"
+        )
+
+    def test_delete(self):
+        content_hash = self.store.put("some content")
+        self.store.delete(content_hash)
+        assert content_hash not in self.store
+
+        # Deleting a blob that's not there does nothing.
+        self.store.delete(content_hash)
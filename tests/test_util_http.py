@@ -1,5 +1,7 @@
 import requests
 import json
+import urllib2
+from requests.packages.urllib3.util.retry import Retry
 from util.http import (
     HTTP, 
     BadResponseException,
@@ -177,6 +179,74 @@ class TestHTTP(object):
             assert isinstance(v, bytes)
         assert isinstance(data, bytes)
 
+    def test_request_with_timeout_uses_pooled_session(self):
+        class MockSession(object):
+            def __init__(self):
+                self.requests = []
+
+            def request(self, *args, **kwargs):
+                self.requests.append((args, kwargs))
+                return MockRequestsResponse(200, content="Success!")
+
+        session = MockSession()
+        old_session_for = HTTP.session_for
+        HTTP.session_for = classmethod(lambda cls, url: session)
+        try:
+            response = HTTP.get_with_timeout("http://url/")
+        finally:
+            HTTP.session_for = old_session_for
+        eq_("Success!", response.content)
+        [(args, kwargs)] = session.requests
+        eq_(("GET", "http://url/"), args)
+        eq_(20, kwargs['timeout'])
+
+
+class TestHTTPSessions(object):
+
+    def teardown(self):
+        HTTP.configure(pool_size=10, max_retries=0, backoff_factor=0.5)
+
+    def test_one_session_per_host(self):
+        HTTP.reset_sessions()
+        s1 = HTTP.session_for("https://example.com/foo")
+        s2 = HTTP.session_for("https://example.com/bar?baz")
+        s3 = HTTP.session_for("http://example.com/foo")
+        s4 = HTTP.session_for("https://example.org/foo")
+        assert s1 is s2
+        assert s1 is not s3
+        assert s1 is not s4
+
+        # Resetting the sessions creates new ones.
+        HTTP.reset_sessions()
+        assert HTTP.session_for("https://example.com/foo") is not s1
+
+    def test_configure(self):
+        HTTP.configure(pool_size=3, max_retries=2, backoff_factor=1)
+        session = HTTP.session_for("https://example.com/")
+        adapter = session.get_adapter("https://example.com/")
+        eq_(3, adapter._pool_maxsize)
+        retry = adapter.max_retries
+        assert isinstance(retry, Retry)
+        eq_(2, retry.total)
+        eq_(1, retry.backoff_factor)
+        eq_(HTTP.RETRY_STATUS_CODES, retry.status_forcelist)
+
+        # By default, requests aren't retried.
+        HTTP.configure(max_retries=0)
+        session = HTTP.session_for("https://example.com/")
+        adapter = session.get_adapter("https://example.com/")
+        eq_(0, adapter.max_retries.total)
+
+    def test_cookies_not_kept_between_requests(self):
+        session = HTTP.session_for("https://example.com/")
+        cookie = requests.cookies.create_cookie(
+            "name", "value", domain="example.com")
+        session.cookies.set_cookie_if_ok(
+            cookie, urllib2.Request("https://example.com/")
+        )
+        eq_(0, len(session.cookies))
+
+
 class TestRemoteIntegrationException(object):
 
     def test_with_service_name(self):
@@ -0,0 +1,228 @@
+from nose.tools import (
+    assert_raises,
+    eq_,
+    set_trace,
+)
+
+from testing import MockRequestsResponse
+from util.http import (
+    HTTP,
+    BadResponseException,
+)
+from util.rate_limit import (
+    RateLimiter,
+    TokenBucket,
+    retry_after,
+)
+
+
+class MockClock(object):
+    """A clock that only moves when something sleeps."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket(object):
+
+    def bucket(self, rate, capacity=None):
+        self.clock = MockClock()
+        return TokenBucket(
+            rate, capacity, clock=self.clock.time, sleep=self.clock.sleep
+        )
+
+    def test_burst_then_steady_rate(self):
+        bucket = self.bucket(2, capacity=3)
+
+        # The bucket starts out full, so the first three tokens are
+        # free.
+        eq_([0, 0, 0], [bucket.take() for i in range(3)])
+        eq_([], self.clock.slept)
+
+        # After that, we get one token every half second.
+        eq_(0.5, bucket.take())
+        eq_(0.5, bucket.take())
+        eq_([0.5, 0.5], self.clock.slept)
+
+    def test_tokens_accumulate_up_to_capacity(self):
+        bucket = self.bucket(1, capacity=2)
+        bucket.take(2)
+
+        # A long time passes, but the bucket only holds two tokens.
+        self.clock.now += 100
+        eq_(0, bucket.take(2))
+        eq_(1, bucket.take())
+
+    def test_rate_must_be_positive(self):
+        assert_raises(ValueError, TokenBucket, 0)
+
+    def test_pause(self):
+        bucket = self.bucket(2, capacity=3)
+        bucket.pause(10)
+
+        # Even though the bucket was full, the next token is a
+        # ten-second wait away.
+        eq_(10.5, bucket.take())
+
+    def test_shared(self):
+        bucket = TokenBucket.shared("test service", 2, 3)
+        eq_(bucket, TokenBucket.shared("test service", 2, 3))
+        assert bucket != TokenBucket.shared("another service", 2, 3)
+
+        # If the configuration changes, so does the bucket.
+        new_bucket = TokenBucket.shared("test service", 1)
+        assert new_bucket != bucket
+        eq_(1, new_bucket.rate)
+
+
+class TestRetryAfter(object):
+
+    def test_retry_after(self):
+        eq_(None, retry_after({}))
+        eq_(None, retry_after(None))
+        eq_(None, retry_after({"Retry-After": "whenever"}))
+        eq_(120, retry_after({"Retry-After": "120"}))
+        eq_(5, retry_after({"retry-after": "5"}))
+        eq_(0, retry_after({"Retry-After": "-5"}))
+
+        # An HTTP date is turned into a number of seconds from now.
+        now = 784111777
+        eq_(30, retry_after(
+            {"Retry-After": "Sun, 06 Nov 1994 08:50:07 GMT"}, now=now
+        ))
+
+
+class MockBucket(object):
+
+    def __init__(self):
+        self.taken = 0
+        self.paused = []
+
+    def take(self, tokens=1):
+        self.taken += tokens
+        return 0
+
+    def pause(self, seconds):
+        self.paused.append(seconds)
+
+
+class TestRateLimiter(object):
+
+    def setup(self):
+        self.responses = []
+        self.made = 0
+
+    def make_request(self):
+        self.made += 1
+        return self.responses.pop(0)
+
+    def test_request(self):
+        bucket = MockBucket()
+        limiter = RateLimiter("service", bucket)
+        self.responses = [(200, {}, "ok")]
+        eq_((200, {}, "ok"), limiter.request(self.make_request))
+        eq_(1, bucket.taken)
+        eq_([], bucket.paused)
+
+    def test_throttled_request_is_retried(self):
+        bucket = MockBucket()
+        limiter = RateLimiter("service", bucket)
+        self.responses = [
+            MockRequestsResponse(429, {"Retry-After": "30"}),
+            MockRequestsResponse(429),
+            MockRequestsResponse(429),
+            # A 503 only counts as throttling if there's a Retry-After.
+            MockRequestsResponse(503, {"Retry-After": "10"}),
+            MockRequestsResponse(503),
+        ]
+        response = limiter.request(self.make_request)
+        eq_(503, response.status_code)
+        eq_(5, bucket.taken)
+
+        # Everyone sharing the bucket was told to back off: for as
+        # long as the server asked, or for twice as long each time
+        # there was no Retry-After.
+        eq_([30, 2, 4, 10], bucket.paused)
+
+        # A request that isn't throttled resets the backoff.
+        eq_(RateLimiter.MIN_BACKOFF, limiter.backoff)
+
+    def test_give_up_eventually(self):
+        slept = []
+        limiter = RateLimiter("service", sleep=slept.append)
+        self.responses = [(429, {}, "slow down")] * RateLimiter.MAX_ATTEMPTS
+        eq_((429, {}, "slow down"), limiter.request(self.make_request))
+        eq_(RateLimiter.MAX_ATTEMPTS, self.made)
+
+        # With no bucket, the limiter slept between attempts. The
+        # backoff doubles each time, up to a maximum.
+        eq_([1, 2, 4, 8], slept)
+        limiter.backoff = RateLimiter.MAX_BACKOFF
+        eq_(RateLimiter.MAX_BACKOFF, limiter.throttled_for(429, {}))
+        eq_(RateLimiter.MAX_BACKOFF, limiter.backoff)
+
+    def test_throttled_request_through_http(self):
+        # HTTP raises an exception on a 5xx response, but a 503 with
+        # Retry-After still gets backed off and retried.
+        class MockSession(object):
+            def __init__(self, responses):
+                self.responses = responses
+                self.requests = []
+
+            def request(self, *args, **kwargs):
+                self.requests.append((args, kwargs))
+                return self.responses.pop(0)
+
+        def request_through(responses, limiter):
+            session = MockSession(responses)
+            old_session_for = HTTP.session_for
+            HTTP.session_for = classmethod(lambda cls, url: session)
+            try:
+                return limiter.request(
+                    lambda: HTTP.request_with_timeout("GET", "http://url/")
+                ), session
+            finally:
+                HTTP.session_for = old_session_for
+
+        bucket = MockBucket()
+        limiter = RateLimiter("service", bucket)
+        response, session = request_through(
+            [MockRequestsResponse(503, {"Retry-After": "10"}),
+             MockRequestsResponse(200, content="ok")],
+            limiter
+        )
+        eq_("ok", response.content)
+        eq_(2, len(session.requests))
+        eq_([10], bucket.paused)
+
+        # A 503 without Retry-After isn't throttling; it's just an error.
+        bucket = MockBucket()
+        limiter = RateLimiter("service", bucket)
+        assert_raises(
+            BadResponseException, request_through,
+            [MockRequestsResponse(503, content="down")], limiter
+        )
+        eq_([], bucket.paused)
+
+        # If we're still being throttled on the last try, the error
+        # propagates.
+        slept = []
+        limiter = RateLimiter("service", sleep=slept.append)
+        throttled = [
+            MockRequestsResponse(503, {"Retry-After": "1"})
+            for i in range(RateLimiter.MAX_ATTEMPTS)
+        ]
+        try:
+            request_through(throttled, limiter)
+            raise AssertionError("Expected a BadResponseException.")
+        except BadResponseException, e:
+            eq_(503, e.response.status_code)
+        eq_([1] * (RateLimiter.MAX_ATTEMPTS - 1), slept)
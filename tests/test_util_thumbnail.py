@@ -0,0 +1,96 @@
+import os
+from cStringIO import StringIO
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+from PIL import Image
+
+from util.thumbnail import (
+    ThumbnailPipeline,
+    scale_image,
+)
+
+def sample_cover(name, format=None):
+    base_path = os.path.split(__file__)[0]
+    path = os.path.join(base_path, "files", "covers", name)
+    content = open(path).read()
+    if format:
+        # Convert the sample cover into some other format.
+        output = StringIO()
+        Image.open(StringIO(content)).convert('RGB').save(output, format)
+        content = output.getvalue()
+    return content
+
+
+class TestScaleImage(object):
+
+    def test_multiple_sizes_from_one_image(self):
+        # This image is 400x600.
+        content = sample_cover("test-book-cover.png")
+        result = scale_image(
+            "key", content, "image/png", [(200, 300), (100, 150)], "png"
+        )
+        eq_("key", result.key)
+        eq_(None, result.exception)
+        eq_((400, 600), result.original_size)
+        [(large, large_size), (small, small_size)] = result.thumbnails
+        eq_((200, 300), large_size)
+        eq_((100, 150), small_size)
+        eq_((100, 150), Image.open(StringIO(small)).size)
+        assert result.elapsed >= 0
+
+    def test_jpeg_is_scaled_while_decoding(self):
+        content = sample_cover("test-book-cover.png", "jpeg")
+        result = scale_image(
+            "key", content, "image/jpeg", [(200, 300)], "jpeg"
+        )
+        eq_(None, result.exception)
+        # The original size is reported even though the image was
+        # never fully decoded.
+        eq_((400, 600), result.original_size)
+        [(thumbnail, size)] = result.thumbnails
+        eq_((200, 300), size)
+        eq_("JPEG", Image.open(StringIO(thumbnail)).format)
+
+    def test_image_already_small_enough(self):
+        # This image is 200x200.
+        content = sample_cover("tiny-image-cover.png")
+        result = scale_image(
+            "key", content, "image/png", [(1000, 1000), (100, 100)], "png"
+        )
+        eq_(None, result.exception)
+        eq_((200, 200), result.original_size)
+        eq_(None, result.thumbnails[0])
+        eq_((100, 100), result.thumbnails[1][1])
+
+    def test_failure(self):
+        result = scale_image("key", "not an image", "image/png",
+                             [(100, 100)], "png")
+        eq_(None, result.original_size)
+        eq_([], result.thumbnails)
+        assert "IOError" in result.exception
+
+
+class TestThumbnailPipeline(object):
+
+    def test_run(self):
+        content = sample_cover("tiny-image-cover.png")
+        jobs = [
+            (1, content, "image/png", [(100, 100)], "png"),
+            (2, "not an image", "image/png", [(100, 100)], "png"),
+            (3, content, "image/png", [(50, 50)], "png"),
+        ]
+        pipeline = ThumbnailPipeline(processes=2)
+        results = dict((x.key, x) for x in pipeline.run(jobs))
+        eq_([1, 2, 3], sorted(results.keys()))
+        eq_((50, 50), results[3].thumbnails[0][1])
+        assert results[2].exception
+        eq_(2, pipeline.scaled)
+        eq_(1, pipeline.failed)
+        assert pipeline.summary().startswith("Scaled 2/3 images")
+
+    def test_run_nothing(self):
+        pipeline = ThumbnailPipeline(processes=1)
+        eq_([], list(pipeline.run([])))
+        eq_("No images scaled.", pipeline.summary())
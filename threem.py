@@ -27,6 +27,7 @@ from model import (
     Identifier,
     Measurement,
     Edition,
+    RateLimit,
     Subject,
 )
 
@@ -66,6 +67,9 @@ class ThreeMAPI(object):
         self.version = version
         self.base_url = base_url
         self.item_list_parser = ItemListParser()
+        self.rate_limiter = RateLimit.limiter_for(
+            _db, Configuration.THREEM_INTEGRATION
+        )
 
         if testing:
             return
@@ -159,15 +163,17 @@ class ThreeMAPI(object):
         if max_age and method=='GET':
             representation, cached = Representation.get(
                 self._db, url, extra_request_headers=headers,
-                do_get=self._simple_http_get, max_age=max_age,
+                do_get=self._rate_limited_http_get, max_age=max_age,
                 exception_handler=Representation.reraise_exception,
             )
             content = representation.content
             return content
         else:
-            return self._request_with_timeout(
-                method, url, data=body, headers=headers, 
-                allow_redirects=False
+            return self.rate_limiter.request(
+                lambda: self._request_with_timeout(
+                    method, url, data=body, headers=headers,
+                    allow_redirects=False
+                )
             )
       
     def get_bibliographic_info_for(self, editions, max_age=None):
@@ -188,6 +194,12 @@ class ThreeMAPI(object):
 
     def bibliographic_lookup(self, identifier, max_age=None):
         data = self.bibliographic_lookup_request(identifier, max_age)
+        return self.parse_bibliographic_lookup(data)
+
+    def parse_bibliographic_lookup(self, data):
+        """Turn the response to a bibliographic lookup into a Metadata
+        object, or None.
+        """
         response = list(self.item_list_parser.parse(data))
         if not response:
             return None
@@ -195,6 +207,11 @@ class ThreeMAPI(object):
             [metadata] = response
         return metadata
 
+    def _rate_limited_http_get(self, url, headers, *args, **kwargs):
+        return self.rate_limiter.request(
+            lambda: self._simple_http_get(url, headers, *args, **kwargs)
+        )
+
     def _request_with_timeout(self, method, url, *args, **kwargs):
         """This will be overridden in MockThreeMAPI."""
         return HTTP.request_with_timeout(method, url, *args, **kwargs)
@@ -430,13 +447,26 @@ class ThreeMBibliographicCoverageProvider(BibliographicCoverageProvider):
             batch_size=25, metadata_replacement_policy=metadata_replacement_policy, **kwargs
         )
 
-    def process_item(self, identifier):
+    # Bibliographic lookups happen in several threads at once.
+    FETCH_THREADS = 5
+
+    def fetch_item(self, identifier):
         # We don't accept a representation from the cache because
         # either this is being run for the first time (in which case
         # there is nothing in the cache) or it's being run to correct
         # for an earlier failure (in which case the representation
-        # in the cache might be wrong).
-        metadata = self.api.bibliographic_lookup(identifier, max_age=0)
+        # in the cache might be wrong). This may run in a worker
+        # thread, so we don't store the response in the cache
+        # either.
+        response = self.api.request("/items/%s" % identifier.identifier)
+        if response.status_code != 200:
+            return None
+        return response.content
+
+    def process_fetched_item(self, identifier, data):
+        metadata = None
+        if data:
+            metadata = self.api.parse_bibliographic_lookup(data)
         if not metadata:
             return CoverageFailure(
                 identifier, "3M bibliographic lookup failed.",
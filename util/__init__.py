@@ -3,6 +3,7 @@
 from nose.tools import set_trace
 from collections import (
     Counter,
+    OrderedDict,
     defaultdict,
 )
 import pkgutil
@@ -38,6 +39,39 @@ def fast_query_count(query):
     return count
 
 
+class LRUCache(object):
+    """A cache that holds at most `capacity` items, discarding the
+    least recently used item when it fills up.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        """Find a cached item, or return `default` if there isn't one."""
+        if key not in self.items:
+            return default
+        # Move this item to the most-recently-used end.
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def set(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        while len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
 class LanguageCodes(object):
     """Convert between ISO-639-2 and ISO-693-1 language codes.
 
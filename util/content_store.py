@@ -0,0 +1,138 @@
+"""A content-addressed store for large blobs kept outside the database."""
+from cStringIO import StringIO
+from nose.tools import set_trace
+import hashlib
+import mmap
+import os
+import tempfile
+
+
+def default_file_mode():
+    """The mode open() would give a new file: 0666, less the umask."""
+    # The only way to read the umask is to set it.
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0666 & ~umask
+
+
+class MappedFile(object):
+    """A read-only filehandle backed by a memory map."""
+
+    def __init__(self, mapped):
+        self.mapped = mapped
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.mapped) - self.mapped.tell()
+        return self.mapped.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.mapped.seek(offset, whence)
+
+    def tell(self):
+        return self.mapped.tell()
+
+    def close(self):
+        self.mapped.close()
+
+    def __len__(self):
+        return len(self.mapped)
+
+
+class ContentStore(object):
+    """Keep blobs on disk, named by the SHA-256 hash of their contents.
+
+    Files are sharded into two levels of subdirectories so no one
+    directory gets too big, e.g. 'ab/cd/abcd1234...'. Storing the same
+    bytes twice only creates one file.
+    """
+
+    # mkstemp() creates files only their owner can read. Blobs get the
+    # mode any other new file would get. This is worked out once, at
+    # import time, since reading the umask isn't thread-safe.
+    FILE_MODE = default_file_mode()
+
+    def __init__(self, root):
+        self.root = root
+
+    @classmethod
+    def content_hash(cls, content):
+        return hashlib.sha256(content).hexdigest()
+
+    def path(self, content_hash):
+        """The path on disk to the blob with the given hash."""
+        return os.path.join(
+            self.root, content_hash[:2], content_hash[2:4], content_hash
+        )
+
+    def __contains__(self, content_hash):
+        return os.path.exists(self.path(content_hash))
+
+    def put(self, content):
+        """Store a blob.
+
+        :return: The hash under which it was stored.
+        """
+        if isinstance(content, unicode):
+            content = content.encode("utf8")
+        content_hash = self.content_hash(content)
+        path = self.path(content_hash)
+        if os.path.exists(path):
+            # We already have these exact bytes.
+            return content_hash
+
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                # Another process created the directory first.
+                if not os.path.isdir(directory):
+                    raise
+
+        # Write to a temporary file and rename it into place, so that
+        # nobody ever sees a partially written blob.
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                os.fchmod(out.fileno(), self.FILE_MODE)
+                out.write(content)
+            os.rename(temp_path, path)
+        except Exception, e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return content_hash
+
+    def open(self, content_hash):
+        """Open a blob for reading.
+
+        :return: A filehandle backed by a read-only memory map of
+        the file.
+        """
+        path = self.path(content_hash)
+        if not os.path.exists(path):
+            raise ValueError("%s does not exist." % path)
+        with open(path, 'rb') as fh:
+            if not os.fstat(fh.fileno()).st_size:
+                # An empty file can't be memory-mapped.
+                return StringIO("")
+            return MappedFile(
+                mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            )
+
+    def get(self, content_hash):
+        """Read a blob into memory."""
+        mapped = self.open(content_hash)
+        try:
+            return mapped.read()
+        finally:
+            mapped.close()
+
+    def delete(self, content_hash):
+        """Remove a blob, if it's there."""
+        try:
+            os.remove(self.path(content_hash))
+        except OSError, e:
+            if os.path.exists(self.path(content_hash)):
+                raise
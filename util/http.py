@@ -1,6 +1,10 @@
 from nose.tools import set_trace
+import cookielib
 import requests
+import threading
 import urlparse
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from flask.ext.babel import lazy_gettext as _
 from problem_detail import ProblemDetail as pd
 
@@ -61,6 +65,18 @@ class BadResponseException(RemoteIntegrationException):
 
     BAD_STATUS_CODE_MESSAGE = "Got status code %s from external server, cannot continue."
 
+    def __init__(self, url_or_service, message, debug_message=None,
+                 response=None):
+        """Indicate that a remote integration has failed.
+
+        :param response: The bad response itself, if there was one, so
+        that the caller can look at its status code and headers.
+        """
+        super(BadResponseException, self).__init__(
+            url_or_service, message, debug_message
+        )
+        self.response = response
+
     def document_debug_message(self, debug=True):
         if debug:
             msg = self.message
@@ -86,7 +102,8 @@ class BadResponseException(RemoteIntegrationException):
             debug_message="Status code: %s\nContent: %s" % (
                 status_code,
                 content,
-            )
+            ),
+            response=response
         )
 
     @classmethod
@@ -123,6 +140,87 @@ class RequestTimedOut(RequestNetworkException, requests.exceptions.Timeout):
 class HTTP(object):
     """A helper for the `requests` module."""
 
+    # Connections to each host are pooled and kept alive between
+    # requests. This is the largest number of connections kept open
+    # to any one host.
+    pool_size = 10
+
+    # By default, failed requests aren't retried. If this is set,
+    # idempotent requests that fail to connect, or that get one of
+    # RETRY_STATUS_CODES, are retried up to this many times, with an
+    # exponential backoff controlled by `backoff_factor`.
+    max_retries = 0
+    backoff_factor = 0.5
+    RETRY_STATUS_CODES = [502, 503, 504]
+
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, pool_size=None, max_retries=None,
+                  backoff_factor=None):
+        """Change how connections are pooled and retried.
+
+        Connections that are already open are closed.
+        """
+        if pool_size is not None:
+            cls.pool_size = pool_size
+        if max_retries is not None:
+            cls.max_retries = max_retries
+        if backoff_factor is not None:
+            cls.backoff_factor = backoff_factor
+        cls.reset_sessions()
+
+    @classmethod
+    def session_for(cls, url):
+        """Find or create the Session used for requests to the host
+        that serves `url`.
+        """
+        parsed = urlparse.urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+        with cls._sessions_lock:
+            session = cls._sessions.get(key)
+            if not session:
+                session = cls._sessions[key] = cls._new_session()
+        return session
+
+    @classmethod
+    def reset_sessions(cls):
+        """Close all pooled connections.
+
+        This should also be called after forking, since connections
+        can't be shared between processes.
+        """
+        with cls._sessions_lock:
+            for session in cls._sessions.values():
+                session.close()
+            cls._sessions = {}
+
+    @classmethod
+    def _new_session(cls):
+        max_retries = cls.max_retries
+        if max_retries:
+            max_retries = Retry(
+                total=max_retries, backoff_factor=cls.backoff_factor,
+                status_forcelist=cls.RETRY_STATUS_CODES,
+                raise_on_status=False
+            )
+
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_maxsize=cls.pool_size, max_retries=max_retries
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        # Each request should stand on its own, as though it had been
+        # made with requests.request. Don't carry cookies from one
+        # response into the next request.
+        session.cookies.set_policy(
+            cookielib.DefaultCookiePolicy(allowed_domains=[])
+        )
+        return session
+
     @classmethod
     def get_with_timeout(cls, url, *args, **kwargs):
         """Make a GET request with timeout handling."""
@@ -136,11 +234,12 @@ class HTTP(object):
 
     @classmethod
     def request_with_timeout(cls, http_method, url, *args, **kwargs):
-        """Call requests.request and turn a timeout into a RequestTimedOut
-        exception.
+        """Make a request through a pooled Session and turn a timeout
+        into a RequestTimedOut exception.
         """
+        session = cls.session_for(url)
         return cls._request_with_timeout(
-            url, requests.request, http_method, url, *args, **kwargs
+            url, session.request, http_method, url, *args, **kwargs
         )
 
     @classmethod
@@ -234,7 +333,8 @@ class HTTP(object):
             raise BadResponseException(
                 url,
                 error_message % code, 
-                debug_message="Response content: %s" % response.content
+                debug_message="Response content: %s" % response.content,
+                response=response
             )
         return response
 
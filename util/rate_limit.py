@@ -0,0 +1,226 @@
+"""Keep the rate of requests to a remote service under control."""
+from nose.tools import set_trace
+from email.utils import (
+    mktime_tz,
+    parsedate_tz,
+)
+import logging
+import threading
+import time
+
+from .http import BadResponseException
+
+
+class TokenBucket(object):
+    """Allow an average of `rate` events per second, with bursts of
+    up to `capacity` events.
+
+    A single TokenBucket can be shared by any number of threads.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.time,
+                 sleep=time.sleep):
+        """Constructor.
+
+        :param rate: The number of tokens added to the bucket every
+        second.
+        :param capacity: The most tokens the bucket can hold. Defaults
+        to `rate`, i.e. one second's worth of tokens.
+        """
+        if rate <= 0:
+            raise ValueError("Rate must be positive, not %r" % rate)
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.capacity
+        self.updated_at = self.clock()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(now - self.updated_at, 0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    def take(self, tokens=1):
+        """Take tokens from the bucket, waiting until enough are
+        available.
+
+        :return: The number of seconds spent waiting.
+        """
+        with self.lock:
+            self._refill(self.clock())
+            # Take the tokens now, even if that puts the bucket in
+            # debt; callers who arrive later will wait for the debt
+            # to be paid off before their own tokens.
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0
+            delay = -self.tokens / self.rate
+        self.sleep(delay)
+        return delay
+
+    def pause(self, seconds):
+        """Hand out no more tokens for at least `seconds`."""
+        with self.lock:
+            self._refill(self.clock())
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+    # Buckets shared by everything in this process that talks to a
+    # given service, keyed by name.
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, name, rate, capacity=None):
+        """Find or create the bucket with the given name.
+
+        If the rate or capacity has changed, the old bucket is
+        replaced.
+        """
+        capacity = float(capacity or max(rate, 1))
+        with cls._shared_lock:
+            bucket = cls._shared.get(name)
+            if (not bucket or bucket.rate != float(rate)
+                or bucket.capacity != capacity):
+                bucket = cls._shared[name] = cls(rate, capacity)
+        return bucket
+
+
+def retry_after(headers, now=None):
+    """How long a response's Retry-After header tells us to wait.
+
+    :return: A number of seconds, or None if there's no usable
+    Retry-After header.
+    """
+    value = None
+    for k, v in (headers or {}).items():
+        if k.lower() == 'retry-after':
+            value = v
+            break
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    # It might be an HTTP date instead of a number of seconds.
+    parsed = parsedate_tz(value)
+    if not parsed:
+        return None
+    now = now or time.time()
+    return max(mktime_tz(parsed) - now, 0)
+
+
+class RateLimiter(object):
+    """Make requests to a remote service no faster than it allows.
+
+    Requests are spaced out by a bucket, which may be a TokenBucket
+    shared by every thread in this process or a bucket shared between
+    processes through the database. If the service says we're going
+    too fast anyway, everyone sharing the bucket backs off -- for as
+    long as the Retry-After header says, or for twice as long each
+    time if there's no Retry-After -- and the request is tried again.
+    """
+
+    # 429 always means we're going too fast. 503 only means that if
+    # it comes with a Retry-After header.
+    TOO_MANY_REQUESTS = 429
+    SERVICE_UNAVAILABLE = 503
+
+    MIN_BACKOFF = 1
+    MAX_BACKOFF = 300
+
+    # Give up and return the throttled response after this many tries.
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, name, bucket=None, sleep=time.sleep):
+        """Constructor.
+
+        :param name: The name of the service, for logging.
+        :param bucket: An object with the same take() and pause()
+        methods as TokenBucket. If this is None, requests aren't
+        spaced out, but we still back off when throttled.
+        """
+        self.name = name
+        self.bucket = bucket
+        self.sleep = sleep
+        self.backoff = self.MIN_BACKOFF
+        self.lock = threading.Lock()
+        self.log = logging.getLogger("Rate limiter for %s" % name)
+
+    def throttled_for(self, status_code, headers):
+        """Decide whether a response means we're going too fast.
+
+        :return: The number of seconds to back off, or None if the
+        response wasn't throttled.
+        """
+        wait = retry_after(headers)
+        if status_code == self.TOO_MANY_REQUESTS or (
+                status_code == self.SERVICE_UNAVAILABLE and wait is not None
+        ):
+            with self.lock:
+                if wait is None:
+                    wait = self.backoff
+                self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+            return wait
+        with self.lock:
+            self.backoff = self.MIN_BACKOFF
+        return None
+
+    def request(self, make_request):
+        """Make a request, waiting for our turn first.
+
+        :param make_request: A function that makes the request and
+        returns either a `requests`-style response or a 3-tuple
+        (status_code, headers, content).
+
+        :return: Whatever make_request() returned the last time it
+        was called. If make_request() raised a BadResponseException
+        that wasn't a throttled 503, or raised one on the last try,
+        the exception propagates.
+        """
+        for attempt in range(self.MAX_ATTEMPTS):
+            if self.bucket:
+                self.bucket.take()
+            try:
+                response = make_request()
+            except BadResponseException, e:
+                # HTTP turns a 5xx response into an exception, but a
+                # 503 with a Retry-After header is the service asking
+                # us to slow down, so it gets the same treatment as a
+                # 429. Anything else, or a 503 on our last try, is
+                # the caller's problem.
+                if (e.response is None
+                    or attempt == self.MAX_ATTEMPTS - 1):
+                    raise
+                status_code, headers = self._status(e.response)
+                wait = self.throttled_for(status_code, headers)
+                if wait is None:
+                    raise
+                self._back_off(status_code, wait, attempt)
+                continue
+            status_code, headers = self._status(response)
+            wait = self.throttled_for(status_code, headers)
+            if wait is None:
+                break
+            self._back_off(status_code, wait, attempt)
+        return response
+
+    def _status(self, response):
+        """Find the status code and headers of a response."""
+        if isinstance(response, tuple):
+            return response[:2]
+        return response.status_code, response.headers
+
+    def _back_off(self, status_code, wait, attempt):
+        self.log.warn(
+            "Got status code %s, backing off for %.1fs.",
+            status_code, wait
+        )
+        if self.bucket:
+            # Nobody sharing the bucket gets to make a request
+            # until we've waited.
+            self.bucket.pause(wait)
+        elif attempt < self.MAX_ATTEMPTS - 1:
+            self.sleep(wait)
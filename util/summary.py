@@ -3,10 +3,151 @@ from collections import Counter
 from nose.tools import set_trace
 from . import (
     Bigrams,
+    LRUCache,
     english_bigrams,
 )
+import hashlib
 import re
 
+class NounPhraseExtractor(object):
+    """Find the noun phrases in a summary and count its sentences."""
+
+    # A short name for this extractor, used as part of the cache key
+    # for its results.
+    name = None
+
+    def analyze(self, summary):
+        """Analyze a summary.
+
+        :return: A 2-tuple (noun phrases, number of sentences). Noun
+        phrases are lowercased and may repeat.
+        """
+        raise NotImplementedError()
+
+
+class TextBlobNounPhraseExtractor(NounPhraseExtractor):
+    """Use TextBlob's part-of-speech tagger to find noun phrases.
+
+    This is accurate but slow.
+    """
+
+    name = "textblob"
+
+    def analyze(self, summary):
+        blob = TextBlob(summary)
+        try:
+            sentences = len(blob.sentences)
+        except Exception, e:
+            # Can't parse into sentences for whatever reason.
+            # Make a really bad guess.
+            sentences = summary.count(". ") + 1
+        return list(blob.noun_phrases), sentences
+
+
+class RegexNounPhraseExtractor(NounPhraseExtractor):
+    """Find noun phrases with regular expressions instead of a
+    part-of-speech tagger.
+
+    A noun phrase is a run of two or more words that aren't stopwords,
+    or a single capitalized word (probably a proper noun). A change
+    between capitalized and lowercase words ends a run, so "they
+    meet Alice and the Mock Turtle" yields "alice" and "mock turtle".
+    The capitalization of the first word in a sentence doesn't count.
+
+    This is much faster than TextBlob and finds most of the same
+    phrases, which is all SummaryEvaluator needs.
+    """
+
+    name = "regex"
+
+    STOPWORDS = set("""
+a about above after again against all also am an and any are as at be
+because been before being below between both but by can could did do
+does doing down during each even ever every few for from further had
+has have having he her here hers herself him himself his how however i
+if in into is it its itself just least less like many may me might more
+most much must my myself never no nor not now of off often on once one
+only or other our ours ourselves out over own rather same several she
+should since so some such than that the their theirs them themselves
+then there these they this those though through thus to too under
+until up upon us very was we were what when where whether which while
+who whom whose why will with within without would yet you your yours
+yourself yourselves
+""".split())
+
+    WORD = re.compile(ur"[^\W\d_][\w'\u2019-]*|[^\w\s]", re.U)
+    POSSESSIVE = re.compile(ur"['\u2019]s?$", re.U)
+    SENTENCE_END = re.compile(r"[.!?]+(?:\s+|$)")
+
+    def analyze(self, summary):
+        phrases = []
+        run = []
+        run_capitalized = None
+        sentence_start = True
+        for token in self.WORD.findall(summary):
+            if not token[0].isalpha() or token.lower() in self.STOPWORDS:
+                # Punctuation or a stopword ends the current run.
+                self._add_phrase(run, phrases)
+                run = []
+                run_capitalized = None
+                if token[0].isalpha():
+                    sentence_start = False
+                elif token in ".!?":
+                    sentence_start = True
+                continue
+            if sentence_start:
+                # This word would be capitalized no matter what it is.
+                capitalized = None
+            else:
+                capitalized = token[0].isupper()
+            sentence_start = False
+            if (run and None not in (capitalized, run_capitalized)
+                and capitalized != run_capitalized):
+                self._add_phrase(run, phrases)
+                run = []
+            run.append(self.POSSESSIVE.sub("", token))
+            if capitalized is not None:
+                run_capitalized = capitalized
+        self._add_phrase(run, phrases)
+
+        sentences = len(
+            [x for x in self.SENTENCE_END.split(summary.strip()) if x.strip()]
+        )
+        return phrases, max(sentences, 1)
+
+    def _add_phrase(self, run, phrases):
+        if len(run) > 1 or (run and run[0][0].isupper()):
+            phrases.append(" ".join(run).lower())
+
+
+def noun_phrase_agreement(summaries, extractor, baseline=None):
+    """Measure how closely one noun phrase extractor agrees with another.
+
+    :param summaries: A list of summaries to analyze.
+    :param extractor: The NounPhraseExtractor being evaluated.
+    :param baseline: The NounPhraseExtractor to compare against;
+        defaults to TextBlob.
+    :return: The average, over all summaries, of the Jaccard
+        similarity between the two sets of noun phrases found.
+    """
+    baseline = baseline or TextBlobNounPhraseExtractor()
+    similarities = []
+    for summary in summaries:
+        found, ignore = extractor.analyze(summary)
+        expected, ignore = baseline.analyze(summary)
+        found = set(found)
+        expected = set(expected)
+        union = found | expected
+        if not union:
+            # Both extractors agree there are no noun phrases.
+            similarities.append(1.0)
+        else:
+            similarities.append(len(found & expected) / float(len(union)))
+    if not similarities:
+        return None
+    return sum(similarities) / len(similarities)
+
+
 class SummaryEvaluator(object):
 
     """Evaluate summaries of a book to find a usable summary.
@@ -53,12 +194,27 @@ class SummaryEvaluator(object):
         re.compile("This is"),
     ])
 
+    # Noun phrase extractors, by the name used to configure them.
+    EXTRACTORS = dict(
+        (extractor.name, extractor) for extractor in [
+            TextBlobNounPhraseExtractor, RegexNounPhraseExtractor
+        ]
+    )
+    DEFAULT_EXTRACTOR = TextBlobNounPhraseExtractor.name
+
+    # The results of analyzing summaries, keyed by extractor name
+    # and a hash of the summary, so that a summary is never analyzed
+    # twice by the same process. model.SummaryAnalysis keeps them
+    # around for other processes.
+    analysis_cache = LRUCache(10000)
+
     def __init__(self, optimal_number_of_sentences=4,
-                 noun_phrases_to_consider=10, bad_phrases=None):
+                 noun_phrases_to_consider=10, bad_phrases=None,
+                 noun_phrase_extractor=None):
         self.optimal_number_of_sentences=optimal_number_of_sentences
         self.summaries = []
         self.noun_phrases = Counter()
-        self.blobs = dict()
+        self.analyses = dict()
         self.scores = dict()
         self.noun_phrases_to_consider = float(noun_phrases_to_consider)
         self.top_noun_phrases = None
@@ -66,17 +222,56 @@ class SummaryEvaluator(object):
             self.bad_phrases = self.default_bad_phrases
         else:
             self.bad_phrases = bad_phrases
+        if not noun_phrase_extractor:
+            noun_phrase_extractor = self.DEFAULT_EXTRACTOR
+        if isinstance(noun_phrase_extractor, basestring):
+            noun_phrase_extractor = self.EXTRACTORS[noun_phrase_extractor]()
+        self.noun_phrase_extractor = noun_phrase_extractor
+
+        # Analyses this evaluator had to perform itself, keyed by
+        # content hash.
+        self.new_analyses = dict()
+
+    @classmethod
+    def content_hash(cls, summary):
+        """A hash of a summary's text."""
+        if isinstance(summary, unicode):
+            summary = summary.encode("utf8")
+        return hashlib.sha1(summary).hexdigest()
+
+    def remember(self, content_hash, analysis):
+        """Make an analysis performed elsewhere available to this
+        evaluator, so the summary isn't analyzed again.
+
+        :param analysis: A 2-tuple (noun phrases, number of sentences).
+        """
+        key = (self.noun_phrase_extractor.name, content_hash)
+        self.analysis_cache.set(key, analysis)
+
+    def analyze(self, summary):
+        """Find the noun phrases in a summary and count its sentences,
+        reusing the results of any previous analysis of the same text.
+        """
+        content_hash = self.content_hash(summary)
+        key = (self.noun_phrase_extractor.name, content_hash)
+        analysis = self.analysis_cache.get(key)
+        if analysis is None:
+            analysis = self.noun_phrase_extractor.analyze(summary)
+            self.analysis_cache.set(key, analysis)
+            self.new_analyses[content_hash] = analysis
+        return analysis
 
     def add(self, summary):
         if isinstance(summary, str):
             summary = summary.decode("utf8")
-        if summary in self.blobs:
+        if summary in self.analyses:
             # We already evaluated this summary. Don't count it more than once
             return
-        blob = TextBlob(summary)
-        self.blobs[summary] = blob
+        analysis = self.analyze(summary)
+        self.analyses[summary] = analysis
         self.summaries.append(summary)
-        for phrase in blob.noun_phrases:
+        noun_phrases, sentences = analysis
+        for phrase in noun_phrases:
             self.noun_phrases[phrase] = self.noun_phrases[phrase] + 1
 
     def ready(self):
@@ -106,18 +301,12 @@ class SummaryEvaluator(object):
         if summary in self.scores:
             return self.scores[summary]
         score = 1
-        blob = self.blobs[summary]
+        noun_phrases, sentences = self.analyses[summary]
 
         top_noun_phrases_used = len(
-            [p for p in self.top_noun_phrases if p in blob.noun_phrases])
+            [p for p in self.top_noun_phrases if p in noun_phrases])
         score = 1 * (top_noun_phrases_used/self.noun_phrases_to_consider)
 
-        try:
-            sentences = len(blob.sentences)
-        except Exception, e:
-            # Can't parse into sentences for whatever reason.
-            # Make a really bad guess.
-            sentences = summary.count(". ") + 1
         off_from_optimal = abs(sentences-self.optimal_number_of_sentences)
         if off_from_optimal == 1:
             off_from_optimal = 1.5
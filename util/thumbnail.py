@@ -0,0 +1,173 @@
+"""Scale cover images down to thumbnail size.
+
+The work happens on raw bytes rather than on Representation objects
+so that it can be farmed out to a pool of worker processes.
+"""
+from collections import namedtuple
+from cStringIO import StringIO
+from nose.tools import set_trace
+import logging
+import multiprocessing
+import time
+import traceback
+
+import cairosvg
+from PIL import Image
+
+SVG_MEDIA_TYPE = u"image/svg+xml"
+
+# The outcome of scaling one image.
+#
+# `key` identifies the image to the caller. `original_size` is the
+# (width, height) of the image as it was found. `thumbnails` contains
+# one item per requested size: either None (the image is already
+# small enough) or a 2-tuple (content, (width, height)). If anything
+# went wrong, `exception` holds the traceback and `thumbnails` is
+# empty.
+ScaledImage = namedtuple(
+    "ScaledImage",
+    ["key", "original_size", "thumbnails", "elapsed", "exception"]
+)
+
+
+def open_image(content, media_type):
+    """Open an image without decoding its pixel data."""
+    if media_type == SVG_MEDIA_TYPE:
+        # Transparently convert the SVG to a PNG.
+        content = cairosvg.svg2png(content)
+    return Image.open(StringIO(content))
+
+
+def _thumbnail(image, size):
+    scaled = image.copy()
+    try:
+        scaled.thumbnail(size, Image.ANTIALIAS)
+    except IOError, e:
+        # I'm not sure why, but sometimes just trying it again works.
+        scaled = image.copy()
+        scaled.thumbnail(size, Image.ANTIALIAS)
+    return scaled
+
+
+def scale_image(key, content, media_type, sizes, pil_format):
+    """Decode an image once and scale it to every one of `sizes`.
+
+    :param sizes: A list of (max_width, max_height) 2-tuples.
+    :param pil_format: The PIL format to use when encoding the
+    thumbnails, e.g. "png".
+
+    :return: A ScaledImage. This function never raises an exception.
+    """
+    start = time.time()
+    original_size = None
+    thumbnails = []
+    exception = None
+    try:
+        image = open_image(content, media_type)
+        original_size = image.size
+
+        # Only SVGs need to be converted no matter how small they are.
+        always_scale = (media_type == SVG_MEDIA_TYPE)
+        needed = [
+            (w, h) for w, h in sizes
+            if always_scale or original_size[0] > w or original_size[1] > h
+        ]
+        if needed:
+            # A JPEG can be scaled down by a power of two as it's
+            # decoded, which is much cheaper than decoding the whole
+            # thing. Ask for nothing smaller than the largest
+            # thumbnail we need to make.
+            image.draft(
+                'RGB', (max(w for w, h in needed), max(h for w, h in needed))
+            )
+            image.load()
+
+        for size in sizes:
+            if size not in needed:
+                thumbnails.append(None)
+                continue
+            scaled = _thumbnail(image, size)
+            if scaled.mode != 'RGB':
+                scaled = scaled.convert('RGB')
+            output = StringIO()
+            scaled.save(output, pil_format)
+            thumbnails.append((output.getvalue(), scaled.size))
+            output.close()
+    except Exception, e:
+        exception = traceback.format_exc()
+        thumbnails = []
+    return ScaledImage(
+        key, original_size, thumbnails, time.time() - start, exception
+    )
+
+
+def _scale_image(args):
+    """Unpack arguments for scale_image. Pool.imap can only pass one."""
+    return scale_image(*args)
+
+
+class ThumbnailPipeline(object):
+    """Scale many images, possibly in parallel, keeping track of
+    how long it takes and how often it fails.
+    """
+
+    log = logging.getLogger("Thumbnail pipeline")
+
+    def __init__(self, processes=None):
+        """Constructor.
+
+        :param processes: The number of worker processes to use. If this
+        is 1, images are scaled in the current process. If this is
+        None, one worker process is used per CPU.
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.scaled = 0
+        self.failed = 0
+        self.elapsed = 0
+
+    def run(self, jobs):
+        """Scale a number of images.
+
+        :param jobs: A list of 5-tuples of arguments to scale_image().
+        :return: A generator of ScaledImage objects, in no particular
+        order.
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return
+        if self.processes == 1 or len(jobs) == 1:
+            results = (_scale_image(job) for job in jobs)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(min(self.processes, len(jobs)))
+            results = pool.imap_unordered(_scale_image, jobs)
+        try:
+            for result in results:
+                self.elapsed += result.elapsed
+                if result.exception:
+                    self.failed += 1
+                    self.log.warn(
+                        "Could not scale %r after %.2fs: %s",
+                        result.key, result.elapsed, result.exception
+                    )
+                else:
+                    self.scaled += 1
+                    self.log.debug(
+                        "Scaled %r in %.2fs", result.key, result.elapsed
+                    )
+                yield result
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def summary(self):
+        """Summarize the work done so far."""
+        total = self.scaled + self.failed
+        if not total:
+            return "No images scaled."
+        return "Scaled %d/%d images in %.2fs (%.3fs per image), %d failures." % (
+            self.scaled, total, self.elapsed, self.elapsed/total, self.failed
+        )